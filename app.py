@@ -7,7 +7,7 @@ from modules.utility import random_password
 from modules.mediawiki import cors_proxy
 from modules.controller import default, session_control, image_review, unreviewed_files, file_search
 from modules.controller import review_report, cleanup_action, cleanup_reason, wikitext_template
-from modules.controller import user_management, help_pages
+from modules.controller import user_management, help_pages, duplicate_report
 from modules.model import db
 
 #Load the configuration file. Do this only after importing every module so they've had a chance to
@@ -23,6 +23,7 @@ app.register_blueprint(image_review.blueprint)
 app.register_blueprint(unreviewed_files.blueprint)
 app.register_blueprint(file_search.blueprint)
 app.register_blueprint(review_report.blueprint)
+app.register_blueprint(duplicate_report.blueprint)
 app.register_blueprint(cleanup_action.blueprint)
 app.register_blueprint(cleanup_reason.blueprint)
 app.register_blueprint(wikitext_template.blueprint)
@@ -171,13 +171,24 @@ function select_image(state, new_index = state.selected_image) {
     const similar_image_count = update_similar_images(state, state.revisions[new_index].timestamp,
                                                       true);
 
-    //Update the similar image count
-    if (similar_image_count === 0)
+    //Update the similar image count. Revisions with a hub hash only show the most similar images,
+    //and more can be requested.
+    const hub = state.similar_image_hubs[state.revisions[new_index].timestamp];
+    if (hub && Number.isInteger(similar_image_count))
+      similar_image_strip_label.textContent =
+        `${similar_image_count} of about ${hub.neighbor_count} possibly similar images ` +
+        '(this image resembles too many files, the most similar ones are shown first):';
+    else if (similar_image_count === 0)
       similar_image_strip_label.textContent = 'No similar images';
     else if (similar_image_count === 1)
       similar_image_strip_label.textContent = '1 possibly similar image:';
     else if (Number.isInteger(similar_image_count))
       similar_image_strip_label.textContent = `${similar_image_count} possibly similar images:`;
+    else if (state.similar_images_pending)
+      similar_image_strip_label.textContent = 'Looking for similar images...';
+
+    document.getElementById('similar_image_more').style.display =
+      (hub && hub.more_results)? '': 'none';
 
     state.selected_image = new_index;
   }
@@ -510,11 +521,93 @@ function update_revision_strip_readonly(state, cleanup_proposal) {
   }
 }
 
-//Query the wiki for information about images similar to the current one and update the DOM when
-//completed
-export async function download_similar_image_data(api_url, state, similar_images) {
+//Add the elements of a group of similar images to the similar image strip, linking them to a revision
+//of the current image
+//Parameters:
+// - state: Contains the dynamic state of the web page, where the elements are referenced.
+// - ref_timestamp: The timestamp of the revision of the current image.
+// - similar_images: An object with the similar image information of the revision, by title.
+// - wiki_image_info: The information of the similar images obtained from the wiki.
+function add_similar_image_elements(state, ref_timestamp, similar_images, wiki_image_info) {
   const similar_img_strip = document.getElementById('similar_img_strip');
 
+  //Temporary holder for element references, shared by all revisions
+  const similar_img_elements = state.similar_img_elements;
+
+  for (const [si_title, similar_image_status] of Object.entries(similar_images)) {
+    //If the wiki didn't return information for the requested image, skip it, as the image
+    //could've been recently deleted and there's no point in reporting it anymore
+    if (!(si_title in wiki_image_info))
+      continue;
+
+    for (const si_timestamp of similar_image_status.revisions) {
+      //If the wiki didn't return information for the referenced revision, skip it as well
+      if (!(si_timestamp in wiki_image_info[si_title]))
+        continue;
+
+      //If the title and timestamp are in the temporary references, simply link the existing DOM
+      //element, as more than revision is referencing it
+      if (si_title in similar_img_elements && si_timestamp in similar_img_elements[si_title])
+      {
+        state.similar_img_strip_elements[ref_timestamp].push(
+          similar_img_elements[si_title][si_timestamp]);
+
+        continue;
+      }
+
+      //Add a new DIV container to the similar image strip, then populate it with details
+      //regarding to that particular image. Make it initially invisible until a related revision
+      //is selected.
+      const container = similar_img_strip.appendChild(document.createElement('div'));
+      container.classList.add('similar_image_strip_item');
+      container.style.display = 'none';
+      container.innerHTML = `
+      <div class="similar_image">
+        <img src="${wiki_image_info[si_title][si_timestamp].thumburl}">
+      </div>
+      <div class="similar_image_title">
+        ${si_title}
+      </div>
+      <div>
+        <span style="color: ${similar_image_status.unused? 'red': 'green'};">
+          ${similar_image_status.unused? '&cross;': '&check;'}
+        </span>
+        <a href="${wiki_image_info[si_title][si_timestamp].descriptionurl}" target="_blank">
+          ${similar_image_status.unused? 'Not in use': 'In use'}
+        </a>
+      </div>
+      <div>
+        <span style="color: ${similar_image_status.reviewed? 'green': 'red'};">
+          ${similar_image_status.reviewed? '&check;': '&cross;'}
+        </span>
+        <a href="${similar_image_status.review_url}" target="_blank">
+          ${similar_image_status.reviewed? 'Reviewed': 'Not reviewed'}
+        </a>
+      </div>
+      `;
+
+      //Append the newly created container to the similar image strip elements array, so that it
+      //can be referenced when selecting a revision
+      state.similar_img_strip_elements[ref_timestamp].push(container);
+
+      //Also add the container to the temporary references, so that it can be reused if referenced
+      //by another revision
+      if (!(si_title in similar_img_elements))  //Create the object only once
+        similar_img_elements[si_title] = {};
+
+      similar_img_elements[si_title][si_timestamp] = container;
+    }
+  }
+}
+
+//Query the wiki for information about a group of similar images and add them to the DOM
+//Parameters:
+// - api_url: The URL of the wiki API.
+// - state: Contains the dynamic state of the web page.
+// - similar_images: An object with the similar image information, by revision timestamp and title.
+// - similar_image_hubs: An object with the summary of the revisions with a hub hash (similar to a
+//   crowd of images), by revision timestamp, of which only the most similar images are included.
+async function add_similar_images(api_url, state, similar_images, similar_image_hubs) {
   //Retrieve all unique titles from the similar_images object
   const similar_image_titles = [];
   for (const image of Object.values(similar_images)) {
@@ -530,80 +623,86 @@ export async function download_similar_image_data(api_url, state, similar_images
                           await query_multiple_images(api_url, similar_image_titles);
 
   //Perform a nested iteration over the similar image (si) information object, down to each revision
-  const similar_img_elements = {};  //Temporary holder for element references
   for (const ref_timestamp in similar_images) {
     //Prepare an empty array for potential references to similar image strip elements
     state.similar_img_strip_elements[ref_timestamp] = [];
     //Note: a zero length array is valid and used to signal that there are no similar images after
     //downloading image information from the wiki
 
-    for (const [si_title, similar_image_status] of Object.entries(similar_images[ref_timestamp])) {
-      //If the wiki didn't return information for the requested image, skip it, as the image
-      //could've been recently deleted and there's no point in reporting it anymore
-      if (!(si_title in wiki_image_info))
-        continue;
+    add_similar_image_elements(state, ref_timestamp, similar_images[ref_timestamp],
+                               wiki_image_info);
+  }
+
+  Object.assign(state.similar_image_hubs, similar_image_hubs);
+}
+
+//Query the wiki for information about images similar to the current one and update the DOM when
+//completed. If the search for similar images was interrupted by its time budget, the images similar
+//to the remaining revisions are requested until the search completes.
+//Parameters:
+// - api_url: The URL of the wiki API.
+// - state: Contains the dynamic state of the web page.
+// - similar_images: An object with the similar image information, by revision timestamp and title.
+// - similar_image_hubs: An object with the summary of the revisions with a hub hash (similar to a
+//   crowd of images), by revision timestamp, of which only the most similar images are included.
+// - cursor: The cursor for continuing the search, or null if it's complete.
+// - similar_images_urls: The URLs for requesting more similar images of the revisions with a hub
+//   hash (page) and the similar images of the remaining revisions (remaining).
+export async function download_similar_image_data(api_url, state, similar_images,
+                                                  similar_image_hubs, cursor, similar_images_urls) {
+  //Request the next page of similar images of the selected revision when asked to
+  const similar_image_more = document.getElementById('similar_image_more');
+  similar_image_more.addEventListener('click', async () => {
+    const ref_timestamp = state.revisions[state.selected_image].timestamp;
+    const hub = state.similar_image_hubs[ref_timestamp];
+    similar_image_more.disabled = true;
+
+    try {
+      const params = new URLSearchParams({ 'revision': ref_timestamp, 'offset': hub.offset });
+      const response = await fetch(similar_images_urls.page + '?' + params.toString());
+      if (!response.ok)
+        throw 'Unable to obtain more similar images';
+
+      const page = await response.json();
+      const page_titles = Object.keys(page.similar_images);
+      const page_image_info = (page_titles.length === 0)? {}:
+                              await query_multiple_images(api_url, page_titles);
+
+      add_similar_image_elements(state, ref_timestamp, page.similar_images, page_image_info);
+      hub.offset = page.offset;
+      hub.more_results = page.more_results;
+    }
+    finally {
+      similar_image_more.disabled = false;
+      select_image(state);  //Refresh the selected image, showing the new elements
+    }
+  });
 
-      for (const si_timestamp of similar_image_status.revisions) {
-        //If the wiki didn't return information for the referenced revision, skip it as well
-        if (!(si_timestamp in wiki_image_info[si_title]))
-          continue;
+  state.similar_images_pending = (cursor !== null);
 
-        //If the title and timestamp are in the temporary references, simply link the existing DOM
-        //element, as more than revision is referencing it
-        if (si_title in similar_img_elements && si_timestamp in similar_img_elements[si_title])
-        {
-          state.similar_img_strip_elements[ref_timestamp].push(
-            similar_img_elements[si_title][si_timestamp]);
+  try {
+    await add_similar_images(api_url, state, similar_images, similar_image_hubs);
+    select_image(state);  //Refresh the selected image
 
-          continue;
-        }
+    //Continue the search for the remaining revisions, showing their similar images as they arrive
+    while (cursor !== null) {
+      const params = new URLSearchParams({ 'cursor': cursor });
+      const response = await fetch(similar_images_urls.remaining + '?' + params.toString());
+      if (!response.ok)
+        throw 'Unable to obtain the remaining similar images';
 
-        //Add a new DIV container to the similar image strip, then populate it with details
-        //regarding to that particular image. Make it initially invisible until a related revision
-        //is selected.
-        const container = similar_img_strip.appendChild(document.createElement('div'));
-        container.classList.add('similar_image_strip_item');
-        container.style.display = 'none';
-        container.innerHTML = `
-        <div class="similar_image">
-          <img src="${wiki_image_info[si_title][si_timestamp].thumburl}">
-        </div>
-        <div class="similar_image_title">
-          ${si_title}
-        </div>
-        <div>
-          <span style="color: ${similar_images[ref_timestamp][si_title].unused? 'red': 'green'};">
-            ${similar_images[ref_timestamp][si_title].unused? '&cross;': '&check;'}
-          </span>
-          <a href="${wiki_image_info[si_title][si_timestamp].descriptionurl}" target="_blank">
-            ${similar_images[ref_timestamp][si_title].unused? 'Not in use': 'In use'}
-          </a>
-        </div>
-        <div>
-          <span style="color: ${similar_images[ref_timestamp][si_title].reviewed? 'green': 'red'};">
-            ${similar_images[ref_timestamp][si_title].reviewed? '&check;': '&cross;'}
-          </span>
-          <a href="${similar_images[ref_timestamp][si_title].review_url}" target="_blank">
-            ${similar_images[ref_timestamp][si_title].reviewed? 'Reviewed': 'Not reviewed'}
-          </a>
-        </div>
-        `;
-
-        //Append the newly created container to the similar image strip elements array, so that it
-        //can be referenced when selecting a revision
-        state.similar_img_strip_elements[ref_timestamp].push(container);
-
-        //Also add the container to the temporary references, so that it can be reused if referenced
-        //by another revision
-        if (!(si_title in similar_img_elements))  //Create the object only once
-          similar_img_elements[si_title] = {};
-
-        similar_img_elements[si_title][si_timestamp] = container;
-      }
+      const remaining = await response.json();
+      await add_similar_images(api_url, state, remaining.similar_images,
+                               remaining.similar_image_hubs);
+      cursor = remaining.cursor;
+
+      state.similar_images_pending = (cursor !== null);
+      select_image(state);  //Refresh the selected image
     }
   }
-
-  select_image(state);  //Refresh the selected image
+  finally {
+    state.similar_images_pending = false;
+  }
 }
 
 //Functions for handling form data and submit requests
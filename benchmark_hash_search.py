@@ -0,0 +1,107 @@
+#!/usr/bin/env -S sh -c 'cd $(dirname $0); python/bin/python -m $(basename ${0%.py}) $@'
+
+import random, tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+from modules.common import config
+from modules.model import db
+from modules.model.table import hashes
+from modules.model.hash_index import packed_array
+
+#Register and parse program arguments
+parser = ArgumentParser(description = 'Compare the hamming distance search of the full table scan '
+                                      'and the packed array snapshot on a synthetic database')
+parser.add_argument('-n', '--hash-count', type = int, default = 1000000,
+                    help = 'Amount of hashes in the synthetic database (default: 1000000)')
+parser.add_argument('-q', '--query-count', type = int, default = 20,
+                    help = 'Amount of search queries performed by each engine (default: 20)')
+parser.add_argument('-d', '--max-dist', type = int, default = 12,
+                    help = 'Maximum hamming distance of the search queries (default: 12)')
+parser.add_argument('-s', '--seed', type = int, default = 0,
+                    help = 'Seed for the random hash generator (default: 0)')
+args = parser.parse_args()
+
+#Work on a temporary database and snapshot file, so no real data is touched
+temp_dir = tempfile.TemporaryDirectory()
+config_path = Path(temp_dir.name) / 'config.toml'
+config_path.write_text(f"[sqlite3]\n"
+                       f"path = '{Path(temp_dir.name) / 'db.sqlite3'}'\n"
+                       f"[similarity_search]\n"
+                       f"snapshot_file = '{Path(temp_dir.name) / 'hash_snapshot.bin'}'\n")
+
+config.load(str(config_path), warn_unknown = False)
+
+db.go_without_flask()
+db.initialize_schema()
+
+#Hashes refer to revisions that don't exist in the synthetic database
+con = db.get()
+con.execute('PRAGMA foreign_keys = 0')
+
+#Generate clustered hashes, similarly to real images: every cluster has a random base hash and its
+#members differ from it in a few bits
+def generate_hashes(count: int) -> list[tuple[int, int]]:
+  rows = []
+  while len(rows) < count:
+    base_hash = random.getrandbits(64)
+    for _ in range(random.randint(1, 20)):
+      member_hash = base_hash
+      for bit in random.sample(range(64), random.randint(0, 8)):
+        member_hash ^= 1 << bit
+
+      #Hashes are stored as signed 64-bit integers
+      rows.append((len(rows) + 1, member_hash - (1 << 64) if member_hash >= 1 << 63 else member_hash))
+  return rows[:count]
+
+random.seed(args.seed)
+
+print(f'Generating {args.hash_count} hashes...')
+rows = generate_hashes(args.hash_count)
+with con:
+  con.executemany(
+    'INSERT INTO revision_hashes (revision_id, sequence, status, hash) VALUES (?, ?, ?, ?)',
+    ((revision_id, revision_id, hashes.STATUS_HASHED, hash_) for revision_id, hash_ in rows))
+
+#Measure the time it takes to run a function, returning its result too
+def timed(func, *func_args) -> tuple[float, any]:
+  start_time = perf_counter()
+  result = func(*func_args)
+  return perf_counter() - start_time, result
+
+elapsed, _ = timed(packed_array.refresh)
+print(f'Snapshot creation: {elapsed:.3f}s')
+
+#Search for hashes taken from the database, so every query has matches
+queries = [rows[random.randrange(len(rows))][1] for _ in range(args.query_count)]
+
+full_scan_times = []
+packed_array_times = []
+for ref_hash in queries:
+  full_scan_time, full_scan_result = timed(hashes.search, ref_hash, args.max_dist)
+  packed_array_time, packed_array_result = timed(packed_array.search, ref_hash, args.max_dist)
+
+  if sorted(full_scan_result) != sorted(packed_array_result):
+    raise RuntimeError(f'Search results differ for hash {ref_hash}')
+
+  full_scan_times.append(full_scan_time)
+  packed_array_times.append(packed_array_time)
+
+print(f'Full table scan: {median(full_scan_times) * 1000:.1f}ms median query time')
+print(f'Packed array:    {median(packed_array_times) * 1000:.1f}ms median query time '
+      f'({median(full_scan_times) / median(packed_array_times):.1f}x faster)')
+
+#Measure an incremental refresh after adding some more hashes
+new_rows = [(len(rows) + revision_id, hash_)
+            for revision_id, hash_ in generate_hashes(max(args.hash_count // 1000, 1))]
+with con:
+  con.executemany(
+    'INSERT INTO revision_hashes (revision_id, sequence, status, hash) VALUES (?, ?, ?, ?)',
+    ((revision_id, revision_id, hashes.STATUS_HASHED, hash_) for revision_id, hash_ in new_rows))
+
+elapsed, _ = timed(packed_array.refresh)
+print(f'Snapshot refresh ({len(new_rows)} new hashes): {elapsed:.3f}s')
+
+db.close()
+temp_dir.cleanup()
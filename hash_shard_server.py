@@ -0,0 +1,62 @@
+#!/usr/bin/env -S sh -c 'cd $(dirname $0); python/bin/python -m $(basename ${0%.py}) $@'
+
+from argparse import ArgumentParser
+import multiprocessing, os, signal, sys
+from modules.common import config
+from modules.model import db
+from modules.model.hash_index import sharded
+
+#Register and parse program arguments
+parser = ArgumentParser(description = 'Run the shard servers of the sharded similarity search '
+                                      'engine, each one in its own process pinned to a CPU core')
+parser.add_argument('-s', '--shard',
+                    type = int,
+                    help = 'Run the server of a single shard in this process (default: run all)')
+args = parser.parse_args()
+
+#Load configuration
+config.load('config.toml', warn_unknown = False)
+
+#Run the server of a shard, pinned to a core if supported by the platform
+def run_shard(shard_index: int, core: int | None) -> None:
+  #Let the server remove its socket when terminated
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+  if core is not None:
+    os.sched_setaffinity(0, {core})
+
+  db.go_without_flask()
+  try:
+    sharded.serve(shard_index)
+  except KeyboardInterrupt:
+    pass
+
+shard_count = config.root.similarity_search.shard_count
+if args.shard is not None:
+  if not 0 <= args.shard < shard_count:
+    parser.error(f'Shard index out of range (expected 0 to {shard_count - 1})')
+  run_shard(args.shard, None)
+else:
+  #Spread the shards among the cores this process may run on
+  cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_setaffinity') else None
+
+  #Fork the shard processes, so they inherit the configuration
+  context = multiprocessing.get_context('fork')
+  processes = [
+    context.Process(target = run_shard,
+                    args = (shard_index, cores[shard_index % len(cores)] if cores else None))
+    for shard_index in range(shard_count)]
+
+  for process in processes:
+    process.start()
+
+  #Forward termination requests to the shard processes
+  def handle_signal(signum, frame):
+    for process in processes:
+      process.terminate()
+
+  signal.signal(signal.SIGTERM, handle_signal)
+  signal.signal(signal.SIGINT, handle_signal)
+
+  for process in processes:
+    process.join()
@@ -15,6 +15,8 @@ from modules.model.table import cleanup_choices
 from modules.model.table import image_reviews
 from modules.model.table import revision_reviews
 from modules.model.table import wikitext
+from modules.model.table import sync_state
+from modules.model.table import image_usage
 from modules.model.view import pending_hashes
 from modules.model.view import unreviewed_images
 from modules.model.view import similar_images
@@ -22,6 +24,10 @@ from modules.model.view import image_revisions
 from modules.model.view import user_privileges
 from modules.model.view import cleanup_action_reason_links
 from modules.model.view import review_details
+from modules.model.hash_index import similar_pairs
+from modules.model.hash_index import duplicate_clusters
+from modules.model.hash_index import hub_hashes
+from modules.model.hash_index import result_cache
 
 config.load('config.toml', warn_unknown = False)
 
@@ -0,0 +1,52 @@
+from flask import Blueprint, request, render_template, abort
+from modules.controller import session_control
+from modules.model.hash_index import duplicate_clusters
+
+blueprint = Blueprint('duplicate_report', __name__)
+
+#Route handler for the duplicate report view
+@blueprint.get('/duplicate_report')
+@session_control.login_required()
+def get() -> str:
+  #Validate and get the limit and offset request parameters
+  limit, offset = _validate_request_range()
+
+  #Gather the clusters in the range, which are computed by the image update script
+  clusters, more_results = duplicate_clusters.get_range(limit, offset)
+
+  render_params = {
+    'limit': limit,
+    'offset': offset,
+    'more_results': more_results,
+    'clusters': clusters,
+    'info': duplicate_clusters.get_info(),
+  }
+
+  return render_template('view/duplicate_report.jinja.html', **render_params)
+
+#Convert the limit and offset request arguments to integers, validate them, and provide defaults if
+#absent
+def _validate_request_range() -> tuple[int, int]:
+  if 'limit' in request.args:
+    try:
+      limit = int(request.args['limit'])
+    except ValueError:
+      abort(400, 'Request parameter must be a number: limit')
+
+    if limit <= 0:
+      abort(400, 'Request parameter must be greater than 0: limit')
+  else:
+    limit = 50
+
+  if 'offset' in request.args:
+    try:
+      offset = int(request.args['offset'])
+    except ValueError:
+      abort(400, 'Request parameter must be a number: offset')
+
+    if offset < 0:
+      abort(400, 'Request parameter must be greater than or equal to 0: offset')
+  else:
+    offset = 0
+
+  return limit, offset
@@ -1,7 +1,8 @@
+import time
 from flask import Blueprint, request, abort, g, redirect, url_for, render_template
 from werkzeug.exceptions import HTTPException
 from modules.controller import session_control
-from modules.model.table import users, image_concessions
+from modules.model.table import users, images, image_concessions
 from modules.model.view import image_revisions, similar_images
 from modules.model.view import cleanup_action_reason_links, review_details
 from modules.model.aggregate import review_candidates, review_store
@@ -12,11 +13,21 @@ blueprint = Blueprint('image_review', __name__)
 #Field size limits
 COMMENTS_MAX_LEN = 256
 
+#Maximum hamming distance of similar images
+SIMILAR_MAX_DIST = 12
+
+#Amount of similar revisions shown at once for revisions with a hub hash, which are similar to a crowd
+#of revisions
+SIMILAR_PAGE_SIZE = 20
+
 #Register module configurations
 config.register({
   'image_dealer': {
     'concession_period': 300,   #Images are reserved for every review author for 5 minutes
   },
+  'similarity_search': {
+    'time_budget': 0.5,         #Search similar images for half a second before rendering pages
+  },
 })
 
 #Error handler for this blueprint
@@ -136,14 +147,17 @@ def _render_user_review(image_title: str, user_name: str | None) -> str:
     render_params['author'] = user_name
     render_params['review_data'] = review_details.get_single(image_id, user_id)
 
-  #Get all similar images and add the results to the render parameters
-  render_params['similar_images'] = similar_images.search(image_id, 12)
+  #Get the similar images found within the time budget and add the results to the render parameters,
+  #along with the summary of the revisions with a hub hash, whose remaining similar images are
+  #requested on demand, and the cursor for requesting the similar images of the remaining revisions
+  render_params['similar_images'], render_params['similar_image_hubs'],\
+  render_params['similar_images_cursor'] = \
+    similar_images.search(image_id, SIMILAR_MAX_DIST, SIMILAR_PAGE_SIZE,
+                          time.monotonic() + config.root.similarity_search.time_budget)
 
   #Add links for reviewing similar images directly
   for ref_timestamp in render_params['similar_images']:
-    for title in render_params['similar_images'][ref_timestamp]:
-      render_params['similar_images'][ref_timestamp][title]['review_url'] = \
-        url_for('image_review.get', image_title = title)
+    _add_review_urls(render_params['similar_images'][ref_timestamp])
 
   #Write the concession so other users get other images during the concession period
   image_concessions.write(g.user_id, image_id)
@@ -155,6 +169,65 @@ def _render_user_review(image_title: str, user_name: str | None) -> str:
 
   return render_template('view/image_review.jinja.html', **render_params)
 
+#Route handler for getting more similar images of a revision with a hub hash
+@blueprint.get('/image_review/<image_title>/similar_images')
+@session_control.login_required()
+def get_similar_images(image_title: str) -> dict[str, any]:
+  #Read and validate request arguments
+  if 'revision' not in request.args:
+    abort(400, 'MISSING_FIELD,revision')
+
+  try:
+    offset = int(request.args.get('offset', 0))
+  except ValueError:
+    abort(400, 'INVALID_TYPE,offset')
+
+  if offset < 0:
+    abort(400, 'INVALID_VALUE,offset')
+
+  image_id = images.read_id(image_title)
+  if image_id is None: abort(404)
+
+  matches, more_results = similar_images.search_page(image_id, request.args['revision'],
+                                                     SIMILAR_MAX_DIST, SIMILAR_PAGE_SIZE, offset)
+  _add_review_urls(matches)
+
+  return {
+    'similar_images': matches,
+    'offset': offset + sum(len(match['revisions']) for match in matches.values()),
+    'more_results': more_results,
+  }
+
+#Route handler for continuing a search for similar images interrupted by its time budget
+@blueprint.get('/image_review/<image_title>/similar_images/remaining')
+@session_control.login_required()
+def get_remaining_similar_images(image_title: str) -> dict[str, any]:
+  #Read and validate request arguments
+  if 'cursor' not in request.args:
+    abort(400, 'MISSING_FIELD,cursor')
+
+  image_id = images.read_id(image_title)
+  if image_id is None: abort(404)
+
+  matches, hubs, cursor = \
+    similar_images.search(image_id, SIMILAR_MAX_DIST, SIMILAR_PAGE_SIZE,
+                          time.monotonic() + config.root.similarity_search.time_budget,
+                          request.args['cursor'])
+
+  for ref_timestamp in matches:
+    _add_review_urls(matches[ref_timestamp])
+
+  return {
+    'similar_images': matches,
+    'similar_image_hubs': hubs,
+    'cursor': cursor,
+  }
+
+#Add links for reviewing similar images directly to the matching images of a reference revision
+def _add_review_urls(matches: dict[str, dict[str, any]]) -> None:
+  for title in matches:
+    matches[title]['review_url'] = url_for('image_review.get', image_title = title)
+
 #Make sure the category paremeter is valid and convert it to an Enum value or abort the request
 def _validate_category() -> review_candidates.Category:
   if 'category' not in request.args:
@@ -1,18 +1,5 @@
 from collections.abc import Iterator
-from urllib.parse import urlencode
-from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
-from modules.common import config
-from modules.mediawiki import config as mw_config
-
-#Perform initialization based on configuration
-@config.on_load
-def _on_load():
-  global _pool
-
-  #Create a connection pool based on the connection scheme
-  server = config.root.mediawiki_server.url
-  _pool = HTTPConnectionPool(server.hostname, server.port) if server.scheme == 'http' else\
-          HTTPSConnectionPool(server.hostname, server.port)
+from modules.mediawiki import transport
 
 #Create a generator object that performs continued queries to a mediawiki server
 #Parameters:
@@ -23,8 +10,7 @@ def query(params: dict[str, str]) -> Iterator[dict]:
 
   while True:
     #Perform the request and get the response
-    server = config.root.mediawiki_server.url
-    rsp = _pool.urlopen('GET', f'{server.path}?{urlencode(params)}')
+    rsp = transport.request('GET', params)
 
     #Make sure the response is 200 - OK
     if rsp.status != 200:
@@ -34,18 +20,10 @@ def query(params: dict[str, str]) -> Iterator[dict]:
     rsp_data = rsp.json()
     yield rsp_data
 
-    #Check whether there's a continue element in the structure
+    #Check whether there's a continue element in the structure, then add all of its values to the
+    #request (there may be more than one continuation parameter when using generators)
     if 'continue' in rsp_data:
-      #The continuation parameter is any element that isn't called 'continue'
-      continue_param = None
-      for key in rsp_data['continue']:
-        if key != 'continue':
-          continue_param = key
-          break
-
-      #Add the continue parameter value to the request, if present
-      if continue_param is not None:
-        params[continue_param] = rsp_data['continue'][continue_param]
-        continue
+      params.update(rsp_data['continue'])
+      continue
 
-    break   #No continuation or continue response not structured as expected
+    break   #No continuation
@@ -12,10 +12,8 @@
 #+-------------------------------------------------------------------------------------------------+
 
 from flask import Blueprint, url_for, request, make_response
-from urllib.parse import urlencode
-from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
 from modules.common import config
-from modules.mediawiki import config as mw_config
+from modules.mediawiki import transport
 
 #Register module configurations
 config.register({
@@ -31,13 +29,7 @@ blueprint = Blueprint('cors_proxy', __name__, url_prefix = '/cors_proxy')
 @config.on_load
 def _on_load():
   if config.root.mediawiki_server.cors_proxy:
-    #CORS proxy is enabled. Create a connection pool based on the connection scheme.
-    global _pool
-    server = config.root.mediawiki_server.url
-    _pool = HTTPConnectionPool(server.hostname, server.port) if server.scheme == 'http' else\
-            HTTPSConnectionPool(server.hostname, server.port)
-
-    #Add the route handler and set the frontend API configuration to that
+    #CORS proxy is enabled. Add the route handler and set the frontend API configuration to that
     blueprint.get('/api')(get)
     config.root.mediawiki_server.frontend_api = lambda: url_for('cors_proxy.get')
   else:
@@ -46,9 +38,10 @@ def _on_load():
 
 #When enabled this function handles @blueprint.get('/api')
 def get():
-  #Make the request to the mediawiki server on behalf of the client and relay the query parameters
-  server = config.root.mediawiki_server.url
-  mw_resp = _pool.urlopen('GET', f'{server.path}?{urlencode(request.args)}')
+  #Make the request to the mediawiki server on behalf of the client and relay the query parameters,
+  #leaving the maxlag parameter and retries up to the client. Retrying here would hold the web
+  #worker for too long.
+  mw_resp = transport.request('GET', request.args, maxlag = False, max_retries = 0)
 
   #Create a response for the client and relay the response data and status code
   resp = make_response(mw_resp.data)
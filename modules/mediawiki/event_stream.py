@@ -0,0 +1,130 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The event stream module consumes a server-sent events (SSE) stream, such as the recentchange    |
+#| stream of the Wikimedia EventStreams service, and provides its events as they arrive.           |
+#|                                                                                                 |
+#| The connection is reestablished automatically when lost, waiting for the delay requested by the |
+#| server (or the configured one) and backing off exponentially while it keeps failing. The id of  |
+#| the last received event is sent when reconnecting, so the stream resumes where it was left.     |
+#+-------------------------------------------------------------------------------------------------+
+
+import json, sys
+from collections.abc import Iterator
+from time import sleep
+from urllib.parse import urlparse
+import urllib3
+from urllib3 import Timeout
+from urllib3.exceptions import HTTPError
+from modules.common import config
+
+#Register module configurations
+config.register({
+  'event_stream': {
+    'url': '',                #Default: No event stream
+    'reconnect_delay': 3,     #Default: Reconnect after 3 seconds
+    'read_timeout': 60,       #Default: Reconnect if nothing is received for 60 seconds
+  },
+})
+
+#Maximum delay between reconnection attempts in seconds
+RECONNECT_DELAY_MAX = 300
+
+#Perform initialization based on configuration
+@config.on_load
+def _on_load():
+  #Validate the stream URL, if provided
+  url = config.root.event_stream.url
+  if url:
+    parsed_url = urlparse(url)
+    if parsed_url.scheme not in ('http', 'https') or parsed_url.hostname is None:
+      raise ValueError(f'Invalid URL for configuration event_stream.url: {url}')
+
+#Check whether an event stream has been configured
+def enabled() -> bool:
+  return config.root.event_stream.url != ''
+
+#Create an iterator object that connects to the configured event stream and returns its message
+#events as they arrive, reconnecting whenever the connection is lost. It never ends by itself.
+#Parameters:
+# - last_event_id: The id of the last event processed previously (if any), so the stream resumes
+#   right after it.
+#Return value: Tuples with the event id (None if not provided) and the event data parsed as JSON.
+def events(last_event_id: str | None = None) -> Iterator[tuple[str | None, any]]:
+  pool = urllib3.PoolManager(timeout = Timeout(connect = 10,
+                                               read = config.root.event_stream.read_timeout),
+                             retries = False)
+  reconnect_delay = config.root.event_stream.reconnect_delay
+  failures = 0
+
+  while True:
+    headers = { 'Accept': 'text/event-stream', 'Cache-Control': 'no-cache' }
+    if last_event_id is not None:
+      headers['Last-Event-ID'] = last_event_id
+
+    try:
+      rsp = pool.request('GET', config.root.event_stream.url, headers = headers,
+                         preload_content = False)
+      try:
+        if rsp.status != 200:
+          raise HTTPError(f'Error code {rsp.status} - {rsp.reason}')
+
+        for field_values in _read_events(rsp):
+          #Every block of fields ending with a blank line is an event. The retry field changes the
+          #reconnection delay, and the id field persists for the next events if not provided again.
+          if 'retry' in field_values and field_values['retry'].isdigit():
+            reconnect_delay = int(field_values['retry']) / 1000
+          if 'id' in field_values:
+            last_event_id = field_values['id']
+
+          if field_values.get('event', 'message') != 'message' or 'data' not in field_values:
+            continue
+
+          try:
+            data = json.loads(field_values['data'])
+          except json.JSONDecodeError:
+            print(f'Invalid event stream data: {field_values['data'][:100]}', file = sys.stderr)
+            continue
+
+          failures = 0
+          yield last_event_id, data
+      finally:
+        rsp.release_conn()
+
+      print('Event stream closed by the server', file = sys.stderr)
+    except HTTPError as e:
+      failures += 1
+      print(f'Event stream connection failed: {e}', file = sys.stderr)
+
+    #Wait before reconnecting, doubling the delay while the connection keeps failing
+    sleep(min(RECONNECT_DELAY_MAX, reconnect_delay * 2 ** max(failures - 1, 0)))
+
+#Read the events of an event stream response, returning the fields of each one as a dictionary.
+#Comments (such as heartbeats) are ignored, while multiple data fields are joined by line breaks.
+def _read_events(rsp: urllib3.BaseHTTPResponse) -> Iterator[dict[str, str]]:
+  field_values = {}
+  for line in _read_lines(rsp):
+    if line == '':
+      #A blank line dispatches the event
+      if field_values:
+        yield field_values
+        field_values = {}
+      continue
+    elif line.startswith(':'):
+      continue
+
+    field, _, value = line.partition(':')
+    if value.startswith(' '):
+      value = value[1:]
+
+    if field == 'data' and 'data' in field_values:
+      field_values['data'] += '\n' + value
+    else:
+      field_values[field] = value
+
+#Read the lines of a streamed response as soon as they are received, without their line endings
+def _read_lines(rsp: urllib3.BaseHTTPResponse) -> Iterator[str]:
+  buffer = b''
+  while chunk := rsp.read1(65536):
+    buffer += chunk
+    *lines, buffer = buffer.split(b'\n')
+    for line in lines:
+      yield line.rstrip(b'\r').decode('utf-8', errors = 'replace')
@@ -0,0 +1,183 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The transport module provides a single HTTP connection pool to the mediawiki server API that is |
+#| shared by all the modules that communicate with it (the API client, the bot API client and the  |
+#| CORS proxy).                                                                                    |
+#|                                                                                                 |
+#| Responses are requested with gzip/deflate compression and decoded transparently. Requests that  |
+#| fail with server errors (5xx), rate limiting (429) or a replication lag error (maxlag) are      |
+#| retried after waiting for the time given by the Retry-After header, or otherwise an exponential |
+#| backoff with random jitter. Requests that are not idempotent (like logins and edits) are only   |
+#| retried when the server can't have processed them: connection failures, rate limiting and       |
+#| replication lag errors. Counters for requests, retries, latency and transferred bytes are kept  |
+#| for monitoring purposes.                                                                        |
+#+-------------------------------------------------------------------------------------------------+
+
+import random, sys
+from time import monotonic, sleep
+from urllib.parse import urlencode, urlparse
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool, BaseHTTPResponse, Timeout
+from urllib3.exceptions import HTTPError, ConnectTimeoutError
+from urllib3.util import make_headers
+from modules.common import config
+
+#Register module configurations
+config.register({
+  'mediawiki_server': {
+    'api': str,
+    'pool_size': 4,         #Default: Keep up to 4 connections open
+    'connect_timeout': 10,  #Default: 10 seconds
+    'read_timeout': 60,     #Default: 60 seconds
+    'max_retries': 5,       #Default: Retry failed requests up to 5 times
+    'maxlag': 5,            #Default: Back off if the database replication lag exceeds 5 seconds
+  },
+})
+
+#HTTP status codes of responses that are retried
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+#HTTP status codes of responses that are retried for requests that are not idempotent, as the server
+#rejects them without processing the request
+RETRY_STATUS_CODES_NON_IDEMPOTENT = (429,)
+
+#Limits of the exponential backoff, in seconds
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+#Request counters
+_stats = {
+  'requests': 0,        #Amount of requests performed, including retries
+  'retries': 0,         #Amount of retried requests
+  'bytes_received': 0,  #Amount of response bytes received (compressed)
+  'bytes_decoded': 0,   #Amount of response bytes after decompression
+  'latency_total': 0.0, #Sum of the latency of all requests in seconds
+  'latency_max': 0.0,   #Maximum latency of a single request in seconds
+}
+
+#Perform initialization based on configuration
+@config.on_load
+def _on_load():
+  global _pool
+
+  #Parse and validate the API URL
+  url = urlparse(config.root.mediawiki_server.api)
+  if url.scheme not in ('http', 'https') or url.hostname is None or url.path == '':
+    raise ValueError(f'Invalid URL for configuration mediawiki_server.api: '
+                     f'{config.root.mediawiki_server.api}')
+
+  #Append the parsed URL to the configuration
+  config.root.mediawiki_server.url = url
+
+  #Create a connection pool based on the connection scheme
+  server = config.root.mediawiki_server.url
+  pool_class = HTTPConnectionPool if server.scheme == 'http' else HTTPSConnectionPool
+  _pool = pool_class(server.hostname, server.port,
+                     maxsize = config.root.mediawiki_server.pool_size,
+                     timeout = Timeout(connect = config.root.mediawiki_server.connect_timeout,
+                                       read = config.root.mediawiki_server.read_timeout),
+                     retries = False)
+
+#Perform a request to the mediawiki server API, retrying it if needed
+#Parameters:
+# - method: The HTTP method ('GET' or 'POST').
+# - params: The query parameters, which are encoded in the request URL for GET requests or the
+#   request body for POST requests.
+# - headers: Optional additional request headers.
+# - maxlag: Whether to add the configured maxlag parameter to the request. Disable it for requests
+#   on behalf of other clients.
+# - idempotent: Whether the request can be repeated safely after the server may have processed it.
+#   By default, only GET requests are considered idempotent.
+# - max_retries: The maximum amount of retries, or None to use the configured one. Disable retries
+#   for requests that must be answered quickly, so the response of the server is returned as is.
+#Return value: The response of the last attempt, with its content already decoded.
+def request(method: str, params: dict[str, str], headers: dict[str, str] | None = None,
+            maxlag: bool = True, idempotent: bool | None = None,
+            max_retries: int | None = None) -> BaseHTTPResponse:
+  if maxlag and config.root.mediawiki_server.maxlag > 0:
+    params = { **params, 'maxlag': config.root.mediawiki_server.maxlag }
+
+  #Always accept compressed responses
+  headers = { **make_headers(accept_encoding = True), **(headers or {}) }
+
+  match method:
+    case 'GET':
+      #Request parameters go in the url for GET requests
+      url = f'{config.root.mediawiki_server.url.path}?{urlencode(params)}'
+      body = None
+    case 'POST':
+      #Request parameters go in the body for POST requests
+      url = config.root.mediawiki_server.url.path
+      body = urlencode(params)
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    case _:
+      raise ValueError('Invalid HTTP method')
+
+  #Requests that are not idempotent are only retried when the server can't have processed them
+  if idempotent is None:
+    idempotent = method == 'GET'
+  retry_status_codes = RETRY_STATUS_CODES if idempotent else RETRY_STATUS_CODES_NON_IDEMPOTENT
+
+  if max_retries is None:
+    max_retries = config.root.mediawiki_server.max_retries
+
+  attempt = 0
+  while True:
+    #Perform the request while measuring its latency
+    _stats['requests'] += 1
+    start_time = monotonic()
+    try:
+      rsp = _pool.urlopen(method, url, body, headers)
+    except HTTPError as e:
+      #Connection errors and timeouts are retried as well, until attempts run out. Errors after the
+      #connection is established are only retried for idempotent requests, as the request might
+      #have been received already.
+      _update_latency(monotonic() - start_time)
+      if attempt >= max_retries or\
+         not (idempotent or isinstance(e, ConnectTimeoutError)):
+        raise
+
+      retry_reason = type(e).__name__
+      retry_delay = None
+    else:
+      _update_latency(monotonic() - start_time)
+      _stats['bytes_received'] += rsp.tell()
+      _stats['bytes_decoded'] += len(rsp.data)
+
+      #Determine whether the response should be retried
+      if rsp.status in retry_status_codes:
+        retry_reason = f'Error code {rsp.status} - {rsp.reason}'
+      elif rsp.headers.get('MediaWiki-API-Error') == 'maxlag':
+        retry_reason = 'Replication lag'
+      else:
+        return rsp
+
+      if attempt >= max_retries:
+        return rsp
+
+      retry_delay = _parse_retry_after(rsp.headers.get('Retry-After'))
+
+    #Wait before retrying, using exponential backoff with full jitter if the server didn't specify
+    #a delay
+    if retry_delay is None:
+      retry_delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    print(f'{retry_reason}, retrying in {retry_delay:.1f}s', file = sys.stderr)
+    sleep(retry_delay)
+
+    attempt += 1
+    _stats['retries'] += 1
+
+#Get a copy of the request counters
+def stats() -> dict[str, int | float]:
+  return dict(_stats)
+
+#Update the latency counters with the latency of a request
+def _update_latency(latency: float) -> None:
+  _stats['latency_total'] += latency
+  _stats['latency_max'] = max(_stats['latency_max'], latency)
+
+#Parse the value of a Retry-After header given in seconds, limiting it to the maximum backoff
+def _parse_retry_after(value: str | None) -> float | None:
+  try:
+    return min(float(value), BACKOFF_MAX)
+  except (TypeError, ValueError):
+    return None
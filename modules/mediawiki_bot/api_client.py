@@ -1,23 +1,10 @@
-from urllib.parse import urlencode
-from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
-from modules.common import config
-from modules.mediawiki import config as mw_config
+from modules.mediawiki import transport
 
 #Note: The cookie model implemented here is extremely simplistic. The 'Set-Cookie' header is simply
 #translated from the server response to the 'Cookie' header in the next request. This model is
 #enough for current bot functionality but might need to be expanded to use something like
 #http.cookiejar in case of adding more features in the future.
 
-#Perform initialization based on configuration
-@config.on_load
-def _on_load():
-  global _pool
-
-  #Create a connection pool based on the connection scheme
-  server = config.root.mediawiki_server.url
-  _pool = HTTPConnectionPool(server.hostname, server.port) if server.scheme == 'http' else\
-          HTTPSConnectionPool(server.hostname, server.port)
-
 #Perform a server query and get parsed JSON data and cookies
 #Parameters:
 # - method: The HTTP method ('GET' or 'POST')
@@ -30,25 +17,12 @@ def _query(method: str, params: dict[str, str],
            cookies: str | None = None) -> tuple[dict[str, any], str | None]:
   params['format'] = 'json'   #Make sure to request json format
 
-  match method:
-    case 'GET':
-      #Request parameters go in the url for GET requests
-      server_url = f'{config.root.mediawiki_server.url.path}?{urlencode(params)}'
-      body = None
-      headers = {}
-    case 'POST':
-      #Request parameters go in the body for POST requests
-      server_url = config.root.mediawiki_server.url.path
-      body = urlencode(params)
-      headers = { 'Content-Type': 'application/x-www-form-urlencoded' }
-    case _:
-      raise ValueError('Invalid HTTP method')
-
+  headers = {}
   if cookies is not None:
     headers['Cookie'] = cookies
 
   #Perform the request now
-  rsp = _pool.urlopen(method, server_url, body, headers)
+  rsp = transport.request(method, params, headers)
 
   #Make sure the response is 200 - OK
   if rsp.status != 200:
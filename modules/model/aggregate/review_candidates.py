@@ -1,7 +1,11 @@
 from time import time
 from modules.model import db
 from modules.model.table import image_concessions
-from modules.model.view.unreviewed_images import Category
+from modules.model.view.unreviewed_images import Category, QUEUE_KEYS
+
+#Maximum amount of times a user tries to claim a candidate that other users keep claiming first
+#before getting an image regardless of concessions
+CLAIM_ATTEMPTS = 10
 
 #Acquire the next image available from a specified usage category on behalf of a specified user
 #Parameters:
@@ -14,43 +18,54 @@ def acquire_next(user_id: int, concession_period: int, category: Category,
                  prev_title: str | None) -> str | None:
   #Calculate the time of the oldest concession that will be observed
   time_threshold = int(time()) - concession_period
+  con = db.get()
 
-  with db.get() as con:
-    #This operation could be perturbed by other acquirements, as the image concessions table is
-    #modified after reading from many tables, including it. Make sure this doesn't happen.
-    con.execute('BEGIN EXCLUSIVE')
+  #Find the position of the continuation point in the queue of the category, if it's still there
+  condition, key = QUEUE_KEYS[category]
+  position = con.execute(
+    f'SELECT {key}, image_id FROM review_queue '
+    f'WHERE image_id = (SELECT id FROM images WHERE title = ?) AND {condition}',
+    (prev_title,)).fetchone()
 
-    #Perform the candidate search now. The filter conditions are as follows:
-    # - The image image must be after the continuation point (higher row number)
-    # - The image has not been recently conceded to another user
+  #Candidates are searched without locking the database, then claimed with a conditional write. If
+  #another user claims the same candidate in between, the claim fails and the next search skips it.
+  #The filter conditions are as follows:
+  # - The image must be after the continuation point, if any
+  # - The image has not been recently conceded to another user
+  after = '' if position is None else f'AND ({key}, image_id) > (?, ?) '
+  for _ in range(CLAIM_ATTEMPTS):
     row = con.execute(
-      f'SELECT image_title, image_id FROM {category.value} '
-      f'WHERE row_num > COALESCE('
-        f'(SELECT row_num FROM {category.value} WHERE image_title = ?), 0) '
-      f'AND image_id NOT IN '
+      f'SELECT images.title, review_queue.image_id FROM review_queue '
+      f'INNER JOIN images ON images.id = review_queue.image_id '
+      f'WHERE {condition} {after}AND image_id NOT IN '
         f'(SELECT image_id FROM image_concessions WHERE user_id <> ? AND timestamp > ?) '
-      f'ORDER BY row_num ASC LIMIT 1', (prev_title, user_id, time_threshold)).fetchone()
+      f'ORDER BY {key}, image_id LIMIT 1', (*(position or ()), user_id, time_threshold)).fetchone()
 
     if row is None:
-      #If the candidate search did not return any result (the pool is shallow), retry ignoring
-      #previous concessions so that the last images are forced to appear, even if conceded to
-      #another user
-      row = con.execute(
-        f'SELECT image_title, image_id FROM {category.value} '
-        f'WHERE row_num > COALESCE('
-          f'(SELECT row_num FROM {category.value} WHERE image_title = ?), 0) '
-        f'ORDER BY row_num ASC LIMIT 1', (prev_title,)).fetchone()
-
-      #If available images run out right before a user requests the next one, this last search may
-      #not return anything. In that case restarting the dealing process (requesting an image with no
-      #previous title) will always return the last unreviewed images, regardless of concession
-      #status.
-
-      if row is None: return None   #No image candidate is found
+      break
 
     next_image_title, next_image_id = row
+    if image_concessions.claim(user_id, next_image_id, time_threshold):
+      return next_image_title
+
+  #If the candidate search did not return any result (the pool is shallow) or other users kept
+  #claiming the candidates first, retry ignoring previous concessions so that the last images are
+  #forced to appear, even if conceded to another user
+  row = con.execute(
+    f'SELECT images.title, review_queue.image_id FROM review_queue '
+    f'INNER JOIN images ON images.id = review_queue.image_id '
+    f'WHERE {condition} {after}'
+    f'ORDER BY {key}, image_id LIMIT 1', position or ()).fetchone()
+
+  #If available images run out right before a user requests the next one, this last search may not
+  #return anything. In that case restarting the dealing process (requesting an image with no
+  #previous title) will always return the last unreviewed images, regardless of concession status.
+
+  if row is None: return None   #No image candidate is found
+
+  next_image_title, next_image_id = row
 
-    #Write the concession so other users get other images during the concession period
-    image_concessions.write(user_id, next_image_id)
+  #Write the concession so other users get other images during the concession period
+  image_concessions.write(user_id, next_image_id)
 
-    return next_image_title
+  return next_image_title
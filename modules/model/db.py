@@ -47,14 +47,22 @@ def load_extension(ext_name: str) -> None:
   if extensions is None:
     extensions = g._database_extensions = []
 
-  #Load the extension if it's not in the list yet
+  _load_extension(get(), extensions, ext_name)
+
+#Load a sqlite3 extension into a connection unless it's in the list of loaded extensions, then add
+#it to the list
+def _load_extension(con: sqlite3.Connection, extensions: list[str], ext_name: str) -> None:
   if ext_name not in extensions:
-    con = get()
     con.enable_load_extension(True)
     con.load_extension(f'sqlite_extensions/{ext_name}.so')
     con.enable_load_extension(False)
     extensions.append(ext_name)
 
+#Check whether a table (including virtual tables) exists in the database
+def table_exists(name: str) -> bool:
+  return get().execute(
+    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
 _schema_functions = []  #List of schema initialization functions
 
 #Function decorator for registering schema initialization functions
@@ -70,12 +78,16 @@ def initialize_schema() -> None:
 #Reconfigure this module to operate outside of flask, preserving its API
 def go_without_flask() -> None:
   global _con
+  global _extensions
   global get
   global close
+  global load_extension
 
   _con = _new_conection()       #Keep connection at module level, instead of application context
+  _extensions = []              #Keep extension name list at module level too
   get = lambda: _con            #Override get()
   close = lambda: _con.close()  #Override close()
+  load_extension = lambda ext_name: _load_extension(_con, _extensions, ext_name)  #Same
 
 #Open a direct connection to the database independently of any request context (the caller is
 #responsible for calling the close method on the connnection once finished)
@@ -0,0 +1,130 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The block scan engine stores copies of the image hashes packed in blocks of up to 4096 hashes,  |
+#| one block per row of the hash_blocks table, along with a parallel block of revision ids. A      |
+#| search calls the hammscan function of the hammdist extension once per block, which compares the |
+#| query hash with every hash in the block using vector instructions where available, so a full    |
+#| scan of a million hashes only has to step through a few hundred rows.                           |
+#|                                                                                                 |
+#| Blocks are appended to by the image update script, which creates their table the first time,    |
+#| and rebuilt if hashes are deleted. Hashes added after the last update are searched in the       |
+#| hashes table, so results are always current.                                                    |
+#+-------------------------------------------------------------------------------------------------+
+
+from array import array
+from modules.model import db
+from modules.model.table import hashes
+
+#Maximum amount of hashes per block
+BLOCK_SIZE = 4096
+
+#Get all image hashes that are within a maximum hamming distance from a given reference hash
+def search(ref_hash: int, max_dist: int) -> list[int]:
+  if not db.table_exists('hash_blocks'):
+    return hashes.search(ref_hash, max_dist)
+
+  db.load_extension('hammdist')
+  con = db.get()
+
+  #Scan every block, getting the revision ids of the matching hashes directly
+  cursor = con.execute(
+    'SELECT hammscan(hashes, ?, ?, revision_ids), last_id FROM hash_blocks',
+    (ref_hash, max_dist))
+
+  result = []
+  last_id = 0
+  for revision_ids, block_last_id in cursor:
+    if revision_ids is not None:
+      result.extend(array('i', revision_ids))
+    last_id = max(last_id, block_last_id)
+
+  #Search the hashes that are newer than the blocks in the database
+  return result + hashes.search(ref_hash, max_dist, after_id = last_id)
+
+#Get all image hashes that are within a maximum hamming distance from each of a group of reference
+#hashes, returning a list of revision ids for every reference hash
+def search_many(ref_hashes: list[int], max_dist: int) -> list[list[int]]:
+  if not db.table_exists('hash_blocks'):
+    return hashes.search_many(ref_hashes, max_dist)
+
+  db.load_extension('hammdist')
+  con = db.get()
+
+  #Scan every block once for all the reference hashes, which are packed like the hashes of a block.
+  #The result of every block holds pairs of reference hash index and revision id.
+  cursor = con.execute(
+    'SELECT hammscan(hashes, ?, ?, revision_ids), last_id FROM hash_blocks',
+    (array('q', ref_hashes).tobytes(), max_dist))
+
+  result = [[] for _ in ref_hashes]
+  last_id = 0
+  for pairs, block_last_id in cursor:
+    if pairs is not None:
+      pairs = array('i', pairs)
+      for index, revision_id in zip(pairs[::2], pairs[1::2]):
+        result[index].append(revision_id)
+    last_id = max(last_id, block_last_id)
+
+  #Search the hashes that are newer than the blocks in the database
+  new_matches = hashes.search_many(ref_hashes, max_dist, after_id = last_id)
+
+  return [ref_result + ref_new_matches for ref_result, ref_new_matches in zip(result, new_matches)]
+
+#Bring the blocks up to date with the hashes table
+def refresh() -> None:
+  with db.get() as con:
+    #Hashes are packed as 64-bit integers and revision ids as 32-bit integers, in native byte order.
+    #The last hash id and revision id sum of the hashes of every block are used to detect changes.
+    con.execute(
+      'CREATE TABLE IF NOT EXISTS hash_blocks('
+        'id INTEGER PRIMARY KEY, '
+        'count INTEGER NOT NULL, '
+        'last_id INTEGER NOT NULL, '
+        'revision_id_sum INTEGER NOT NULL, '
+        'hashes BLOB NOT NULL, '
+        'revision_ids BLOB NOT NULL)')
+
+    last_id, count, revision_id_sum = con.execute(
+      'SELECT IFNULL(MAX(last_id), 0), IFNULL(SUM(count), 0), IFNULL(SUM(revision_id_sum), 0) '
+      'FROM hash_blocks').fetchone()
+
+    #Make sure the hashes in the blocks are still the same in the database. Hashes are never
+    #modified, so only deletions have to be detected, in which case all blocks are created again.
+    if hashes.read_summary(last_id) != (count, revision_id_sum):
+      con.execute('DELETE FROM hash_blocks')
+      last_id = 0
+      print('Hash blocks: Rebuilding')
+
+    rows = list(hashes.read_hashes(last_id))
+    if not rows:
+      return
+
+    #Continue filling the last block if it isn't full
+    block = con.execute(
+      'SELECT id, hashes, revision_ids, revision_id_sum FROM hash_blocks '
+      'WHERE count < ? ORDER BY id DESC LIMIT 1', (BLOCK_SIZE,)).fetchone()
+    if block is not None:
+      block_id, block_hashes, block_revision_ids, block_revision_id_sum = block
+      block_hashes = array('q', block_hashes)
+      block_revision_ids = array('i', block_revision_ids)
+    else:
+      block_id, block_hashes, block_revision_ids, block_revision_id_sum = None, array('q'),\
+                                                                           array('i'), 0
+
+    for i, (hash_id, revision_id, hash_) in enumerate(rows):
+      block_hashes.append(hash_)
+      block_revision_ids.append(revision_id)
+      block_revision_id_sum += revision_id
+
+      #Store the block once full or when all rows are added
+      if len(block_hashes) == BLOCK_SIZE or i == len(rows) - 1:
+        con.execute(
+          'INSERT OR REPLACE INTO hash_blocks '
+          '(id, count, last_id, revision_id_sum, hashes, revision_ids) '
+          'VALUES (?, ?, ?, ?, ?, ?)',
+          (block_id, len(block_hashes), hash_id, block_revision_id_sum, block_hashes.tobytes(),
+           block_revision_ids.tobytes()))
+
+        block_id, block_hashes, block_revision_ids, block_revision_id_sum = None, array('q'),\
+                                                                             array('i'), 0
+
+  print(f'Hash blocks: {len(rows)} hashes added')
@@ -0,0 +1,191 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The duplicate clusters module groups images into clusters of near-duplicates: the connected     |
+#| components of the graph in which two images are linked if any of their revisions are similar.   |
+#| Clusters are ranked by the storage that deleting all but their largest image would reclaim.     |
+#|                                                                                                 |
+#| Components are found with a union-find structure over a similarity join of all the revisions.   |
+#| The join reads the precomputed similar pairs if available, otherwise it merges the revisions    |
+#| with identical reference hashes directly and searches every distinct reference hash with the    |
+#| configured search engine in batches. The cluster of every image is stored in a table, so the    |
+#| report is computed once by the image update script and read by the web application, while the   |
+#| titles, sizes, unused and review status of the images are always read when reporting.           |
+#+-------------------------------------------------------------------------------------------------+
+
+import json
+from datetime import datetime, timezone
+from modules.common import config
+from modules.model import db
+from modules.model.table import sync_state, hashes
+from modules.model.hash_index import engine, similar_pairs
+
+#Register module configurations
+config.register({
+  'similarity_search': {
+    'cluster_max_dist': 12, #Default: Same distance used by the review pages
+  },
+})
+
+#Amount of reference hashes searched at once
+BATCH_SIZE = 256
+
+#Schema initialization function
+@db.schema
+def init_schema() -> None:
+  con = db.get()
+
+  #The id of every cluster is the id of its first image
+  con.execute(
+    'CREATE TABLE IF NOT EXISTS duplicate_clusters('
+      'image_id INTEGER PRIMARY KEY REFERENCES images(id) ON DELETE CASCADE, '
+      'cluster_id INTEGER NOT NULL)')
+
+  con.execute(
+    'CREATE INDEX IF NOT EXISTS duplicate_clusters_cluster_id ON duplicate_clusters(cluster_id)')
+
+#Disjoint sets of elements, supporting the union of sets and finding the set of an element
+class _DisjointSets:
+  def __init__(self):
+    self.parents = {}
+    self.sizes = {}
+
+  #Find the representative element of the set of an element
+  def find(self, element: int) -> int:
+    parent = self.parents.setdefault(element, element)
+    while parent != element:
+      #Path halving: point every element visited to its grandparent
+      grandparent = self.parents[parent]
+      self.parents[element] = grandparent
+      element, parent = grandparent, self.parents[grandparent]
+    return element
+
+  #Join the sets of two elements, attaching the smaller set to the larger one
+  def union(self, element_a: int, element_b: int) -> None:
+    root_a = self.find(element_a)
+    root_b = self.find(element_b)
+    if root_a == root_b:
+      return
+
+    if self.sizes.get(root_a, 1) < self.sizes.get(root_b, 1):
+      root_a, root_b = root_b, root_a
+
+    self.parents[root_b] = root_a
+    self.sizes[root_a] = self.sizes.get(root_a, 1) + self.sizes.pop(root_b, 1)
+
+#Get the time and maximum distance of the last cluster computation
+#Return value: A dictionary with the 'timestamp' and 'max_dist' keys, or None if never computed.
+def get_info() -> dict[str, str | int] | None:
+  return sync_state.read('duplicate_clusters')
+
+#Compute the clusters of near-duplicate images within the configured maximum hamming distance, unless
+#the hashes haven't changed since they were computed for the same distance
+def update() -> None:
+  max_dist = config.root.similarity_search.cluster_max_dist
+  con = db.get()
+
+  hashes_key = hashes.read_key()
+
+  info = get_info()
+  if info is not None and info['max_dist'] == max_dist and info['hashes_key'] == hashes_key:
+    print('Duplicate clusters: Up to date')
+    return
+
+  image_ids = dict(con.execute('SELECT id, image_id FROM revisions'))
+  sets = _DisjointSets()
+
+  if similar_pairs.available(max_dist):
+    for revision_a, revision_b in con.execute(
+      'SELECT revision_a, revision_b FROM similar_pairs WHERE distance <= ?', (max_dist,)):
+      sets.union(image_ids[revision_a], image_ids[revision_b])
+  else:
+    #Get the reference hash of every revision, then merge the images that share a reference hash
+    first_image_ids = {}
+    for revision_id, ref_hash in con.execute(
+      'SELECT revision_id, hash FROM revision_hashes WHERE hash IS NOT NULL'):
+      image_id = image_ids.get(revision_id)
+      if image_id is not None:
+        sets.union(first_image_ids.setdefault(ref_hash, image_id), image_id)
+
+    #Search every distinct reference hash only once
+    ref_hashes = list(first_image_ids)
+    for start in range(0, len(ref_hashes), BATCH_SIZE):
+      batch = ref_hashes[start:start + BATCH_SIZE]
+      for ref_hash, match_revision_ids in zip(batch, engine.search_many(batch, max_dist)):
+        for match_revision_id in match_revision_ids:
+          #Search engines may lag behind deletions
+          if match_revision_id in image_ids:
+            sets.union(first_image_ids[ref_hash], image_ids[match_revision_id])
+
+  #Store the images of the clusters with more than one image, identifying every cluster by its first
+  #image
+  members = {}
+  for image_id in sets.parents:
+    members.setdefault(sets.find(image_id), []).append(image_id)
+
+  clusters = [cluster for cluster in members.values() if len(cluster) > 1]
+  rows = [(image_id, min(cluster)) for cluster in clusters for image_id in cluster]
+
+  with con:
+    con.execute('DELETE FROM duplicate_clusters')
+    con.executemany(
+      'INSERT INTO duplicate_clusters (image_id, cluster_id) VALUES (?, ?)', rows)
+
+  sync_state.write('duplicate_clusters', {
+    'timestamp': datetime.now(timezone.utc).isoformat(timespec = 'seconds'),
+    'max_dist': max_dist,
+    'hashes_key': hashes_key,
+  })
+
+  print(f'Duplicate clusters: {len(rows)} images in {len(clusters)} clusters')
+
+#Get a range of clusters, sorted by the storage that would be reclaimed by deleting every image of
+#the cluster except the largest one (considering all their revisions)
+#Return value: A tuple with the list of clusters and a flag indicating whether more clusters follow.
+#Every cluster is a dictionary with the following keys:
+# - 'reclaimable_size': The size of all the images of the cluster except the largest one.
+# - 'total_size': The size of all the images of the cluster.
+# - 'images': A list of dictionaries with the 'title', 'size', 'unused' and 'reviewed' keys for every
+#   image of the cluster, from largest to smallest.
+def get_range(limit: int, offset: int) -> tuple[list[dict[str, any]], bool]:
+  con = db.get()
+
+  #Deleted images leave their clusters, which are only listed while they have more than one image.
+  #One additional row is requested to confirm that more rows follow.
+  clusters = con.execute(
+    'SELECT cluster_id, SUM(image_size) - MAX(image_size), SUM(image_size) FROM '
+      '(SELECT duplicate_clusters.cluster_id, IFNULL(SUM(revisions.size), 0) AS image_size '
+      'FROM duplicate_clusters '
+      'INNER JOIN revisions ON duplicate_clusters.image_id = revisions.image_id '
+      'GROUP BY duplicate_clusters.image_id) '
+    'GROUP BY cluster_id HAVING COUNT(*) > 1 '
+    'ORDER BY 2 DESC, cluster_id LIMIT ? OFFSET ?', (limit + 1, offset)).fetchall()
+
+  more_results = len(clusters) > limit
+  clusters = clusters[:limit]
+
+  #Read the images of all the clusters in the range at once
+  cursor = con.execute(
+    'SELECT duplicate_clusters.cluster_id, images.title, IFNULL(SUM(revisions.size), 0), '
+    'EXISTS (SELECT 1 FROM unused_images WHERE unused_images.title = images.title), '
+    'EXISTS (SELECT 1 FROM image_reviews INNER JOIN users ON image_reviews.user_id = users.id '
+      'WHERE image_reviews.image_id = images.id) '
+    'FROM duplicate_clusters '
+    'INNER JOIN images ON duplicate_clusters.image_id = images.id '
+    'INNER JOIN revisions ON images.id = revisions.image_id '
+    'WHERE duplicate_clusters.cluster_id IN (SELECT value FROM json_each(?)) '
+    'GROUP BY images.id ORDER BY 3 DESC, images.title',
+    (json.dumps([cluster_id for cluster_id, _, _ in clusters]),))
+
+  images = {}
+  for cluster_id, title, size, unused, reviewed in cursor:
+    images.setdefault(cluster_id, []).append({
+      'title': title,
+      'size': size,
+      'unused': bool(unused),
+      'reviewed': bool(reviewed),
+    })
+
+  return [{
+    'reclaimable_size': reclaimable_size,
+    'total_size': total_size,
+    'images': images[cluster_id],
+  } for cluster_id, reclaimable_size, total_size in clusters], more_results
@@ -0,0 +1,113 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The engine module performs hamming distance searches on the image hashes with the search engine |
+#| selected by configuration. Every engine provides the same search function, which returns the    |
+#| revision id of every hash within a maximum distance of a reference hash. Engines may return a   |
+#| revision once for every rotation hash that matches, but the results of this module list each    |
+#| revision once. The available engines are:                                                       |
+#|  - full_scan: Compares the reference hash with every hash in the database.                      |
+#|  - multi_index: Uses an index on hash substrings to only compare a small set of candidates.     |
+#|  - packed_array: Compares the reference hash with a memory-mapped snapshot of every hash using  |
+#|    vectorized operations.                                                                       |
+#|  - metric_tree: Searches a BK-tree of the hashes, pruning branches that can't contain matches.  |
+#|  - virtual_table: Queries an indexed virtual table of the hashes provided by the extension.     |
+#|  - block_scan: Compares the reference hash with packed blocks of hashes using vector            |
+#|    instructions.                                                                                |
+#|  - sharded: Sends the reference hash to shard server processes that compare it with their part  |
+#|    of the hashes in parallel.                                                                   |
+#|                                                                                                 |
+#| Engines may also provide a search_many function that searches a group of reference hashes at    |
+#| once, sharing a single pass over the hashes. Otherwise, every reference hash is searched alone. |
+#| Likewise, engines may provide a search_nearest function that finds the k nearest revisions      |
+#| while pruning with the distance of the k-th one found so far. Otherwise, the search radius is   |
+#| widened step by step until k revisions are found, which stops early for crowded hashes.         |
+#|                                                                                                 |
+#| Engines that keep their own data structures also provide a refresh function, which is called    |
+#| by the image update script after changing the hashes.                                           |
+#+-------------------------------------------------------------------------------------------------+
+
+import heapq
+from types import ModuleType
+from modules.common import config
+from modules.model.table import hashes
+from modules.model.hash_index import multi_index, packed_array, metric_tree, virtual_table,\
+                                     block_scan, sharded
+
+#Register module configurations
+config.register({
+  'similarity_search': {
+    'engine': 'multi_index',  #Default: Multi-index hashing
+  },
+})
+
+#Modules of the available engines, by engine name
+_ENGINES: dict[str, ModuleType] = {
+  'full_scan': hashes,
+  'multi_index': multi_index,
+  'packed_array': packed_array,
+  'metric_tree': metric_tree,
+  'virtual_table': virtual_table,
+  'block_scan': block_scan,
+  'sharded': sharded,
+}
+
+#Perform initialization based on configuration
+@config.on_load
+def _on_load():
+  global _engine
+
+  #Validate the engine name and select its search function
+  engine = config.root.similarity_search.engine
+  if engine not in _ENGINES:
+    raise ValueError(f'Invalid value for configuration similarity_search.engine: {engine} '
+                     f'(expected one of: {', '.join(_ENGINES)})')
+
+  _engine = _ENGINES[engine]
+
+#Get all image hashes that are within a maximum hamming distance from a given reference hash
+#Return value: The ids of the revisions with any matching hash, each one listed once.
+def search(ref_hash: int, max_dist: int) -> list[int]:
+  return list(dict.fromkeys(_engine.search(ref_hash, max_dist)))
+
+#Get all image hashes that are within a maximum hamming distance from each of a group of reference
+#hashes
+#Parameters:
+# - ref_hashes: The reference hashes, which may be repeated (e.g. images uploaded again unchanged).
+# - max_dist: The maximum hamming distance.
+#Return value: A list with the ids of the revisions with any matching hash for every reference hash,
+#in the same order, each one listed once. Repeated reference hashes are only searched once and share
+#the same list.
+def search_many(ref_hashes: list[int], max_dist: int) -> list[list[int]]:
+  distinct_hashes = list(dict.fromkeys(ref_hashes))
+  if not distinct_hashes:
+    return []
+
+  if hasattr(_engine, 'search_many'):
+    distinct_results = _engine.search_many(distinct_hashes, max_dist)
+  else:
+    distinct_results = [_engine.search(ref_hash, max_dist) for ref_hash in distinct_hashes]
+
+  results_by_hash = { ref_hash: list(dict.fromkeys(revision_ids))
+                     for ref_hash, revision_ids in zip(distinct_hashes, distinct_results) }
+  return [results_by_hash[ref_hash] for ref_hash in ref_hashes]
+
+#Get the k revisions nearest to a reference hash within a maximum hamming distance
+#Return value: A list with the revision id and distance of up to k revisions, sorted by distance and
+#revision id. The distance of every revision is the one of its nearest hash.
+def search_nearest(ref_hash: int, max_dist: int, k: int) -> list[tuple[int, int]]:
+  if hasattr(_engine, 'search_nearest'):
+    return _engine.search_nearest(ref_hash, max_dist, k)
+
+  #Once k revisions are found within a radius, they include the k nearest ones
+  for radius in sorted({max_dist // 4, max_dist // 2, max_dist}):
+    revision_ids = set(_engine.search(ref_hash, radius))
+    if len(revision_ids) >= k or radius == max_dist:
+      break
+
+  distances = hashes.read_distances(ref_hash, revision_ids)
+  return heapq.nsmallest(k, ((revision_id, dist) for revision_id, dist in distances.items()),
+                         key = lambda match: (match[1], match[0]))
+
+#Update the data structures of the selected engine after the hashes have changed, if it has any
+def refresh() -> None:
+  if hasattr(_engine, 'refresh'):
+    _engine.refresh()
@@ -0,0 +1,78 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The fine hashes module re-ranks similarity search results with the optional fine hashes:        |
+#| 256-bit perceptual hashes calculated along with the 64-bit ones when enabled, which are packed  |
+#| next to them in a BLOB column. Searches run as a cascade: the 64-bit hashes select the          |
+#| candidates with the search engine, then the fine hashes of just those candidates are compared   |
+#| at once with vectorized NumPy operations, to drop the false positives and sort the rest by      |
+#| similarity.                                                                                     |
+#|                                                                                                 |
+#| Re-ranking only applies when the reference revision has a fine hash. Candidates without fine    |
+#| hashes (hashed before enabling them) can't be judged, so they're kept after the re-ranked ones. |
+#+-------------------------------------------------------------------------------------------------+
+
+import json
+import numpy as np
+from modules.common import config
+from modules.model import db
+
+#Register module configurations
+config.register({
+  'similarity_search': {
+    'fine_max_dist': 48,  #Default: Same fraction of the bits as a distance of 12 for 64-bit hashes
+  },
+})
+
+#Size of the fine hashes in bytes
+FINE_HASH_SIZE = 32
+
+#Get the fine hashes of the reference hashes of the revisions of an image
+#Parameters:
+# - image_id: The id of the image.
+# - ref_revisions: The timestamp and reference hash of every revision of the image.
+#Return value: A dictionary with the fine hash by revision timestamp. Revisions without a fine hash
+#are left out.
+def read_references(image_id: int, ref_revisions: list[tuple[str, int]]) -> dict[str, bytes]:
+  ref_revisions = set(ref_revisions)
+  cursor = db.get().execute(
+    'SELECT revisions.timestamp, revision_hashes.hash, revision_hashes.fine_hashes FROM revisions '
+    'INNER JOIN revision_hashes ON revisions.id = revision_hashes.revision_id '
+    'WHERE revisions.image_id = ? AND revision_hashes.fine_hashes IS NOT NULL', (image_id,))
+
+  #The fine hash of the reference hash comes first
+  return {timestamp: fine_hashes[:FINE_HASH_SIZE] for timestamp, hash_, fine_hashes in cursor
+          if (timestamp, hash_) in ref_revisions}
+
+#Filter and sort a group of matching revisions by the distance of their fine hashes to a reference
+#fine hash. The distance of every revision is the one of its nearest fine hash (one per rotation).
+#Return value: The ids of the revisions within the configured maximum distance, nearest first,
+#followed by the ones without fine hashes in their original order. Repeated ids are only kept once.
+def rerank(ref_fine_hash: bytes, match_revision_ids: list[int]) -> list[int]:
+  match_revision_ids = list(dict.fromkeys(match_revision_ids))
+  if not match_revision_ids:
+    return []
+
+  rows = db.get().execute(
+    'SELECT revision_id, fine_hashes FROM revision_hashes '
+    'WHERE revision_id IN (SELECT value FROM json_each(?)) AND fine_hashes IS NOT NULL',
+    (json.dumps(match_revision_ids),)).fetchall()
+
+  #Compare all the fine hashes with the reference one at once, repeating the revision id of every
+  #revision for each of its fine hashes
+  distances = {}
+  if rows:
+    fine_hashes = np.frombuffer(b''.join(fine_hashes for _, fine_hashes in rows),
+                                dtype = np.uint8).reshape(-1, FINE_HASH_SIZE)
+    ref_array = np.frombuffer(ref_fine_hash, dtype = np.uint8)
+    hash_distances = np.unpackbits(fine_hashes ^ ref_array, axis = 1).sum(axis = 1).tolist()
+    hash_revision_ids = [revision_id for revision_id, fine_hashes in rows
+                         for _ in range(len(fine_hashes) // FINE_HASH_SIZE)]
+
+    for revision_id, dist in zip(hash_revision_ids, hash_distances):
+      distances[revision_id] = min(dist, distances.get(revision_id, dist))
+
+  max_dist = config.root.similarity_search.fine_max_dist
+  reranked = sorted((revision_id for revision_id, dist in distances.items() if dist <= max_dist),
+                    key = lambda revision_id: (distances[revision_id], revision_id))
+
+  return reranked + [revision_id for revision_id in match_revision_ids
+                     if revision_id not in distances]
@@ -0,0 +1,110 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The hub hashes module keeps the reference hashes that are similar to a crowd of revisions, such |
+#| as the ones of blank scans, solid colors or placeholder icons, along with their neighbor count. |
+#| The review pages don't list every similar image of those revisions, which are mostly useless    |
+#| matches, but only the nearest ones along with the neighbor count, and the rest on demand.       |
+#|                                                                                                 |
+#| Neighbor counts are computed by the image update script for every distinct reference hash,      |
+#| either from the precomputed similar pairs if available or by searching with the configured      |
+#| search engine in batches, and only the hashes exceeding the threshold are stored. They are      |
+#| recomputed when the hashes change, while in between new revisions are not counted. Every        |
+#| computation gets a new version number, which is part of the key of cached search results.       |
+#+-------------------------------------------------------------------------------------------------+
+
+import json
+from collections import Counter
+from modules.common import config
+from modules.model import db
+from modules.model.table import sync_state, hashes
+from modules.model.hash_index import engine, similar_pairs
+
+#Register module configurations
+config.register({
+  'similarity_search': {
+    'hub_max_dist': 12,     #Default: Same distance used by the review pages
+    'hub_threshold': 200,   #Default: Hashes with more than 200 similar revisions are hubs
+  },
+})
+
+#Amount of reference hashes searched at once
+BATCH_SIZE = 256
+
+#Schema initialization function
+@db.schema
+def init_schema() -> None:
+  db.get().execute(
+    'CREATE TABLE IF NOT EXISTS hub_hashes('
+      'hash INTEGER PRIMARY KEY, '
+      'neighbor_count INTEGER NOT NULL)')
+
+#Get the neighbor counts of the hub hashes among a group of hashes, if they were computed for the
+#given maximum hamming distance
+#Return value: A dictionary with the neighbor count by hash, which only includes the hub hashes.
+def read_counts(ref_hashes: list[int], max_dist: int) -> dict[int, int]:
+  info = sync_state.read('hub_hashes')
+  if info is None or info['max_dist'] != max_dist or not ref_hashes:
+    return {}
+
+  return dict(db.get().execute(
+    'SELECT hash, neighbor_count FROM hub_hashes WHERE hash IN (SELECT value FROM json_each(?))',
+    (json.dumps(ref_hashes),)))
+
+#Get the version of the hub hashes, which changes every time they're computed
+def read_version() -> int:
+  info = sync_state.read('hub_hashes')
+  return 0 if info is None else info['version']
+
+#Count the revisions similar to every distinct reference hash within the configured maximum hamming
+#distance and store the hashes exceeding the threshold, unless the hashes haven't changed since they
+#were counted for the same distance and threshold
+def update() -> None:
+  max_dist = config.root.similarity_search.hub_max_dist
+  threshold = config.root.similarity_search.hub_threshold
+  con = db.get()
+
+  hashes_key = hashes.read_key()
+  info = sync_state.read('hub_hashes')
+  if info is not None and info['max_dist'] == max_dist and info['threshold'] == threshold and\
+     info['hashes_key'] == hashes_key:
+    print('Hub hashes: Up to date')
+    return
+
+  neighbor_counts = Counter()
+  if similar_pairs.available(max_dist):
+    #The pairs of a revision don't include the revision itself, which is a match of its own hash
+    for ref_hash, pair_count in con.execute(
+      'SELECT similar_pairs_revisions.hash, COUNT(similar_pairs.revision_b) '
+      'FROM similar_pairs_revisions LEFT JOIN similar_pairs '
+      'ON similar_pairs.revision_a = similar_pairs_revisions.revision_id AND '
+      'similar_pairs.distance <= ? '
+      'GROUP BY similar_pairs_revisions.revision_id', (max_dist,)):
+      neighbor_counts[ref_hash] = max(neighbor_counts[ref_hash], pair_count + 1)
+  else:
+    #Get the distinct reference hashes and count the distinct revisions matching each one
+    ref_hashes = list(dict.fromkeys(ref_hash for (ref_hash,) in con.execute(
+      'SELECT hash FROM revision_hashes WHERE hash IS NOT NULL')))
+
+    for start in range(0, len(ref_hashes), BATCH_SIZE):
+      batch = ref_hashes[start:start + BATCH_SIZE]
+      for ref_hash, match_revision_ids in zip(batch, engine.search_many(batch, max_dist)):
+        neighbor_counts[ref_hash] = len(set(match_revision_ids))
+
+  rows = { ref_hash: count for ref_hash, count in neighbor_counts.items() if count > threshold }
+
+  #The version only changes along with the stored hub hashes, so cached search results are kept
+  version = 0 if info is None else info['version']
+  if info is None or info['max_dist'] != max_dist or\
+     rows != dict(con.execute('SELECT hash, neighbor_count FROM hub_hashes')):
+    with con:
+      con.execute('DELETE FROM hub_hashes')
+      con.executemany('INSERT INTO hub_hashes (hash, neighbor_count) VALUES (?, ?)', rows.items())
+    version += 1
+
+  sync_state.write('hub_hashes', {
+    'max_dist': max_dist,
+    'threshold': threshold,
+    'hashes_key': hashes_key,
+    'version': version,
+  })
+
+  print(f'Hub hashes: {len(rows)} of {len(neighbor_counts)} reference hashes')
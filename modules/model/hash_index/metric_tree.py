@@ -0,0 +1,357 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The metric tree engine searches the image hashes using a BK-tree, in which every node holds a   |
+#| distinct hash and the revisions that have it, and its children are keyed by their hamming       |
+#| distance to it. Searches only descend into children whose distance range can contain matches,   |
+#| which prunes most of the tree when hashes are clustered (e.g. scans of the same document).      |
+#|                                                                                                 |
+#| The tree is built offline by the image update script and saved to a file, which every process   |
+#| loads lazily on its first search. Hashes created afterwards are inserted into the loaded tree   |
+#| before searching, and the tree is rebuilt in a background thread when those insertions make it  |
+#| too deep. The update script rebuilds the file when hashes are deleted or many have been added.  |
+#+-------------------------------------------------------------------------------------------------+
+
+import heapq, os, random, sqlite3, threading, zipfile
+import numpy as np
+from modules.common import config
+from modules.model import db
+from modules.model.table import hashes
+
+#Register module configurations
+config.register({
+  'similarity_search': {
+    'tree_file': 'hash_tree.npz', #Default: Tree file in the working directory
+  },
+})
+
+#Mask used to treat hashes as unsigned 64-bit integers
+HASH_MASK = (1 << 64) - 1
+
+#The tree file is rebuilt when the hashes added after building it exceed this fraction of the hashes
+#in it, while loaded trees are rebuilt when insertions make them deeper than this factor
+REBUILD_FRACTION = 0.25
+REBUILD_DEPTH_FACTOR = 1.5
+
+#Tree node layout: [hash, list of revision ids, dictionary of children by distance or None]
+_HASH = 0
+_REVISION_IDS = 1
+_CHILDREN = 2
+
+#BK-tree of hashes
+class _MetricTree:
+  def __init__(self):
+    self.root = None
+    self.node_count = 0
+    self.depth = 0            #Depth of the deepest node
+    self.built_depth = 0      #Depth right after building the tree
+    self.last_id = 0          #Id of the last hash inserted
+    self.revision_count = 0   #Amount of hashes (not distinct) in the tree
+    self.revision_id_sum = 0  #Sum of the revision ids of all hashes, used to detect deletions
+
+  #Build a tree from a group of hash rows (hash id, revision id, hash)
+  @classmethod
+  def build(cls, rows: list[tuple[int, int, int]]) -> '_MetricTree':
+    tree = cls()
+
+    #Group the revisions by hash, then insert every distinct hash in random order, which results in
+    #a reasonably balanced tree
+    revision_ids_by_hash = {}
+    for hash_id, revision_id, hash_ in rows:
+      revision_ids_by_hash.setdefault(hash_ & HASH_MASK, []).append(revision_id)
+      tree._count_row(hash_id, revision_id)
+
+    hash_list = list(revision_ids_by_hash)
+    random.shuffle(hash_list)
+    for hash_ in hash_list:
+      node = tree._insert_node(hash_)
+      node[_REVISION_IDS] = revision_ids_by_hash[hash_]
+
+    tree.built_depth = tree.depth
+    return tree
+
+  #Insert a hash row created after building the tree
+  def insert(self, hash_id: int, revision_id: int, hash_: int) -> None:
+    self._insert_node(hash_ & HASH_MASK)[_REVISION_IDS].append(revision_id)
+    self._count_row(hash_id, revision_id)
+
+  #Check whether insertions have made the tree much deeper than it was when built
+  def is_unbalanced(self) -> bool:
+    return self.depth > max(self.built_depth * REBUILD_DEPTH_FACTOR, self.built_depth + 2)
+
+  #Get the revision ids of all hashes within a maximum hamming distance from a reference hash
+  def search(self, ref_hash: int, max_dist: int) -> list[int]:
+    ref_hash &= HASH_MASK
+
+    result = []
+    pending_nodes = [self.root] if self.root is not None else []
+    while pending_nodes:
+      node = pending_nodes.pop()
+      dist = (node[_HASH] ^ ref_hash).bit_count()
+      if dist <= max_dist:
+        result.extend(node[_REVISION_IDS])
+
+      #By the triangle inequality, matches can only be found under children whose distance to this
+      #node differs from the reference distance by the maximum distance at most
+      children = node[_CHILDREN]
+      if children is not None:
+        for child_dist in range(max(dist - max_dist, 1), min(dist + max_dist, 64) + 1):
+          child = children.get(child_dist)
+          if child is not None:
+            pending_nodes.append(child)
+
+    return result
+
+  #Get the k revisions nearest to a reference hash within a maximum hamming distance, as a list of
+  #revision ids and distances sorted by distance and revision id
+  def search_nearest(self, ref_hash: int, max_dist: int, k: int) -> list[tuple[int, int]]:
+    ref_hash &= HASH_MASK
+
+    #The k nearest revisions found so far are kept in a heap with the farthest one on top, along with
+    #their distances (revisions may have hashes in several nodes). Once the heap is full, the search
+    #radius shrinks to the distance of the farthest one, since only nearer revisions can replace it.
+    heap = []
+    distances = {}
+    radius = max_dist
+    pending_nodes = [self.root] if self.root is not None and k > 0 else []
+    while pending_nodes:
+      node = pending_nodes.pop()
+      dist = (node[_HASH] ^ ref_hash).bit_count()
+      if dist <= radius:
+        for revision_id in node[_REVISION_IDS]:
+          known_dist = distances.get(revision_id)
+          if known_dist is not None:
+            #Revision already in the heap, update its distance if nearer
+            if dist < known_dist:
+              heap[heap.index((-known_dist, -revision_id))] = (-dist, -revision_id)
+              heapq.heapify(heap)
+              distances[revision_id] = dist
+          elif len(heap) < k:
+            heapq.heappush(heap, (-dist, -revision_id))
+            distances[revision_id] = dist
+          elif (-dist, -revision_id) > heap[0]:
+            _, evicted_revision_id = heapq.heapreplace(heap, (-dist, -revision_id))
+            del distances[-evicted_revision_id]
+            distances[revision_id] = dist
+
+        if len(heap) == k:
+          radius = -heap[0][0]
+
+      #Children are pushed farthest first, so the ones most likely to hold near hashes are searched
+      #first and shrink the radius sooner
+      children = node[_CHILDREN]
+      if children is not None:
+        child_dists = range(max(dist - radius, 1), min(dist + radius, 64) + 1)
+        for child_dist in sorted(child_dists, key = lambda child_dist: -abs(child_dist - dist)):
+          child = children.get(child_dist)
+          if child is not None:
+            pending_nodes.append(child)
+
+    return [(-negated_revision_id, -negated_dist)
+            for negated_dist, negated_revision_id in sorted(heap, reverse = True)]
+
+  #Find the node of a hash, creating it if it doesn't exist
+  def _insert_node(self, hash_: int) -> list:
+    if self.root is None:
+      self.root = [hash_, [], None]
+      self.node_count = 1
+      return self.root
+
+    node = self.root
+    depth = 0
+    while True:
+      dist = (node[_HASH] ^ hash_).bit_count()
+      if dist == 0:
+        return node
+
+      depth += 1
+      if node[_CHILDREN] is None:
+        node[_CHILDREN] = {}
+
+      child = node[_CHILDREN].get(dist)
+      if child is None:
+        child = node[_CHILDREN][dist] = [hash_, [], None]
+        self.node_count += 1
+        self.depth = max(self.depth, depth)
+        return child
+
+      node = child
+
+  #Account for a hash row inserted in the tree
+  def _count_row(self, hash_id: int, revision_id: int) -> None:
+    self.last_id = max(self.last_id, hash_id)
+    self.revision_count += 1
+    self.revision_id_sum += revision_id
+
+  #Save the tree to a file, flattened in breadth-first order so every parent precedes its children.
+  #The file is written at a temporary location and then replaces the previous one atomically.
+  def save(self, path: str) -> None:
+    hashes = []
+    parents = []
+    distances = []
+    revision_counts = []
+    revision_ids = []
+
+    pending_nodes = [(self.root, -1, 0)] if self.root is not None else []
+    for node, parent, dist in pending_nodes:
+      index = len(hashes)
+      hashes.append(node[_HASH])
+      parents.append(parent)
+      distances.append(dist)
+      revision_counts.append(len(node[_REVISION_IDS]))
+      revision_ids.extend(node[_REVISION_IDS])
+
+      if node[_CHILDREN] is not None:
+        pending_nodes.extend((child, index, child_dist)
+                             for child_dist, child in node[_CHILDREN].items())
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+      np.savez(f,
+               meta = np.array([self.last_id, self.revision_count, self.revision_id_sum,
+                                self.depth], dtype = np.int64),
+               hashes = np.array(hashes, dtype = np.uint64),
+               parents = np.array(parents, dtype = np.int32),
+               distances = np.array(distances, dtype = np.uint8),
+               revision_counts = np.array(revision_counts, dtype = np.int32),
+               revision_ids = np.array(revision_ids, dtype = np.int32))
+    os.replace(temp_path, path)
+
+  #Load a tree from a file
+  @classmethod
+  def load(cls, path: str) -> '_MetricTree':
+    tree = cls()
+
+    with np.load(path) as data:
+      tree.last_id, tree.revision_count, tree.revision_id_sum, tree.depth =\
+        (int(value) for value in data['meta'])
+      tree.built_depth = tree.depth
+
+      nodes = []
+      revision_ids = data['revision_ids'].tolist()
+      revision_offset = 0
+      for hash_, parent, dist, revision_count in zip(data['hashes'].tolist(),
+                                                     data['parents'].tolist(),
+                                                     data['distances'].tolist(),
+                                                     data['revision_counts'].tolist()):
+        node = [hash_, revision_ids[revision_offset:revision_offset + revision_count], None]
+        revision_offset += revision_count
+        nodes.append(node)
+
+        if parent < 0:
+          tree.root = node
+        else:
+          if nodes[parent][_CHILDREN] is None:
+            nodes[parent][_CHILDREN] = {}
+          nodes[parent][_CHILDREN][dist] = node
+
+      tree.node_count = len(nodes)
+
+    return tree
+
+#Tree used for searching, the identity of the file it was loaded from and whether it's being rebuilt
+_tree = None
+_tree_file_id = None
+_tree_lock = threading.Lock()
+_rebuilding = False
+
+#Get all image hashes that are within a maximum hamming distance from a given reference hash
+def search(ref_hash: int, max_dist: int) -> list[int]:
+  return search_many([ref_hash], max_dist)[0]
+
+#Get all image hashes that are within a maximum hamming distance from each of a group of reference
+#hashes, returning a list of revision ids for every reference hash
+def search_many(ref_hashes: list[int], max_dist: int) -> list[list[int]]:
+  with _tree_lock:
+    tree = _get_updated_tree()
+    return [tree.search(ref_hash, max_dist) for ref_hash in ref_hashes]
+
+#Get the k revisions nearest to a reference hash within a maximum hamming distance
+def search_nearest(ref_hash: int, max_dist: int, k: int) -> list[tuple[int, int]]:
+  with _tree_lock:
+    return _get_updated_tree().search_nearest(ref_hash, max_dist, k)
+
+#Bring the tree file up to date with the hashes table, rebuilding it when hashes have been deleted
+#or many have been added since it was built. Newer hashes are inserted by the searching processes.
+def refresh() -> None:
+  path = config.root.similarity_search.tree_file
+
+  try:
+    with np.load(path) as data:
+      last_id, revision_count, revision_id_sum, _ = (int(value) for value in data['meta'])
+  except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+    pass
+  else:
+    #Make sure the hashes in the tree are still the same in the database. Hashes are never
+    #modified, so only deletions have to be detected.
+    db_revision_count, db_revision_id_sum = hashes.read_summary(last_id)
+    new_count = hashes.read_summary()[0] - db_revision_count
+
+    if (db_revision_count, db_revision_id_sum) == (revision_count, revision_id_sum) and\
+       new_count <= revision_count * REBUILD_FRACTION:
+      return
+
+  tree = _build(db.get())
+  tree.save(path)
+  print(f'Hash tree: Rebuilt with {tree.node_count} distinct hashes')
+
+#Build a tree from all the hashes in the database
+def _build(con: sqlite3.Connection) -> _MetricTree:
+  return _MetricTree.build(hashes.read_hashes(con = con))
+
+#Get the tree used for searching, loading it lazily from the tree file. The tree is loaded again when
+#the file is replaced, or built right away if there's no file.
+def _get_tree() -> _MetricTree:
+  global _tree
+  global _tree_file_id
+
+  try:
+    stat = os.stat(config.root.similarity_search.tree_file)
+    file_id = (stat.st_dev, stat.st_ino)
+  except FileNotFoundError:
+    file_id = None
+
+  if _tree is None or (file_id is not None and file_id != _tree_file_id):
+    _tree = _build(db.get()) if file_id is None else\
+            _MetricTree.load(config.root.similarity_search.tree_file)
+    _tree_file_id = file_id
+
+  return _tree
+
+#Get the tree used for searching after inserting the hashes created since it was built or last
+#searched, starting a rebuild if that made it unbalanced. Must be called with the tree lock held.
+def _get_updated_tree() -> _MetricTree:
+  tree = _get_tree()
+
+  for hash_id, revision_id, hash_ in hashes.read_hashes(tree.last_id):
+    tree.insert(hash_id, revision_id, hash_)
+
+  if tree.is_unbalanced():
+    _start_rebuild()
+
+  return tree
+
+#Rebuild the tree used for searching in a background thread, with its own database connection, and
+#replace it once finished
+def _start_rebuild() -> None:
+  global _rebuilding
+
+  if _rebuilding:
+    return
+
+  def rebuild():
+    global _tree
+    global _rebuilding
+
+    try:
+      con = db.contextless_get()
+      try:
+        tree = _build(con)
+      finally:
+        con.close()
+
+      with _tree_lock:
+        _tree = tree
+    finally:
+      _rebuilding = False
+
+  _rebuilding = True
+  threading.Thread(target = rebuild, daemon = True).start()
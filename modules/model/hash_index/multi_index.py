@@ -0,0 +1,109 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The multi-index hashing engine performs hamming distance searches without scanning every hash.  |
+#|                                                                                                 |
+#| Every 64-bit hash is split into 4 substrings of 16 bits, which are indexed in the               |
+#| hash_substrings table along with their position and revision id. If two hashes are within a     |
+#| hamming distance r, at least one of their substrings must be within a distance of r // 4        |
+#| (pigeonhole principle), so searching every substring for the values within that distance from   |
+#| the reference one yields all the matching revisions, plus some candidates that are verified     |
+#| afterwards using their full hashes. For a radius of 12, every substring is probed for 697       |
+#| values out of 65536, which touches about 4% of the rows.                                        |
+#|                                                                                                 |
+#| The substrings are added by the image update script, which creates their table the first time.  |
+#| Hashes created after the last update are searched in the hashes table, so results are always    |
+#| current.                                                                                        |
+#+-------------------------------------------------------------------------------------------------+
+
+import json
+from functools import cache
+from itertools import combinations
+from modules.model import db
+from modules.model.table import sync_state, hashes
+
+#Number of substrings and size of each substring in bits
+SUBSTRING_COUNT = 4
+SUBSTRING_BITS = 16
+
+#Maximum substring search radius. Larger radii touch too many rows to be worthwhile, so the full
+#scan is used instead.
+MAX_SUBSTRING_RADIUS = 4
+
+#Get all image hashes that are within a maximum hamming distance from a given reference hash
+def search(ref_hash: int, max_dist: int) -> list[int]:
+  #Without substrings (not created yet), every hash would be searched in the hashes table anyway
+  info = sync_state.read('hash_substrings')
+  substring_radius = max_dist // SUBSTRING_COUNT
+  if substring_radius > MAX_SUBSTRING_RADIUS or info is None:
+    return hashes.search(ref_hash, max_dist)
+
+  db.load_extension('hammdist')
+  con = db.get()
+
+  last_id = info['last_id']
+
+  #Search every substring for its candidate values and verify the candidate revisions, which are
+  #only returned once even if they're found through multiple substrings
+  masks = _substring_masks(substring_radius)
+  substrings = [(i << SUBSTRING_BITS) | (_substring(ref_hash, i) ^ mask)
+                for i in range(SUBSTRING_COUNT) for mask in masks]
+
+  cursor = con.execute(
+    'SELECT revision_id FROM revision_hashes '
+    'WHERE revision_id IN (SELECT revision_id FROM hash_substrings '
+      'WHERE substring IN (SELECT value FROM json_each(?))) '
+    'AND sequence <= ? AND HAMMDIST(?, hash, rotation_hashes) <= ?',
+    (json.dumps(substrings), last_id // hashes.MAX_HASHES, ref_hash, max_dist))
+
+  cursor.row_factory = lambda cur, row: row[0]
+
+  #Search the hashes that are newer than the substrings in the database
+  return cursor.fetchall() + hashes.search(ref_hash, max_dist, after_id = last_id)
+
+#Bring the substrings up to date with the hashes table
+def refresh() -> None:
+  info = sync_state.read('hash_substrings')
+  last_id = 0 if info is None else info['last_id']
+
+  with db.get() as con:
+    #Every substring is stored as its position followed by its value, so all of them share one index
+    con.execute(
+      'CREATE TABLE IF NOT EXISTS hash_substrings('
+        'substring INTEGER NOT NULL, '
+        'revision_id INTEGER NOT NULL, '
+        'PRIMARY KEY (substring, revision_id)) WITHOUT ROWID')
+
+    #Hashes are never modified, so if the ones indexed before are unchanged, only the new ones have
+    #to be added. Otherwise, the substrings of the deleted revisions are removed.
+    deleted = 0
+    if info is not None and list(hashes.read_summary(last_id)) != info['summary']:
+      deleted = con.execute(
+        'DELETE FROM hash_substrings '
+        'WHERE revision_id NOT IN (SELECT revision_id FROM revision_hashes)').rowcount
+
+    new_hashes = list(hashes.read_hashes(last_id))
+    con.executemany(
+      'INSERT OR IGNORE INTO hash_substrings (substring, revision_id) VALUES (?, ?)',
+      ((((i << SUBSTRING_BITS) | _substring(hash_, i)), revision_id)
+       for _, revision_id, hash_ in new_hashes for i in range(SUBSTRING_COUNT)))
+
+  if new_hashes:
+    last_id = new_hashes[-1][0]
+
+  sync_state.write('hash_substrings', {
+    'last_id': last_id,
+    'summary': hashes.read_summary(last_id),
+  })
+
+  if new_hashes or deleted:
+    print(f'Hash substrings: {len(new_hashes)} hashes added, {deleted} substrings removed')
+
+#Get the substring of a hash at a given position
+def _substring(hash_: int, position: int) -> int:
+  return (hash_ >> (position * SUBSTRING_BITS)) & ((1 << SUBSTRING_BITS) - 1)
+
+#Get the XOR masks that produce every substring value within a given hamming distance
+@cache
+def _substring_masks(radius: int) -> list[int]:
+  return [sum(1 << bit for bit in bits)
+          for dist in range(radius + 1)
+          for bits in combinations(range(SUBSTRING_BITS), dist)]
@@ -0,0 +1,229 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The packed array engine keeps a snapshot of all the image hashes in a memory-mapped file, made  |
+#| of a contiguous array of 64-bit hashes and a parallel array of 32-bit revision ids. The file is |
+#| shared by every process that searches it through the page cache, and each search compares the   |
+#| reference hash against the whole array at once using vectorized NumPy operations.               |
+#|                                                                                                 |
+#| The snapshot is refreshed by the image update script: new hashes are appended in place, while   |
+#| the file is rebuilt and atomically replaced if hashes were deleted or it runs out of capacity.  |
+#| Hashes added after the last refresh are searched in the database, so results are always current.|
+#+-------------------------------------------------------------------------------------------------+
+
+import os
+from itertools import batched
+import numpy as np
+from modules.common import config
+from modules.model.table import hashes
+
+#Register module configurations
+config.register({
+  'similarity_search': {
+    'snapshot_file': 'hash_snapshot.bin', #Default: Snapshot file in the working directory
+  },
+})
+
+#File header layout. The sequence number is odd while the header is being updated, so readers can
+#retry until they read a consistent header.
+_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('capacity', '<i8'), ('sequence', '<i8'),
+                          ('count', '<i8'), ('last_id', '<i8'), ('revision_id_sum', '<i8')])
+HEADER_SIZE = 64
+MAGIC = b'MWCAHASH'
+
+#Minimum amount of hashes the file is created for. Files are created with twice the capacity needed,
+#so appending doesn't require rebuilding the file often.
+MIN_CAPACITY = 1 << 16
+
+#Maximum attempts to read a consistent header
+READ_HEADER_ATTEMPTS = 1000
+
+#Amount of hashes compared at once, which limits the size of temporary arrays
+CHUNK_SIZE = 1 << 18
+
+#Count the bits set in every element of an array of unsigned 64-bit integers, using NumPy's builtin
+#function if available (NumPy 2.0+), or a lookup table for every 16-bit value otherwise
+if hasattr(np, 'bitwise_count'):
+  popcount = np.bitwise_count
+else:
+  _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(1 << 16)], dtype = np.uint8)
+  popcount = lambda values: _POPCOUNT_TABLE[values.view(np.uint16)].reshape(-1, 4).sum(axis = 1)
+
+#Memory map of the snapshot file used for searching and the identity of the file it maps
+_snapshot = None
+_snapshot_file_id = None
+
+#Get all image hashes that are within a maximum hamming distance from a given reference hash
+def search(ref_hash: int, max_dist: int) -> list[int]:
+  snapshot = _get_snapshot()
+  header_fields = None if snapshot is None else _read_header(snapshot[0])
+  if header_fields is None:
+    #There's no usable snapshot
+    return hashes.search(ref_hash, max_dist)
+
+  _, hash_array, revision_id_array = snapshot
+  count, last_id, _ = header_fields
+
+  #Compare the reference hash against the snapshot in chunks
+  matches = []
+  for start in range(0, count, CHUNK_SIZE):
+    end = min(start + CHUNK_SIZE, count)
+    distances = popcount((hash_array[start:end] ^ np.int64(ref_hash)).view(np.uint64))
+    matches.append(revision_id_array[start:end][distances <= max_dist])
+
+  result = np.concatenate(matches).tolist() if matches else []
+
+  #Search the hashes that are newer than the snapshot in the database
+  return result + hashes.search(ref_hash, max_dist, after_id = last_id)
+
+#Get all image hashes that are within a maximum hamming distance from each of a group of reference
+#hashes, returning a list of revision ids for every reference hash
+def search_many(ref_hashes: list[int], max_dist: int) -> list[list[int]]:
+  snapshot = _get_snapshot()
+  header_fields = None if snapshot is None else _read_header(snapshot[0])
+  if header_fields is None:
+    #There's no usable snapshot
+    return hashes.search_many(ref_hashes, max_dist)
+
+  _, hash_array, revision_id_array = snapshot
+  count, last_id, _ = header_fields
+
+  #Compare every chunk against all the reference hashes while it's still in the CPU cache, so the
+  #snapshot is only read from memory once
+  matches = [[] for _ in ref_hashes]
+  for start in range(0, count, CHUNK_SIZE):
+    end = min(start + CHUNK_SIZE, count)
+    hash_chunk = hash_array[start:end]
+    revision_id_chunk = revision_id_array[start:end]
+    for ref_matches, ref_hash in zip(matches, ref_hashes):
+      distances = popcount((hash_chunk ^ np.int64(ref_hash)).view(np.uint64))
+      ref_matches.append(revision_id_chunk[distances <= max_dist])
+
+  #Search the hashes that are newer than the snapshot in the database
+  new_matches = hashes.search_many(ref_hashes, max_dist, after_id = last_id)
+
+  return [(np.concatenate(ref_matches).tolist() if ref_matches else []) + ref_new_matches
+          for ref_matches, ref_new_matches in zip(matches, new_matches)]
+
+#Bring the snapshot up to date with the hashes table, creating it if needed
+def refresh() -> None:
+  path = config.root.similarity_search.snapshot_file
+
+  snapshot = _map(path, 'r+')
+  header_fields = None if snapshot is None else _read_header(snapshot[0])
+  if header_fields is not None:
+    count, last_id, revision_id_sum = header_fields
+
+    #Make sure the hashes in the snapshot are still the same in the database. Hashes are never
+    #modified, so only deletions have to be detected.
+    if hashes.read_summary(last_id) == (count, revision_id_sum):
+      #Append the new hashes if they fit, otherwise the file must be rebuilt
+      rows = list(hashes.read_hashes(last_id))
+
+      if count + len(rows) <= len(snapshot[1]):
+        if rows:
+          _append(snapshot, rows)
+          print(f'Hash snapshot: {len(rows)} hashes appended')
+        return
+
+  _rebuild(path)
+
+#Create the snapshot file again from all the hashes in the database, replacing the previous one
+def _rebuild(path: str) -> None:
+  count = hashes.read_summary()[0]
+  capacity = max(MIN_CAPACITY, count * 2)
+
+  #Create the file with its final size at a temporary location
+  temp_path = f'{path}.tmp'
+  with open(temp_path, 'wb') as f:
+    f.truncate(HEADER_SIZE + capacity * 12)
+
+  snapshot = _map(temp_path, 'r+', capacity)
+  header = snapshot[0]
+  header['magic'] = MAGIC
+  header['capacity'] = capacity
+
+  #Add all the hashes in batches. Hashes that are added during the process fit in the spare
+  #capacity.
+  for rows in batched(hashes.read_hashes(), CHUNK_SIZE):
+    _append(snapshot, rows)
+
+  #Replace the previous file. Processes that mapped it will map the new one on their next search.
+  del snapshot, header
+  os.replace(temp_path, path)
+
+  print(f'Hash snapshot: Rebuilt with {count} hashes')
+
+#Append a group of hash rows (hash id, revision id, hash) to the snapshot, then update the header
+def _append(snapshot: tuple[np.memmap, np.memmap, np.memmap], rows: list[tuple[int, int, int]]):
+  header, hash_array, revision_id_array = snapshot
+  count, last_id, revision_id_sum = _read_header(header)
+
+  #Convert the rows to an array with one column per field
+  rows = np.array(rows, dtype = np.int64)
+  hash_array[count:count + len(rows)] = rows[:, 2]
+  revision_id_array[count:count + len(rows)] = rows[:, 1]
+  hash_array.flush()
+  revision_id_array.flush()
+
+  #Update the header only once the hashes are in place, so readers never see incomplete rows
+  header['sequence'] += 1
+  header['count'] = count + len(rows)
+  header['last_id'] = rows[-1, 0]
+  header['revision_id_sum'] = revision_id_sum + int(rows[:, 1].sum())
+  header['sequence'] += 1
+  header.flush()
+
+#Read the header fields that change when hashes are appended, retrying while they're being updated
+#Return value: The hash count, last hash id and revision id sum, or None if the header is never
+#consistent (e.g. the update process was killed while updating it).
+def _read_header(header: np.memmap) -> tuple[int, int, int] | None:
+  for _ in range(READ_HEADER_ATTEMPTS):
+    sequence = int(header['sequence'][0])
+    fields = int(header['count'][0]), int(header['last_id'][0]),\
+             int(header['revision_id_sum'][0])
+    if sequence % 2 == 0 and sequence == int(header['sequence'][0]):
+      return fields
+
+  return None
+
+#Get the memory map of the snapshot file for searching, mapping it again if it has been replaced
+#Return value: The memory map or None if there's no valid snapshot file.
+def _get_snapshot() -> tuple[np.memmap, np.memmap, np.memmap] | None:
+  global _snapshot
+  global _snapshot_file_id
+
+  path = config.root.similarity_search.snapshot_file
+  try:
+    stat = os.stat(path)
+  except FileNotFoundError:
+    return None
+
+  file_id = (stat.st_dev, stat.st_ino)
+  if file_id != _snapshot_file_id:
+    _snapshot = _map(path, 'r')
+    _snapshot_file_id = file_id
+
+  return _snapshot
+
+#Map the header, hash array and revision id array of a snapshot file to memory
+#Parameters:
+# - path: The path of the snapshot file.
+# - mode: The memory map mode ('r' for reading only, 'r+' for reading and writing).
+# - capacity: The capacity of a new file, or None to read it from the file header.
+#Return value: The memory maps or None if the file is missing or not valid.
+def _map(path: str, mode: str,
+         capacity: int | None = None) -> tuple[np.memmap, np.memmap, np.memmap] | None:
+  try:
+    header = np.memmap(path, dtype = _HEADER_DTYPE, mode = mode, shape = (1,))
+    if capacity is None:
+      if header['magic'][0] != MAGIC:
+        return None
+      capacity = int(header['capacity'][0])
+
+    hash_array = np.memmap(path, dtype = np.int64, mode = mode, offset = HEADER_SIZE,
+                           shape = (capacity,))
+    revision_id_array = np.memmap(path, dtype = np.int32, mode = mode,
+                                  offset = HEADER_SIZE + capacity * 8, shape = (capacity,))
+  except (FileNotFoundError, ValueError):
+    return None
+
+  return header, hash_array, revision_id_array
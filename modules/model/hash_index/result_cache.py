@@ -0,0 +1,108 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The result cache module keeps the results of recent similarity searches, so images opened again |
+#| by other reviewers don't have to be searched again. Results are kept by image id and search     |
+#| parameters in an in-process LRU cache and, optionally, in a database table shared by every      |
+#| worker process.                                                                                 |
+#|                                                                                                 |
+#| Every result is tagged with the hash generation it was computed for, a counter that changes     |
+#| when hashes are created or deleted. Results of previous generations are never returned, so new  |
+#| uploads show up as soon as they're hashed. Only the matching revisions are cached, while their  |
+#| titles and review status are always read when rendering.                                        |
+#+-------------------------------------------------------------------------------------------------+
+
+import json, threading
+from collections import OrderedDict
+from modules.common import config
+from modules.model import db
+from modules.model.table import hashes
+
+#Register module configurations
+config.register({
+  'similarity_search': {
+    'cache_size': 256,      #Default: Results of 256 searches kept by every process (0 disables it)
+    'shared_cache': False,  #Default: Don't share results between processes through the database
+  },
+})
+
+#Schema initialization function
+@db.schema
+def init_schema() -> None:
+  db.get().execute(
+    'CREATE TABLE IF NOT EXISTS similarity_cache('
+      'image_id INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE, '
+      'params TEXT NOT NULL, '
+      'generation INTEGER NOT NULL, '
+      'result TEXT NOT NULL, '
+      'PRIMARY KEY (image_id, params)) WITHOUT ROWID')
+
+#In-process cache entries by image id and parameters, with the least recently used first
+_entries = OrderedDict()
+_entries_lock = threading.Lock()
+
+#Get the result of a search for an image for the current hash generation
+#Parameters:
+# - image_id: The id of the image searched.
+# - params: The search parameters, which must be JSON serializable.
+#Return value: A tuple with the current hash generation and the result, or None if not found. The
+#result is shared with other callers, so it can't be modified.
+def read(image_id: int, params: list) -> tuple[int, any]:
+  generation = hashes.read_generation()
+  key = (image_id, json.dumps(params))
+
+  with _entries_lock:
+    entry = _entries.get(key)
+    if entry is not None and entry[0] == generation:
+      _entries.move_to_end(key)
+      return generation, entry[1]
+
+  result = None
+  if config.root.similarity_search.shared_cache:
+    row = db.get().execute(
+      'SELECT result FROM similarity_cache WHERE image_id = ? AND params = ? AND generation = ?',
+      (*key, generation)).fetchone()
+
+    if row is not None:
+      result = json.loads(row[0])
+      _write_entry(key, generation, result)
+
+  return generation, result
+
+#Store the result of a search for an image
+#Parameters:
+# - image_id: The id of the image searched.
+# - params: The search parameters, which must be JSON serializable.
+# - generation: The hash generation read before searching, so results computed while hashes change
+#   are already outdated.
+# - result: The search result, which must be JSON serializable and can't be modified afterwards.
+def write(image_id: int, params: list, generation: int, result: any) -> None:
+  key = (image_id, json.dumps(params))
+
+  if config.root.similarity_search.shared_cache:
+    with db.get() as con:
+      con.execute(
+        'INSERT INTO similarity_cache (image_id, params, generation, result) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (image_id, params) DO UPDATE SET '
+        'generation = excluded.generation, result = excluded.result',
+        (*key, generation, json.dumps(result)))
+
+  _write_entry(key, generation, result)
+
+#Store a result in the in-process cache, evicting the least recently used ones beyond its size
+def _write_entry(key: tuple[int, str], generation: int, result: any) -> None:
+  cache_size = config.root.similarity_search.cache_size
+  if cache_size > 0:
+    with _entries_lock:
+      _entries[key] = (generation, result)
+      _entries.move_to_end(key)
+      while len(_entries) > cache_size:
+        _entries.popitem(last = False)
+
+#Delete the shared results of previous hash generations
+def purge() -> None:
+  with db.get() as con:
+    count = con.execute(
+      'DELETE FROM similarity_cache WHERE generation != (SELECT generation FROM hash_generation)'
+    ).rowcount
+
+  if count:
+    print(f'Result cache: {count} outdated results deleted')
@@ -0,0 +1,255 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The sharded engine splits the image hashes among a group of shard server processes, run by the  |
+#| shard server script, which keep their part of the hashes in memory and compare them with the    |
+#| reference hashes using vectorized NumPy operations. Every search is sent to all the shards at   |
+#| once through Unix sockets, so they scan their parts in parallel, and their matches are merged.  |
+#|                                                                                                 |
+#| Revisions are assigned to shards by their hash sequence number modulo the shard count, so new   |
+#| hashes are spread evenly and shards stay balanced as they grow. Before every search, each shard |
+#| compares the hash generation with the one it last read: if the difference is the amount of      |
+#| revisions hashed since then, only the new hashes of the shard are loaded, so results are always |
+#| current. Otherwise, the shard is reloaded in the background while searches keep using the       |
+#| previous hashes. Shards also synchronize periodically, so reloads usually finish before the     |
+#| next search. Every shard serves concurrent searches with a thread each. Searches fall back to   |
+#| the hashes table if any shard is unreachable.                                                   |
+#+-------------------------------------------------------------------------------------------------+
+
+import os, socket, socketserver, struct, sys, threading, traceback
+import numpy as np
+from modules.common import config
+from modules.model import db
+from modules.model.table import hashes
+from modules.model.hash_index.packed_array import popcount, CHUNK_SIZE
+
+#Register module configurations
+config.register({
+  'similarity_search': {
+    'shard_count': 4,         #Default: 4 shard server processes
+    'shard_socket_dir': '.',  #Default: Shard sockets in the working directory
+    'shard_timeout': 10,      #Default: Give up on shards that take more than 10 seconds
+  },
+})
+
+#Message layouts. Requests are made of the maximum distance and the amount of reference hashes,
+#followed by the hashes as 64-bit integers. Responses are made of the amount of matches, followed by
+#the index of the reference hash and the revision id of every match as pairs of 32-bit integers.
+_REQUEST_HEADER = struct.Struct('<ii')
+_RESPONSE_HEADER = struct.Struct('<i')
+
+#Seconds between the synchronizations of a shard server when no searches are requested
+SYNC_INTERVAL = 5
+
+#Get all image hashes that are within a maximum hamming distance from a given reference hash
+def search(ref_hash: int, max_dist: int) -> list[int]:
+  return search_many([ref_hash], max_dist)[0]
+
+#Get all image hashes that are within a maximum hamming distance from each of a group of reference
+#hashes, returning a list of revision ids for every reference hash
+def search_many(ref_hashes: list[int], max_dist: int) -> list[list[int]]:
+  request = _REQUEST_HEADER.pack(max_dist, len(ref_hashes)) +\
+            np.array(ref_hashes, dtype = '<i8').tobytes()
+
+  matches = [[] for _ in ref_hashes]
+  sockets = []
+  try:
+    #Send the request to every shard before reading any response, so they all search at once
+    for shard_index in range(config.root.similarity_search.shard_count):
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      sockets.append(sock)
+      sock.settimeout(config.root.similarity_search.shard_timeout)
+      sock.connect(_socket_path(shard_index))
+      sock.sendall(request)
+
+    for sock in sockets:
+      match_count = _RESPONSE_HEADER.unpack(_receive(sock, _RESPONSE_HEADER.size))[0]
+      pairs = np.frombuffer(_receive(sock, match_count * 8), dtype = '<i4').reshape(-1, 2)
+      for ref_index, revision_id in pairs.tolist():
+        matches[ref_index].append(revision_id)
+  except OSError as e:
+    print(f'Hash shards unavailable, searching the database instead: {e}', file = sys.stderr)
+    return hashes.search_many(ref_hashes, max_dist)
+  finally:
+    for sock in sockets:
+      sock.close()
+
+  return matches
+
+#Run the server of a shard until the process is terminated. The database connection must not be
+#shared with other processes. Requests are served by a thread each, while the calling thread
+#synchronizes the hashes of the shard, which is the only one that uses the database connection.
+def serve(shard_index: int) -> None:
+  path = _socket_path(shard_index)
+
+  #Remove the socket left behind by a previous server that was killed
+  try:
+    os.unlink(path)
+  except FileNotFoundError:
+    pass
+
+  shard = _Shard(shard_index, config.root.similarity_search.shard_count)
+  shard.sync()
+
+  server = socketserver.ThreadingUnixStreamServer(path, _RequestHandler)
+  server.daemon_threads = True
+  server.shard = shard
+  print(f'Hash shard {shard_index}: Serving {len(shard.arrays[0])} hashes at {path}')
+
+  threading.Thread(target = server.serve_forever, daemon = True).start()
+  try:
+    shard.run_sync_loop()
+  finally:
+    server.shutdown()
+    server.server_close()
+    os.unlink(path)
+
+#Hashes of a shard kept in memory by its server: the ones of the revisions whose sequence number
+#modulo the shard count is the shard index
+class _Shard:
+  def __init__(self, shard_index: int, shard_count: int):
+    self.shard_index = shard_index
+    self.shard_count = shard_count
+
+    #Hashes and their revision ids, replaced as a whole so searches always see matching arrays
+    self.arrays = (np.empty(0, dtype = np.int64), np.empty(0, dtype = np.int32))
+
+    #Hash generation and last sequence number of the whole table when last synchronized
+    self.generation = None
+    self.last_sequence = 0
+
+    #Synchronization requests, and the amount of synchronizations started and completed. Requests
+    #don't wait for synchronizations that reload the whole shard, which are done in the background.
+    self.sync_requested = threading.Event()
+    self.sync_condition = threading.Condition()
+    self.syncs_started = 0
+    self.syncs_completed = 0
+    self.reloading = False
+
+  #Synchronize the shard whenever requested or periodically otherwise, so reloads usually happen
+  #before any search needs them. Runs until the process is terminated.
+  def run_sync_loop(self) -> None:
+    while True:
+      self.sync_requested.wait(SYNC_INTERVAL)
+      self.sync_requested.clear()
+
+      with self.sync_condition:
+        self.syncs_started += 1
+
+      try:
+        self.sync()
+      except Exception:
+        #Keep serving the current hashes, the synchronization is retried with the next request
+        traceback.print_exc()
+      finally:
+        with self.sync_condition:
+          self.syncs_completed += 1
+          self.reloading = False
+          self.sync_condition.notify_all()
+
+  #Wait until the shard is synchronized with the hashes table as of now, unless it's being reloaded
+  #(searches use the previous hashes meanwhile). Called by the request threads.
+  def wait_sync(self) -> None:
+    with self.sync_condition:
+      target = self.syncs_started + 1
+      self.sync_requested.set()
+      self.sync_condition.wait_for(
+        lambda: self.syncs_completed >= target or self.reloading,
+        timeout = config.root.similarity_search.shard_timeout)
+
+  #Bring the hashes of the shard up to date with the hashes table
+  def sync(self) -> None:
+    con = db.get()
+
+    #Read everything from the same snapshot of the database
+    con.execute('BEGIN')
+    try:
+      generation = hashes.read_generation()
+      if generation == self.generation:
+        return
+
+      #Every revision hashed or deleted advances the generation once, so if it advanced as many
+      #times as revisions were hashed (including the ones without a hash) nothing else happened
+      new_count, last_sequence = con.execute(
+        'SELECT COUNT(*), MAX(sequence) FROM revision_hashes WHERE sequence > ?',
+        (self.last_sequence,)).fetchone()
+
+      hash_array, revision_id_array = self.arrays
+      if self.generation is not None and generation - self.generation == new_count:
+        after_sequence = self.last_sequence
+      else:
+        #Let waiting searches use the previous hashes while the shard is reloaded
+        with self.sync_condition:
+          self.reloading = True
+          self.sync_condition.notify_all()
+
+        after_sequence = 0
+        hash_array = hash_array[:0]
+        revision_id_array = revision_id_array[:0]
+        last_sequence = con.execute('SELECT MAX(sequence) FROM revision_hashes').fetchone()[0]
+
+      rows = [(revision_id, revision_hash) for revision_id, hash_, rotation_hashes in con.execute(
+        'SELECT revision_id, hash, rotation_hashes FROM revision_hashes '
+        'WHERE hash IS NOT NULL AND sequence > ? AND sequence % ? = ? ORDER BY sequence',
+        (after_sequence, self.shard_count, self.shard_index))
+        for revision_hash in hashes.unpack(hash_, rotation_hashes)]
+    finally:
+      con.rollback()
+
+    if rows:
+      rows = np.array(rows, dtype = np.int64)
+      hash_array = np.concatenate((hash_array, rows[:, 1]))
+      revision_id_array = np.concatenate((revision_id_array, rows[:, 0].astype(np.int32)))
+
+    self.arrays = (hash_array, revision_id_array)
+    self.generation = generation
+    self.last_sequence = last_sequence or self.last_sequence
+
+  #Get the matches of a group of reference hashes within a maximum hamming distance
+  #Return value: An array with the index of the reference hash and the revision id of every match.
+  def search_many(self, ref_hashes: np.ndarray, max_dist: int) -> np.ndarray:
+    hash_array, revision_id_array = self.arrays
+
+    #Compare every chunk against all the reference hashes while it's still in the CPU cache
+    pairs = []
+    for start in range(0, len(hash_array), CHUNK_SIZE):
+      hash_chunk = hash_array[start:start + CHUNK_SIZE]
+      revision_id_chunk = revision_id_array[start:start + CHUNK_SIZE]
+      for ref_index, ref_hash in enumerate(ref_hashes):
+        distances = popcount((hash_chunk ^ ref_hash).view(np.uint64))
+        revision_ids = revision_id_chunk[distances <= max_dist]
+        if len(revision_ids):
+          pairs.append(np.column_stack((np.full_like(revision_ids, ref_index), revision_ids)))
+
+    return np.concatenate(pairs) if pairs else np.empty((0, 2), dtype = np.int32)
+
+#Handler of the connections to a shard server, which may send any amount of requests
+class _RequestHandler(socketserver.StreamRequestHandler):
+  def handle(self) -> None:
+    while len(header := self.rfile.read(_REQUEST_HEADER.size)) == _REQUEST_HEADER.size:
+      max_dist, ref_count = _REQUEST_HEADER.unpack(header)
+      ref_hashes = np.frombuffer(self.rfile.read(ref_count * 8), dtype = '<i8')
+      if len(ref_hashes) != ref_count:
+        return
+
+      shard = self.server.shard
+      shard.wait_sync()
+      pairs = shard.search_many(ref_hashes.astype(np.int64), max_dist)
+
+      self.wfile.write(_RESPONSE_HEADER.pack(len(pairs)) + pairs.astype('<i4').tobytes())
+      self.wfile.flush()
+
+#Get the path of the socket of a shard server
+def _socket_path(shard_index: int) -> str:
+  return os.path.join(config.root.similarity_search.shard_socket_dir,
+                      f'hash_shard_{shard_index}.sock')
+
+#Receive an exact amount of bytes from a socket
+def _receive(sock: socket.socket, size: int) -> bytearray:
+  data = bytearray(size)
+  view = memoryview(data)
+  while view:
+    received = sock.recv_into(view)
+    if received == 0:
+      raise ConnectionResetError('Connection closed by the shard server')
+    view = view[received:]
+
+  return data
@@ -0,0 +1,183 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The similar pairs module keeps a precomputed graph of near-duplicate revisions, so the review   |
+#| pages can read the similar images of a revision with an indexed lookup instead of searching.    |
+#|                                                                                                 |
+#| A pair (revision_a, revision_b, distance) means that one of the hashes of revision b is within  |
+#| the distance of the reference hash of revision a (its first hash), which is what a search for   |
+#| the revision would find. Pairs are filled by an offline all-pairs pass that searches every      |
+#| reference hash with the configured search engine (by default multi-index hashing, which only    |
+#| compares candidates sharing a close substring), and updated incrementally once new revisions    |
+#| are hashed: their reference hash is searched, as well as all their hashes, so they're added to  |
+#| the pairs of the revisions processed before. Deleting revisions cascades to their pairs.        |
+#+-------------------------------------------------------------------------------------------------+
+
+import json
+from modules.common import config
+from modules.model import db
+from modules.model.table import sync_state, hashes
+from modules.model.hash_index import engine
+
+#Register module configurations
+config.register({
+  'similarity_search': {
+    'pair_max_dist': 12,  #Default: Same distance used by the review pages
+  },
+})
+
+#Amount of revisions processed at once
+BATCH_SIZE = 256
+
+#Schema initialization function
+@db.schema
+def init_schema() -> None:
+  con = db.get()
+
+  con.execute(
+    'CREATE TABLE IF NOT EXISTS similar_pairs('
+      'revision_a INTEGER NOT NULL REFERENCES revisions(id) ON DELETE CASCADE, '
+      'revision_b INTEGER NOT NULL REFERENCES revisions(id) ON DELETE CASCADE, '
+      'distance INTEGER NOT NULL, '
+      'PRIMARY KEY (revision_a, revision_b)) WITHOUT ROWID')
+
+  con.execute(
+    'CREATE INDEX IF NOT EXISTS similar_pairs_revision_b ON similar_pairs(revision_b)')
+
+  #Revisions whose pairs have been computed, along with their reference hash
+  con.execute(
+    'CREATE TABLE IF NOT EXISTS similar_pairs_revisions('
+      'revision_id INTEGER PRIMARY KEY REFERENCES revisions(id) ON DELETE CASCADE, '
+      'hash INT NOT NULL)')
+
+#Check whether the pairs are complete for searches within a maximum hamming distance, i.e. an
+#all-pairs pass has finished for that distance or a larger one
+def available(max_dist: int) -> bool:
+  state = sync_state.read('similar_pairs')
+  return state is not None and max_dist <= state['max_dist']
+
+#Get the revisions similar to each of the revisions of an image within a maximum hamming distance
+#Return value: A dictionary with the similar revision ids for every revision timestamp of the image.
+#Revisions without similar revisions are left out.
+def search_image(image_id: int, max_dist: int) -> dict[str, list[int]]:
+  cursor = db.get().execute(
+    'SELECT revisions.timestamp, similar_pairs.revision_b FROM revisions '
+    'INNER JOIN similar_pairs ON revisions.id = similar_pairs.revision_a '
+    'WHERE revisions.image_id = ? AND similar_pairs.distance <= ?', (image_id, max_dist))
+
+  result = {}
+  for revision_timestamp, revision_id in cursor:
+    result.setdefault(revision_timestamp, []).append(revision_id)
+
+  return result
+
+#Get the k revisions nearest to a revision of an image within a maximum hamming distance
+#Return value: A list with the revision id and distance of up to k revisions, sorted by distance and
+#revision id.
+def search_nearest(image_id: int, revision_timestamp: str, max_dist: int,
+                   k: int) -> list[tuple[int, int]]:
+  return db.get().execute(
+    'SELECT similar_pairs.revision_b, similar_pairs.distance FROM revisions '
+    'INNER JOIN similar_pairs ON revisions.id = similar_pairs.revision_a '
+    'WHERE revisions.image_id = ? AND revisions.timestamp = ? AND similar_pairs.distance <= ? '
+    'ORDER BY similar_pairs.distance, similar_pairs.revision_b LIMIT ?',
+    (image_id, revision_timestamp, max_dist, k)).fetchall()
+
+#Compute the pairs of all the revisions from scratch with the configured maximum distance. Searches
+#fall back to the search engine until the pass finishes.
+def rebuild() -> None:
+  max_dist = config.root.similarity_search.pair_max_dist
+
+  sync_state.delete('similar_pairs')
+  with db.get() as con:
+    con.execute('DELETE FROM similar_pairs')
+    con.execute('DELETE FROM similar_pairs_revisions')
+
+    #Hashes that exist now are found by the reference hash searches of every revision, while the
+    #ones created during the pass have to be searched as well, as usual
+    last_sequence = con.execute(
+      'SELECT IFNULL(MAX(sequence), 0) FROM revision_hashes').fetchone()[0]
+
+  count = _add_revisions(max_dist, last_sequence)
+  sync_state.write('similar_pairs', { 'max_dist': max_dist })
+
+  print(f'Similar pairs: Rebuilt for {count} revisions')
+
+#Add the pairs of the revisions hashed since the last update, if the pairs are in use
+def update() -> None:
+  state = sync_state.read('similar_pairs')
+  if state is None:
+    return
+
+  count = _add_revisions(state['max_dist'], 0)
+  if count:
+    print(f'Similar pairs: {count} revisions added')
+
+#Add the pairs of every hashed revision that hasn't been processed yet
+#Parameters:
+# - max_dist: The maximum hamming distance of the pairs.
+# - search_after_sequence: Only search all the hashes of the revisions hashed after this sequence
+#   number. Other revisions only need their reference hash searched if every revision is processed.
+#Return value: The amount of revisions processed.
+def _add_revisions(max_dist: int, search_after_sequence: int) -> int:
+  db.load_extension('hammdist')
+  con = db.get()
+
+  count = 0
+  after_revision_id = -1
+  while True:
+    #Get the next batch of revisions with their reference hash, along with the other hashes
+    rows = con.execute(
+      'SELECT revision_id, hash, sequence, rotation_hashes FROM revision_hashes '
+      'WHERE revision_id > ? AND hash IS NOT NULL AND '
+      'revision_id NOT IN (SELECT revision_id FROM similar_pairs_revisions) '
+      'ORDER BY revision_id LIMIT ?',
+      (after_revision_id, BATCH_SIZE)).fetchall()
+    if not rows:
+      return count
+
+    after_revision_id = rows[-1][0]
+    count += len(rows)
+
+    #Find the revisions similar to every reference hash
+    ref_matches = engine.search_many([ref_hash for _, ref_hash, _, _ in rows], max_dist)
+
+    #Find the processed revisions whose reference hash is similar to any hash of the new revisions
+    search_hashes = [(revision_id, hash_)
+                     for revision_id, ref_hash, sequence, rotation_hashes in rows
+                     if sequence > search_after_sequence
+                     for hash_ in hashes.unpack(ref_hash, rotation_hashes)]
+    search_matches = engine.search_many([hash_ for _, hash_ in search_hashes], max_dist)
+
+    with con:
+      for (revision_id, ref_hash, _, _), match_revision_ids in zip(rows, ref_matches):
+        con.execute(
+          'INSERT INTO similar_pairs (revision_a, revision_b, distance) '
+          'SELECT :revision_id, revision_id, HAMMDIST(:ref_hash, hash, rotation_hashes) '
+          'FROM revision_hashes '
+          'WHERE revision_id IN (SELECT value FROM json_each(:match_revision_ids)) AND '
+          'revision_id != :revision_id AND '
+          'HAMMDIST(:ref_hash, hash, rotation_hashes) <= :max_dist '
+          'ON CONFLICT DO NOTHING',
+          { 'revision_id': revision_id, 'ref_hash': ref_hash,
+            'match_revision_ids': json.dumps(match_revision_ids), 'max_dist': max_dist })
+
+      #The reference hash of a processed revision is compared against all the hashes of the new one
+      for (revision_id, _), match_revision_ids in zip(search_hashes, search_matches):
+        con.execute(
+          'INSERT INTO similar_pairs (revision_a, revision_b, distance) '
+          'SELECT similar_pairs_revisions.revision_id, :revision_id, '
+          'HAMMDIST(similar_pairs_revisions.hash, revision_hashes.hash, '
+          'revision_hashes.rotation_hashes) '
+          'FROM similar_pairs_revisions '
+          'INNER JOIN revision_hashes ON revision_hashes.revision_id = :revision_id '
+          'WHERE similar_pairs_revisions.revision_id IN '
+          '(SELECT value FROM json_each(:match_revision_ids)) AND '
+          'similar_pairs_revisions.revision_id != :revision_id AND '
+          'HAMMDIST(similar_pairs_revisions.hash, revision_hashes.hash, '
+          'revision_hashes.rotation_hashes) <= :max_dist '
+          'ON CONFLICT DO NOTHING',
+          { 'revision_id': revision_id, 'match_revision_ids': json.dumps(match_revision_ids),
+            'max_dist': max_dist })
+
+      con.executemany(
+        'INSERT INTO similar_pairs_revisions (revision_id, hash) VALUES (?, ?)',
+        ((revision_id, ref_hash) for revision_id, ref_hash, _, _ in rows))
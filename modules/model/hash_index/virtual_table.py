@@ -0,0 +1,57 @@
+#+-------------------------------------------------------------------------------------------------+
+#| The virtual table engine searches the image hashes through the hammindex virtual table module   |
+#| of the hammdist extension, which stores every hash in bucketed substring indexes (shadow        |
+#| tables) and resolves "hash MATCH ? AND distance <= ?" constraints by only reading the buckets   |
+#| that can contain matches. As a table, it can also be joined with other tables and views in SQL. |
+#|                                                                                                 |
+#| The virtual table mirrors the hashes table, using the hash ids as rowids, and is brought up to  |
+#| date by the image update script. It's only created then, so databases that use other engines    |
+#| don't depend on the extension. Until it exists, the hashes table is searched instead.           |
+#+-------------------------------------------------------------------------------------------------+
+
+from modules.model import db
+from modules.model.table import hashes
+
+#Get all image hashes that are within a maximum hamming distance from a given reference hash
+def search(ref_hash: int, max_dist: int) -> list[int]:
+  if not db.table_exists('hash_index'):
+    return hashes.search(ref_hash, max_dist)
+
+  db.load_extension('hammdist')
+  con = db.get()
+
+  cursor = con.execute(
+    'SELECT revision_id FROM hash_index WHERE hash MATCH ? AND distance <= ?', (ref_hash, max_dist))
+
+  cursor.row_factory = lambda cur, row: row[0]
+
+  return cursor.fetchall()
+
+#Bring the virtual table up to date with the hashes table
+def refresh() -> None:
+  db.load_extension('hammdist')
+
+  with db.get() as con:
+    con.execute('CREATE VIRTUAL TABLE IF NOT EXISTS hash_index USING hammindex')
+
+    #Read the summary of the stored hashes from the data shadow table, which has one row per hash
+    last_id, count, revision_id_sum = con.execute(
+      'SELECT IFNULL(MAX(id), 0), COUNT(*), IFNULL(SUM(revision_id), 0) FROM hash_index_data'
+    ).fetchone()
+
+    if hashes.read_summary(last_id) == (count, revision_id_sum):
+      #Hashes are never modified, so only the new ones have to be added
+      new_rows = list(hashes.read_hashes(last_id))
+      deleted = 0
+    else:
+      #Hashes have been deleted, compare every row
+      rows = set(hashes.read_hashes())
+      stored_rows = set(con.execute('SELECT id, revision_id, hash FROM hash_index_data'))
+      new_rows = sorted(rows - stored_rows)
+      deleted = con.executemany('DELETE FROM hash_index WHERE rowid = ?',
+                                ((hash_id,) for hash_id, _, _ in stored_rows - rows)).rowcount
+
+    con.executemany('INSERT INTO hash_index (rowid, revision_id, hash) VALUES (?, ?, ?)', new_rows)
+
+  if new_rows or deleted:
+    print(f'Hash index: {len(new_rows)} hashes added, {deleted} removed')
@@ -1,32 +1,243 @@
+import json, sqlite3
+from array import array
+from collections.abc import Iterator
+from itertools import groupby
 from modules.model import db
 
+#Maximum distance between the reference hashes that are searched together by search_many
+GROUP_RADIUS = 4
+
+#Maximum amount of hashes of a revision (one per rotation). Every hash has an id made of the
+#sequence number of its revision times this amount plus its position, which grows as hashes are
+#created like a rowid would.
+MAX_HASHES = 4
+
+#Status of the hashed revisions
+STATUS_UNSUPPORTED = 0  #The file could not be hashed (e.g. it's not an image), so it's not retried
+STATUS_HASHED = 1
+
 #Schema initialization function
 @db.schema
 def init_schema() -> None:
   con = db.get()
 
+  #Every hashed revision has a single row with its reference hash (the first one, which is the hash
+  #of the file as is) and the hashes of the other rotations packed as 64-bit integers in native
+  #byte order, along with the fine hashes of all of them in the same order if calculated. The
+  #sequence number is the hash generation the revision was hashed in, which is never reused, so it
+  #tells which revisions were hashed after others.
+  con.execute(
+    'CREATE TABLE IF NOT EXISTS revision_hashes('
+      'revision_id INTEGER PRIMARY KEY REFERENCES revisions(id) ON DELETE CASCADE, '
+      'sequence INTEGER NOT NULL, '
+      'status INTEGER NOT NULL, '
+      'hash INT, '
+      'rotation_hashes BLOB, '
+      'fine_hashes BLOB) WITHOUT ROWID')
+
   con.execute(
-    'CREATE TABLE IF NOT EXISTS hashes('
-      'revision_id INTEGER NOT NULL REFERENCES revisions(id) ON DELETE CASCADE, '
-      'hash INT)')
+    'CREATE UNIQUE INDEX IF NOT EXISTS revision_hashes_sequence ON revision_hashes(sequence)')
 
+  #The generation counter changes whenever hashes are created or deleted (including deletions of
+  #their revisions), which tells when the results of previous similarity searches become outdated
   con.execute(
-    'CREATE INDEX IF NOT EXISTS hashes_revision_id ON hashes(revision_id)')
+    'CREATE TABLE IF NOT EXISTS hash_generation('
+      'id INTEGER PRIMARY KEY CHECK (id = 0), '
+      'generation INTEGER NOT NULL)')
+
+  with con:
+    con.execute('INSERT OR IGNORE INTO hash_generation (id, generation) VALUES (0, 0)')
+
+  #Databases created before store one row per hash in the hashes table, which are converted
+  if con.execute(
+    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hashes'").fetchone() is not None:
+    _migrate_hash_rows()
+
+  for event in ('INSERT', 'DELETE'):
+    con.execute(
+      f'CREATE TRIGGER IF NOT EXISTS revision_hashes_generation_{event.lower()} AFTER {event} '
+      f'ON revision_hashes BEGIN UPDATE hash_generation SET generation = generation + 1; END')
+
+#Convert the rows of the hashes table to the compact layout, then drop the table. The sequence
+#number of every revision is the rowid of its last hash, so the order of the revisions is kept.
+def _migrate_hash_rows() -> None:
+  with db.get() as con:
+    cursor = con.execute('SELECT revision_id, rowid, hash FROM hashes ORDER BY revision_id, rowid')
 
-#Create a new hash for a given image revision
-def create(revision_id: int, hash_: int | None) -> None:
+    #Fine hashes weren't calculated before
+    rows = []
+    for revision_id, hash_rows in groupby(cursor, key = lambda row: row[0]):
+      hash_rows = list(hash_rows)
+      hashes_ = dict.fromkeys(hash_ for _, _, hash_ in hash_rows if hash_ is not None)
+      rows.append((revision_id, hash_rows[-1][1], *_pack(hashes_)))
+
+    con.executemany(
+      'INSERT INTO revision_hashes '
+      '(revision_id, sequence, status, hash, rotation_hashes, fine_hashes) '
+      'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    con.execute(
+      'UPDATE hash_generation SET generation = '
+      'MAX(generation, (SELECT IFNULL(MAX(sequence), 0) FROM revision_hashes))')
+
+    #The views of the hashes are created again for the new table
+    con.execute('DROP VIEW IF EXISTS pending_hashes_view')
+    con.execute('DROP VIEW IF EXISTS reference_hashes_view')
+    con.execute('DROP TABLE hashes')
+
+  print(f'Hashes: {len(rows)} revisions converted to the compact layout')
+
+#Store the hashes of a given image revision
+#Parameters:
+# - revision_id: The id of the revision.
+# - hashes_: The hash of every rotation, starting with the reference one, along with its fine hash
+#   if calculated, or None if the file could not be hashed.
+def create(revision_id: int, hashes_: dict[int, bytes | None] | None) -> None:
   with db.get() as con:
-    con.execute(f'INSERT INTO hashes (revision_id, hash) VALUES (?, ?)', (revision_id, hash_))
+    con.execute(
+      'INSERT INTO revision_hashes '
+      '(revision_id, sequence, status, hash, rotation_hashes, fine_hashes) '
+      'VALUES (?, (SELECT generation + 1 FROM hash_generation), ?, ?, ?, ?)',
+      (revision_id, *_pack(hashes_ or {})))
+
+#Get all the hashes of a revision from its reference hash and packed rotation hashes
+def unpack(hash_: int, rotation_hashes: bytes | None) -> list[int]:
+  return [hash_, *array('q', rotation_hashes or b'')]
+
+#Get every hash of the revisions hashed after a given hash id, in the order they were created
+#Parameters:
+# - after_id: Only get the hashes with a larger hash id if given.
+# - con: The connection used for reading, if not the one of the current context (e.g. in background
+#   threads).
+#Return value: An iterator with the hash id, revision id and hash of every hash.
+def read_hashes(after_id: int = 0,
+                con: sqlite3.Connection | None = None) -> Iterator[tuple[int, int, int]]:
+  cursor = (con or db.get()).execute(
+    'SELECT sequence, revision_id, hash, rotation_hashes FROM revision_hashes '
+    'WHERE sequence > ? AND hash IS NOT NULL ORDER BY sequence', (after_id // MAX_HASHES,))
+
+  for sequence, revision_id, hash_, rotation_hashes in cursor:
+    for position, position_hash in enumerate(unpack(hash_, rotation_hashes)):
+      yield sequence * MAX_HASHES + position, revision_id, position_hash
+
+#Get the amount and revision id sum of the hashes up to a given hash id, or of all of them if not
+#given. Hashes are never modified, so these change if hashes up to that id are deleted.
+def read_summary(last_id: int | None = None) -> tuple[int, int]:
+  return db.get().execute(
+    'SELECT IFNULL(SUM(hash_count), 0), IFNULL(SUM(revision_id * hash_count), 0) FROM '
+      '(SELECT revision_id, 1 + IFNULL(LENGTH(rotation_hashes), 0) / 8 AS hash_count '
+      'FROM revision_hashes WHERE sequence <= IFNULL(?, sequence) AND hash IS NOT NULL)',
+    (None if last_id is None else last_id // MAX_HASHES,)).fetchone()
 
 #Get all image hashes that are within a maximum hamming distance from a given reference hash
-def search(ref_hash: int, max_dist: int) -> list[int]:
+#Parameters:
+# - ref_hash: The reference hash.
+# - max_dist: The maximum hamming distance.
+# - after_id: Only search the hashes with a larger hash id (i.e. created later) if given.
+#Return value: The ids of the matching revisions, which are only listed once.
+def search(ref_hash: int, max_dist: int, after_id: int = 0) -> list[int]:
   db.load_extension('hammdist')
   con = db.get()
 
   cursor = con.execute(
-    'SELECT revision_id FROM hashes WHERE hash IS NOT NULL AND HAMMDIST(?, hash) <= ?',
-    (ref_hash, max_dist))
+    'SELECT revision_id FROM revision_hashes '
+    'WHERE sequence > ? AND HAMMDIST(?, hash, rotation_hashes) <= ?',
+    (after_id // MAX_HASHES, ref_hash, max_dist))
 
   cursor.row_factory = lambda cur, row: row[0]
 
   return cursor.fetchall()
+
+#Get the revisions nearest to a reference hash within a maximum hamming distance. The database sorts
+#the matching revisions keeping only the nearest ones.
+#Parameters:
+# - ref_hash: The reference hash.
+# - max_dist: The maximum hamming distance.
+# - k: The maximum amount of revisions returned.
+#Return value: A list with the revision id and distance of up to k revisions, sorted by distance and
+#revision id. The distance of every revision is the one of its nearest hash.
+def search_nearest(ref_hash: int, max_dist: int, k: int) -> list[tuple[int, int]]:
+  db.load_extension('hammdist')
+  con = db.get()
+
+  return con.execute(
+    'SELECT revision_id, HAMMDIST(?, hash, rotation_hashes) AS distance FROM revision_hashes '
+    'WHERE distance <= ? ORDER BY distance, revision_id LIMIT ?',
+    (ref_hash, max_dist, k)).fetchall()
+
+#Get the distance of the nearest hash of every revision in a group to a reference hash
+#Return value: A dictionary with the distance by revision id. Revisions without hashes are left out.
+def read_distances(ref_hash: int, revision_ids: set[int]) -> dict[int, int]:
+  db.load_extension('hammdist')
+  con = db.get()
+
+  return dict(con.execute(
+    'SELECT revision_id, HAMMDIST(?, hash, rotation_hashes) FROM revision_hashes '
+    'WHERE revision_id IN (SELECT value FROM json_each(?)) AND hash IS NOT NULL',
+    (ref_hash, json.dumps(list(revision_ids)))))
+
+#Get the current hash generation
+def read_generation() -> int:
+  return db.get().execute('SELECT generation FROM hash_generation').fetchone()[0]
+
+#Get the amount, revision id sum and last sequence number of the hashed revisions. Hashes are never
+#modified, so these change whenever hashes are created or deleted.
+def read_key() -> list[int]:
+  return list(db.get().execute(
+    'SELECT COUNT(*), IFNULL(SUM(revision_id), 0), IFNULL(MAX(sequence), 0) FROM revision_hashes '
+    'WHERE hash IS NOT NULL').fetchone())
+
+#Get all image hashes that are within a maximum hamming distance from each of a group of reference
+#hashes. Reference hashes that are close to each other (e.g. revisions of the same image) are searched
+#together with a single table scan: if they are within a distance r of one of them, all their matches
+#are within max_dist + r of it, so those candidates are verified against each reference hash.
+#Parameters:
+# - ref_hashes: The reference hashes.
+# - max_dist: The maximum hamming distance.
+# - after_id: Only search the hashes with a larger hash id (i.e. created later) if given.
+#Return value: A list with the ids of the matching revisions for every reference hash, in the same
+#order.
+def search_many(ref_hashes: list[int], max_dist: int, after_id: int = 0) -> list[list[int]]:
+  db.load_extension('hammdist')
+  con = db.get()
+
+  result = [[] for _ in ref_hashes]
+  pending_indexes = list(range(len(ref_hashes)))
+  while pending_indexes:
+    #Group the pending reference hashes that are close to the first one
+    center_hash = ref_hashes[pending_indexes[0]]
+    group_dists = {index: _distance(center_hash, ref_hashes[index]) for index in pending_indexes}
+    group_indexes = [index for index, dist in group_dists.items() if dist <= GROUP_RADIUS]
+    pending_indexes = [index for index, dist in group_dists.items() if dist > GROUP_RADIUS]
+
+    cursor = con.execute(
+      'SELECT revision_id, hash, rotation_hashes FROM revision_hashes '
+      'WHERE sequence > ? AND HAMMDIST(?, hash, rotation_hashes) <= ?',
+      (after_id // MAX_HASHES, center_hash,
+       max_dist + max(group_dists[index] for index in group_indexes)))
+
+    for revision_id, hash_, rotation_hashes in cursor:
+      revision_hashes = unpack(hash_, rotation_hashes)
+      for index in group_indexes:
+        if any(_distance(ref_hashes[index], revision_hash) <= max_dist
+               for revision_hash in revision_hashes):
+          result[index].append(revision_id)
+
+  return result
+
+#Get the values of the columns that store the hashes of a revision
+#Return value: The status, reference hash, packed rotation hashes and packed fine hashes. The fine
+#hashes are only stored if every hash has one.
+def _pack(hashes_: dict[int, bytes | None]) -> tuple[int, int | None, bytes | None, bytes | None]:
+  if not hashes_:
+    return STATUS_UNSUPPORTED, None, None, None
+
+  hash_, *rotation_hashes = hashes_
+  fine_hashes = list(hashes_.values())
+
+  return STATUS_HASHED, hash_, array('q', rotation_hashes).tobytes() or None,\
+         b''.join(fine_hashes) if None not in fine_hashes else None
+
+#Get the hamming distance between two hashes
+def _distance(hash_a: int, hash_b: int) -> int:
+  return ((hash_a ^ hash_b) & ((1 << 64) - 1)).bit_count()
@@ -18,3 +18,21 @@ def write(user_id: int, image_id: int) -> None:
       'VALUES (:user_id, :image_id, :timestamp) '
       'ON CONFLICT (user_id) DO UPDATE SET image_id = :image_id, timestamp = :timestamp',
       { 'user_id': user_id, 'image_id': image_id, 'timestamp': int(time()) })
+
+#Concede an image to a given user unless it has been conceded to another user after a given time.
+#The check and the write are a single statement, so concurrent claims can't both succeed.
+#Return value: True if the image was conceded to the user.
+def claim(user_id: int, image_id: int, time_threshold: int) -> bool:
+  with db.get() as con:
+    #Wait for other writers before reading, as a deferred transaction could be refused the write
+    #lock right away to avoid a deadlock. Readers are only blocked while committing.
+    con.execute('BEGIN IMMEDIATE')
+
+    return con.execute(
+      'INSERT INTO image_concessions (user_id, image_id, timestamp) '
+      'SELECT :user_id, :image_id, :timestamp WHERE NOT EXISTS '
+        '(SELECT 1 FROM image_concessions '
+        'WHERE image_id = :image_id AND user_id <> :user_id AND timestamp > :time_threshold) '
+      'ON CONFLICT (user_id) DO UPDATE SET image_id = :image_id, timestamp = :timestamp',
+      { 'user_id': user_id, 'image_id': image_id, 'timestamp': int(time()),
+        'time_threshold': time_threshold }).rowcount == 1
@@ -0,0 +1,62 @@
+from collections.abc import Iterable, Iterator
+from modules.model import db
+
+#Schema initialization function
+@db.schema
+def init_schema() -> None:
+  con = db.get()
+
+  #This table mirrors the links from wiki pages to images, as reported by the mediawiki server. It
+  #refers to images by title, as pages may link to images that have not been indexed or uploaded yet.
+  con.execute(
+    'CREATE TABLE IF NOT EXISTS image_usage('
+      'image_title TEXT NOT NULL, '
+      'page_title TEXT NOT NULL, '
+      'UNIQUE (page_title, image_title))')
+
+  con.execute(
+    'CREATE INDEX IF NOT EXISTS image_usage_image_title ON image_usage(image_title)')
+
+#Delete all image usage information
+def clear() -> None:
+  with db.get() as con:
+    con.execute('DELETE FROM image_usage')
+
+#Register a group of image/page title pairs, each indicating that the page uses the image
+def add_many(usage: Iterable[tuple[str, str]]) -> None:
+  with db.get() as con:
+    con.executemany('INSERT OR IGNORE INTO image_usage (image_title, page_title) VALUES (?, ?)',
+                    usage)
+
+#Replace the images used by a group of pages
+#Parameters:
+# - page_images: A dictionary with page titles as keys and the titles of the images they use as
+#   values. Pages using no images (or missing pages) are given an empty list.
+def replace_page_images(page_images: dict[str, Iterable[str]]) -> None:
+  with db.get() as con:
+    for page_title, image_titles in page_images.items():
+      con.execute('DELETE FROM image_usage WHERE page_title = ?', (page_title,))
+      con.executemany('INSERT INTO image_usage (image_title, page_title) VALUES (?, ?)',
+                      ((image_title, page_title) for image_title in set(image_titles)))
+
+#Replace the pages that use a group of images
+#Parameters:
+# - image_pages: A dictionary with image titles as keys and the titles of the pages that use them as
+#   values.
+def replace_image_pages(image_pages: dict[str, Iterable[str]]) -> None:
+  with db.get() as con:
+    for image_title, page_titles in image_pages.items():
+      con.execute('DELETE FROM image_usage WHERE image_title = ?', (image_title,))
+      con.executemany('INSERT INTO image_usage (image_title, page_title) VALUES (?, ?)',
+                      ((image_title, page_title) for page_title in set(page_titles)))
+
+#Create an iterator object that returns the title of every indexed image that is not used by any
+#page
+def get_unused_titles() -> Iterator[str]:
+  cursor = db.get().execute(
+    'SELECT title FROM images WHERE NOT EXISTS '
+    '(SELECT 1 FROM image_usage WHERE image_usage.image_title = images.title)')
+
+  cursor.row_factory = lambda cur, row: row[0]
+
+  return cursor
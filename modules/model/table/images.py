@@ -60,3 +60,15 @@ def get_range(limit: int, offset: int, search_term: str) -> tuple[list[str], boo
 def delete(title: str) -> None:
   with db.get() as con:
     con.execute('DELETE FROM images WHERE title = ?', (title,))
+
+#Rename an image given its current and new titles, replacing any image that has the new title
+#already. Return true if the image was renamed.
+def rename(title: str, new_title: str) -> bool:
+  with db.get() as con:
+    if con.execute('SELECT 1 FROM images WHERE title = ?', (title,)).fetchone() is None:
+      return False
+
+    con.execute('DELETE FROM images WHERE title = ?', (new_title,))
+    con.execute('UPDATE images SET title = ? WHERE title = ?', (new_title, title))
+
+  return True
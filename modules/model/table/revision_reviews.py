@@ -14,6 +14,10 @@ def init_schema() -> None:
       'cleanup_reason_id INTEGER NOT NULL REFERENCES cleanup_reasons(id) ON DELETE CASCADE, '
       'UNIQUE (image_review_id, revision_id))')
 
+  #Used to find the revisions pending a review
+  con.execute(
+    'CREATE INDEX IF NOT EXISTS revision_reviews_revision_id ON revision_reviews(revision_id)')
+
   #These insert and update triggers are used to make sure that no revision review exists where the
   #referenced image review and the referenced revision refer to different images
   con.execute(
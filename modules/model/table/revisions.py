@@ -18,6 +18,14 @@ def init_schema() -> None:
   con.execute(
     'CREATE INDEX IF NOT EXISTS revisions_timestamp ON revisions(timestamp)')
 
+  #The tracking table for full synchronization processes is persistent (unlike the one used for
+  #partial synchronization processes) so that an interrupted process can be resumed later
+  con.execute(
+    'CREATE TABLE IF NOT EXISTS full_sync_revisions('
+      'image_id INTEGER NOT NULL, '
+      'timestamp TEXT NOT NULL, '
+      'UNIQUE (image_id, timestamp))')
+
 #Read the id of a revision given its image id and timestamp
 def read_id(image_id: int, timestamp: str) -> int | None:
   row = db.get().execute(
@@ -25,6 +33,10 @@ def read_id(image_id: int, timestamp: str) -> int | None:
     (image_id, timestamp)).fetchone()
   return None if row is None else row[0]
 
+#Check whether the table has no revisions at all
+def is_empty() -> bool:
+  return not db.get().execute('SELECT EXISTS (SELECT 1 FROM revisions)').fetchone()[0]
+
 #Obtain the latest timestamp in the table, if any
 def read_last_timestamp() -> str | None:
   row = db.get().execute(
@@ -36,17 +48,37 @@ def update_size(id_: int, size: int) -> None:
   with db.get() as con:
     con.execute('UPDATE revisions SET size = ? WHERE id = ?', (size, id_))
 
-#Start a full or partial synchronization process for the revisions table by creating a temporary
-#tracking table
-def synchronize_begin() -> None:
-  db.get().execute(
+#Start a full synchronization process for the revisions table. Unless resuming an interrupted
+#process, the persistent tracking table is cleared first.
+def full_synchronize_begin(resume: bool) -> None:
+  if not resume:
+    with db.get() as con:
+      con.execute('DELETE FROM full_sync_revisions')
+
+#Start a partial synchronization process for the revisions table by creating a temporary tracking
+#table (replacing the one left by a failed process, if any)
+def partial_synchronize_begin() -> None:
+  con = db.get()
+
+  con.execute('DROP TABLE IF EXISTS temp.updated_revisions')
+  con.execute(
     'CREATE TEMPORARY TABLE updated_revisions('
     'image_id INTEGER, '
     'timestamp TEXT)')
 
-#Attempt to create a revision with the given data during a full or partial synchronization process,
+#Attempt to create a revision with the given data during a full synchronization process, returning
+#true if it was created
+def full_synchronize_add_one(image_id: int, timestamp: str, url: str) -> bool:
+  return _synchronize_add_one('full_sync_revisions', image_id, timestamp, url)
+
+#Attempt to create a revision with the given data during a partial synchronization process,
+#returning true if it was created
+def partial_synchronize_add_one(image_id: int, timestamp: str, url: str) -> bool:
+  return _synchronize_add_one('updated_revisions', image_id, timestamp, url)
+
+#Attempt to create a revision with the given data, registering it in the given tracking table and
 #returning true if it was created
-def synchronize_add_one(image_id: int, timestamp: str, url: str) -> bool:
+def _synchronize_add_one(tracking_table: str, image_id: int, timestamp: str, url: str) -> bool:
   con = db.get()
 
   #Insert the revision only if it isn't in the table already
@@ -59,10 +91,12 @@ def synchronize_add_one(image_id: int, timestamp: str, url: str) -> bool:
   #Note: Table insertion order is important, as inserting into revisions first will cause other
   #restrictions such as foreign keys to be checked, causing an exception that skips the code below
 
-  #Insert into the tracking table as well
+  #Insert into the tracking table as well. Revisions may be tracked more than once when resuming a
+  #full synchronization process, so ignore duplicates.
   with con:
     con.execute(
-      'INSERT INTO updated_revisions (image_id, timestamp) VALUES (?, ?)', (image_id, timestamp))
+      f'INSERT OR IGNORE INTO {tracking_table} (image_id, timestamp) VALUES (?, ?)',
+      (image_id, timestamp))
 
   #Return true if revision was inserted (did not fail the unique constraint check)
   return cursor.rowcount == 1
@@ -73,7 +107,7 @@ def full_synchronize_get_deletions() -> Iterator[tuple[int, str]]:
   cursor = db.get().cursor()
   cursor.execute(
     'SELECT image_id, timestamp FROM revisions WHERE (image_id, timestamp) NOT IN '
-    '(SELECT image_id, timestamp FROM updated_revisions)')
+    '(SELECT image_id, timestamp FROM full_sync_revisions)')
 
   while True:
     row = cursor.fetchone()
@@ -97,16 +131,13 @@ def partial_synchronize_get_deletions() -> Iterator[tuple[int, str]]:
     yield row
 
 #End a full synchronization process for the revisions table by deleting all revisions that are not
-#in the tracking table
+#in the tracking table, then clearing it
 def full_synchronize_end() -> None:
-  con = db.get()
-
-  with con:
+  with db.get() as con:
     con.execute(
       'DELETE FROM revisions WHERE (image_id, timestamp) NOT IN '
-      '(SELECT image_id, timestamp FROM updated_revisions)')
-
-  con.execute('DROP TABLE updated_revisions')
+      '(SELECT image_id, timestamp FROM full_sync_revisions)')
+    con.execute('DELETE FROM full_sync_revisions')
 
 #End a partial synchronization process for the revisions table by deleting all revisions of the
 #images that have an image id but are lacking a timestamp in the tracking table
@@ -0,0 +1,28 @@
+import json
+from modules.model import db
+
+#Schema initialization function
+@db.schema
+def init_schema() -> None:
+  db.get().execute(
+    'CREATE TABLE IF NOT EXISTS sync_state('
+      'name TEXT PRIMARY KEY, '
+      'value TEXT NOT NULL)')
+
+#Read the value of a named synchronization state entry, decoded from JSON
+def read(name: str) -> any:
+  row = db.get().execute('SELECT value FROM sync_state WHERE name = ?', (name,)).fetchone()
+  return None if row is None else json.loads(row[0])
+
+#Create or update a named synchronization state entry, encoding its value as JSON
+def write(name: str, value: any) -> None:
+  with db.get() as con:
+    con.execute(
+      'INSERT INTO sync_state (name, value) VALUES (:name, :value) '
+      'ON CONFLICT (name) DO UPDATE SET value = :value',
+      { 'name': name, 'value': json.dumps(value) })
+
+#Delete a named synchronization state entry
+def delete(name: str) -> None:
+  with db.get() as con:
+    con.execute('DELETE FROM sync_state WHERE name = ?', (name,))
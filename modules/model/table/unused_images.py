@@ -13,9 +13,13 @@ def exists(title: str) -> bool:
   return bool(db.get().execute(
     'SELECT EXISTS (SELECT 1 FROM unused_images WHERE title = ?)', (title,)).fetchone()[0])
 
-#Create a scratch table for registering new unused images
+#Create a scratch table for registering new unused images (replacing the one left by a failed
+#synchronization, if any)
 def synchronize_begin() -> None:
-  db.get().execute(
+  con = db.get()
+
+  con.execute('DROP TABLE IF EXISTS temp.new_unused_images')
+  con.execute(
     'CREATE TEMPORARY TABLE new_unused_images('
       'title TEXT UNIQUE NOT NULL)')
 
@@ -25,9 +29,15 @@ def synchronize_add_many(titles: Iterable[str]) -> None:
     con.executemany('INSERT INTO new_unused_images (title) VALUES (?)',
                     ((t,) for t in titles))
 
-#Update the unused_images table using the scratch table
-def synchronize_end() -> None:
+#Update the unused_images table using the scratch table by applying only the differences between
+#them, returning the count of added and removed titles
+def synchronize_end() -> tuple[int, int]:
   with db.get() as con:
-    con.execute('DELETE FROM unused_images')
-    con.execute('INSERT INTO unused_images (title) SELECT title FROM new_unused_images')
+    removed_count = con.execute(
+      'DELETE FROM unused_images WHERE title NOT IN (SELECT title FROM new_unused_images)').rowcount
+    added_count = con.execute(
+      'INSERT INTO unused_images (title) SELECT title FROM new_unused_images '
+      'WHERE title NOT IN (SELECT title FROM unused_images)').rowcount
     con.execute('DROP TABLE new_unused_images')
+
+  return added_count, removed_count
@@ -8,17 +8,18 @@ def init_schema() -> None:
   db.get().execute(
     'CREATE VIEW IF NOT EXISTS pending_hashes_view(revision_id, revision_url) AS '
     'SELECT revisions.id, revisions.url FROM revisions WHERE revisions.id NOT IN '
-    '(SELECT hashes.revision_id FROM hashes)')
+    '(SELECT revision_hashes.revision_id FROM revision_hashes)')
 
 #Return the count of revisions that haven't been hashed yet
 def total() -> int:
   return db.get().execute('SELECT COUNT(*) FROM pending_hashes_view').fetchone()[0]
 
-#Create an iterator object that returns the id and url of every revision that hasn't been hashed yet
-def get() -> Iterator[tuple[int, str]]:
+#Create an iterator object that returns the id and url of every revision that hasn't been hashed yet,
+#optionally starting after a given revision id
+def get(after_id: int = -1) -> Iterator[tuple[int, str]]:
   con = db.get()
 
-  last_id = -1
+  last_id = after_id
   while True:
     row = con.execute(
       'SELECT revision_id, revision_url FROM pending_hashes_view WHERE revision_id > ? '
@@ -1,72 +1,315 @@
+import json, time
 from modules.model import db
-from modules.model.table import hashes, unused_images
-from modules.model.view import image_revisions, review_details
+from modules.model.hash_index import engine, similar_pairs, hub_hashes, fine_hashes,\
+                                     result_cache
 
 #Schema initialization function
 @db.schema
 def init_schema() -> None:
-  #This view allows to query for the timestamp and one of the hashes for each revision of a specific
-  #image
+  #This view allows to query for the timestamp and the reference hash for each revision of a
+  #specific image
   db.get().execute(
     'CREATE VIEW IF NOT EXISTS '
     'reference_hashes_view(image_id, revision_timestamp, hash) AS '
-    'SELECT image_id, timestamp, hash FROM '
-      '(SELECT revisions.image_id, revisions.timestamp, hashes.hash, '
-      'ROW_NUMBER() OVER (PARTITION BY revisions.id) AS row_num FROM revisions '
-      'INNER JOIN hashes ON revisions.id = hashes.revision_id)'
-    'WHERE row_num = 1')
+    'SELECT revisions.image_id, revisions.timestamp, revision_hashes.hash FROM revisions '
+    'INNER JOIN revision_hashes ON revisions.id = revision_hashes.revision_id')
 
 #Perform a search for revisions that are similar to the revisions of a given image, within a maximum
-#hamming distance
+#hamming distance. Matches are re-ranked with the fine hashes if available. Revisions with a hub
+#hash (similar to a crowd of revisions) only get their nearest matches, while the rest can be
+#obtained page by page with search_page.
+#The revisions of the reference image are searched from newest to oldest until a deadline, then the
+#search can be continued from the returned cursor. The revisions searched so far are kept in the
+#result cache, so continuing searches (of any user) don't search them again.
 #Parameters:
 # - ref_image_id: The id of the reference image.
 # - max_dist: The maximum allowed hamming distance. Image hashes farther than this are excluded.
-#Return value: A nested dictionary that encodes matching images with the following structure:
-#   Search results
-#   <dict>
-#     - key: {Timestamp of the revision of the reference image}
-#       <dict>
-#       - key: {Title of the matching image}
+# - hub_limit: The maximum amount of matching revisions for revisions with a hub hash.
+# - deadline: The time (as returned by time.monotonic) after which no more revisions are searched.
+#   At least some revisions are always searched, unless there are none left.
+# - cursor: The cursor returned by a previous search, to continue it, or None to start a new one.
+#Return value: A tuple with three elements:
+# - A nested dictionary that encodes matching images with the following structure:
+#     Search results
+#     <dict>
+#       - key: {Timestamp of the revision of the reference image}
 #         <dict>
-#         - key: 'unused'
-#           <bool> - a flag indicating whether the image is unused in the wiki
-#         - key: 'revisions'
-#           <list[str]> - the timestamps of all matching revisions
-def search(ref_image_id: int, max_dist: int) -> dict[str, dict[str, dict[str, bool | list[str]]]]:
-  con = db.get()
+#         - key: {Title of the matching image}
+#           <dict>
+#           - key: 'unused'
+#             <bool> - a flag indicating whether the image is unused in the wiki
+#           - key: 'reviewed'
+#             <bool> - a flag indicating whether the image has been reviewed
+#           - key: 'revisions'
+#             <list[str]> - the timestamps of all matching revisions
+# - A dictionary with a summary for every revision of the reference image with a hub hash, by
+#   timestamp, with the following keys:
+#   - 'neighbor_count': The amount of revisions similar to the hash when hub hashes were computed.
+#   - 'offset': The amount of matching revisions included, which is where the next page starts.
+#   - 'more_results': Whether there are more matching revisions.
+# - The cursor for continuing the search (the timestamp of the last revision searched), or None if
+#   every revision has been searched.
+def search(ref_image_id: int, max_dist: int, hub_limit: int, deadline: float,
+           cursor: str | None = None) -> tuple[dict[str, dict[str, dict[str, bool | list[str]]]],
+                                               dict[str, dict[str, int | bool]], str | None]:
+  #Get the matching revisions of the revisions of the reference image searched so far, including
+  #the ones searched by previous calls, which are kept in the result cache until the hashes change
+  progress = _search_revisions_until(ref_image_id, max_dist, hub_limit, deadline, cursor)
 
-  #Obtain the timestamp and a reference hash for each of the revisions of the given image (every
-  #revision can have up to 4 hashes - one per rotation, but any one will do)
-  ref_hash_cursor = con.execute(
-    'SELECT revision_timestamp, hash FROM reference_hashes_view WHERE image_id = ?',
-    (ref_image_id,))
+  #Leave out the revisions returned before
+  ref_matches = [ref_match for ref_match in progress['ref_matches']
+                 if cursor is None or ref_match[0] < cursor]
+  hub_matches = [hub_match for hub_match in progress['hub_matches']
+                 if cursor is None or hub_match[0] < cursor]
+
+  #Look up the information of all the matching revisions at once. Revisions that don't exist anymore
+  #are missing from it (search engines may lag behind deletions).
+  match_info = _read_match_info({match_revision_id
+                                 for _, match_revision_ids, *_ in ref_matches + hub_matches
+                                 for match_revision_id in match_revision_ids})
 
   result = {}
-  for ref_revision_timestamp, ref_hash in ref_hash_cursor:
-    #Make sure the image is hashed (e.g. not an unsupported file type)
-    if ref_hash is None:
-      continue
+  for ref_revision_timestamp, match_revision_ids in ref_matches:
+    result[ref_revision_timestamp] = {}
+    _add_matches(result[ref_revision_timestamp], ref_image_id, match_revision_ids, match_info)
 
-    #Perform a search for the reference hash and iterate over the results
+  hubs = {}
+  for ref_revision_timestamp, match_revision_ids, neighbor_count in hub_matches:
+    match_revision_ids = _remove_ref_image(ref_image_id, match_revision_ids, match_info)
     result[ref_revision_timestamp] = {}
-    for match_revision_id in hashes.search(ref_hash, max_dist):
-      #Look up the image and timestamp that correspond to the revision that was just found
-      match_image_id, match_image_title, match_rev_timestamp =\
-        image_revisions.get_revision_info(match_revision_id)
-
-      #Make sure this is different from the reference image, which is identical to itself
-      if match_image_id == ref_image_id:
-        continue
-
-      #Add a dictionary for the matching image if not already present
-      if match_image_title not in result[ref_revision_timestamp]:
-        result[ref_revision_timestamp][match_image_title] = {
-          'unused': unused_images.exists(match_image_title),
-          'reviewed': review_details.exists(match_image_title),
-          'revisions': [],
-        }
-
-      #Lastly, append the matching revision timestamp
-      result[ref_revision_timestamp][match_image_title]['revisions'].append(match_rev_timestamp)
-
-  return result
+    _add_matches(result[ref_revision_timestamp], ref_image_id, match_revision_ids[:hub_limit],
+                 match_info)
+    hubs[ref_revision_timestamp] = {
+      'neighbor_count': neighbor_count,
+      'offset': len(match_revision_ids[:hub_limit]),
+      'more_results': len(match_revision_ids) > hub_limit,
+    }
+
+  return result, hubs, None if progress['complete'] else progress['cursor']
+
+#Search the revisions of an image from newest to oldest until a deadline, with the same parameters
+#as the search function. The progress is continued from the result cache if it has reached the
+#cursor, and stored there afterwards. Otherwise (e.g. after the hashes changed), the search starts
+#at the cursor, and its progress is stored apart, so the next requests of the same search continue
+#it without replacing the progress from the first revision.
+#Return value: A dictionary with the following keys:
+# - 'ref_matches', 'hub_matches': The matches of the revisions searched, as returned by
+#   _search_revisions.
+# - 'start': The cursor the search started at, or None if it started at the first revision.
+# - 'cursor': The timestamp of the last revision searched, or None if none.
+# - 'complete': Whether every revision has been searched.
+def _search_revisions_until(ref_image_id: int, max_dist: int, hub_limit: int, deadline: float,
+                            cursor: str | None) -> dict[str, any]:
+  #Searches made with other hub hashes may have split the revisions differently
+  cache_params = [max_dist, hub_limit, hub_hashes.read_version()]
+  generation, progress = result_cache.read(ref_image_id, cache_params)
+
+  if progress is None:
+    progress = { 'ref_matches': [], 'hub_matches': [], 'start': None, 'cursor': None,
+                 'complete': False }
+
+  if not _has_reached(progress, cursor):
+    cache_params = cache_params + ['partial']
+    generation, progress = result_cache.read(ref_image_id, cache_params)
+
+    if progress is None or not _has_reached(progress, cursor):
+      progress = { 'ref_matches': [], 'hub_matches': [], 'start': cursor, 'cursor': cursor,
+                   'complete': False }
+
+  if progress['complete']:
+    return progress
+
+  #Obtain the timestamp and a reference hash for each of the revisions of the given image (every
+  #revision can have up to 4 hashes - one per rotation, but any one will do) that haven't been
+  #searched yet. Revisions that aren't hashed (e.g. unsupported file types) are skipped.
+  ref_revisions = db.get().execute(
+    'SELECT revision_timestamp, hash FROM reference_hashes_view '
+    'WHERE image_id = :image_id AND hash IS NOT NULL AND '
+    '(:cursor IS NULL OR revision_timestamp < :cursor) ORDER BY revision_timestamp DESC',
+    { 'image_id': ref_image_id, 'cursor': progress['cursor'] }).fetchall()
+
+  #Search the revisions in groups that double in size every time, so images with few revisions are
+  #searched at once, and the deadline is checked more often at first. The progress is copied, as
+  #cached results can't be modified.
+  progress = dict(progress, ref_matches = list(progress['ref_matches']),
+                  hub_matches = list(progress['hub_matches']))
+  group_size = 1
+  while ref_revisions:
+    group = ref_revisions[:group_size]
+    ref_revisions = ref_revisions[group_size:]
+
+    ref_matches, hub_matches = _search_revisions(ref_image_id, max_dist, hub_limit, group)
+    progress['ref_matches'] += ref_matches
+    progress['hub_matches'] += hub_matches
+    progress['cursor'] = group[-1][0]
+
+    if time.monotonic() >= deadline:
+      break
+
+    group_size *= 2
+
+  progress['complete'] = not ref_revisions
+
+  result_cache.write(ref_image_id, cache_params, generation, progress)
+
+  return progress
+
+#Check whether the progress of a search covers every revision up to a cursor, so it can be continued
+#from there (the progress of searches cached before it was recorded always starts at the first
+#revision)
+def _has_reached(progress: dict[str, any], cursor: str | None) -> bool:
+  start = progress.get('start')
+  if cursor is None:
+    return start is None
+
+  return (start is None or start >= cursor) and\
+         (progress['complete'] or (progress['cursor'] is not None and progress['cursor'] <= cursor))
+
+#Search for the revisions that are similar to a group of revisions of a given image, with the same
+#parameters as the search function
+#Parameters:
+# - ref_revisions: The timestamp and reference hash of every revision of the image searched.
+#Return value: A tuple with two lists:
+# - The timestamp and the matching revision ids of every revision of the reference image without a
+#   hub hash.
+# - The timestamp, the ids of the nearest matching revisions (which may include the reference image)
+#   and the neighbor count of every revision of the reference image with a hub hash.
+def _search_revisions(ref_image_id: int, max_dist: int, hub_limit: int,
+                      ref_revisions: list[tuple[str, int]]) ->\
+  tuple[list[list[str | list[int]]], list[list[str | list[int] | int]]]:
+  #Set the revisions with a hub hash apart
+  neighbor_counts = hub_hashes.read_counts([ref_hash for _, ref_hash in ref_revisions], max_dist)
+  hub_revisions = [(ref_revision_timestamp, ref_hash)
+                   for ref_revision_timestamp, ref_hash in ref_revisions
+                   if ref_hash in neighbor_counts]
+  ref_revisions = [(ref_revision_timestamp, ref_hash)
+                   for ref_revision_timestamp, ref_hash in ref_revisions
+                   if ref_hash not in neighbor_counts]
+
+  #Read the precomputed matches if available, otherwise search for all the reference hashes at once
+  if similar_pairs.available(max_dist):
+    matches_by_timestamp = similar_pairs.search_image(ref_image_id, max_dist)
+    ref_matches = [matches_by_timestamp.get(ref_revision_timestamp, [])
+                   for ref_revision_timestamp, _ in ref_revisions]
+  else:
+    ref_matches = engine.search_many([ref_hash for _, ref_hash in ref_revisions], max_dist)
+
+  #Re-rank the matches of the revisions with a fine hash, dropping false positives and sorting the
+  #rest by similarity
+  ref_fine_hashes = fine_hashes.read_references(ref_image_id, ref_revisions)
+  ref_matches = [fine_hashes.rerank(ref_fine_hashes[ref_revision_timestamp], match_revision_ids)
+                 if ref_revision_timestamp in ref_fine_hashes else match_revision_ids
+                 for (ref_revision_timestamp, _), match_revision_ids in zip(ref_revisions,
+                                                                             ref_matches)]
+
+  #Only get the nearest matches of the revisions with a hub hash. The revisions of the reference
+  #image are left out afterwards, so as many more are requested, plus one to tell if more follow.
+  hub_matches = []
+  if hub_revisions:
+    nearest_count = hub_limit + _count_revisions(ref_image_id) + 1
+    hub_matches = [[ref_revision_timestamp,
+                    _search_nearest(ref_image_id, ref_revision_timestamp, ref_hash, max_dist,
+                                    nearest_count),
+                    neighbor_counts[ref_hash]]
+                   for ref_revision_timestamp, ref_hash in hub_revisions]
+
+  return [[ref_revision_timestamp, match_revision_ids]
+          for (ref_revision_timestamp, _), match_revision_ids in zip(ref_revisions,
+                                                                      ref_matches)], hub_matches
+
+#Get a page of the revisions that are similar to a revision of a given image, nearest first
+#Parameters:
+# - ref_image_id: The id of the reference image.
+# - ref_revision_timestamp: The timestamp of the reference revision.
+# - max_dist: The maximum allowed hamming distance.
+# - limit: The maximum amount of matching revisions in the page.
+# - offset: The amount of nearer matching revisions skipped.
+#Return value: A tuple with a dictionary that encodes the matching images like every revision of the
+#search function results, and a flag indicating whether more matching revisions follow.
+def search_page(ref_image_id: int, ref_revision_timestamp: str, max_dist: int, limit: int,
+                offset: int) -> tuple[dict[str, dict[str, bool | list[str]]], bool]:
+  ref_revision = db.get().execute(
+    'SELECT hash FROM reference_hashes_view '
+    'WHERE image_id = ? AND revision_timestamp = ? AND hash IS NOT NULL',
+    (ref_image_id, ref_revision_timestamp)).fetchone()
+
+  if ref_revision is None:
+    return {}, False
+
+  match_revision_ids = _search_nearest(ref_image_id, ref_revision_timestamp, ref_revision[0],
+                                       max_dist,
+                                       offset + limit + _count_revisions(ref_image_id) + 1)
+  match_info = _read_match_info(set(match_revision_ids))
+  match_revision_ids = _remove_ref_image(ref_image_id, match_revision_ids, match_info)
+
+  matches = {}
+  _add_matches(matches, ref_image_id, match_revision_ids[offset:offset + limit], match_info)
+
+  return matches, len(match_revision_ids) > offset + limit
+
+#Get the ids of the k revisions nearest to a revision of an image, nearest first
+def _search_nearest(ref_image_id: int, ref_revision_timestamp: str, ref_hash: int, max_dist: int,
+                    k: int) -> list[int]:
+  if similar_pairs.available(max_dist):
+    nearest = similar_pairs.search_nearest(ref_image_id, ref_revision_timestamp, max_dist, k)
+  else:
+    nearest = engine.search_nearest(ref_hash, max_dist, k)
+
+  return [revision_id for revision_id, _ in nearest]
+
+#Get the amount of revisions of an image
+def _count_revisions(image_id: int) -> int:
+  return db.get().execute(
+    'SELECT COUNT(*) FROM revisions WHERE image_id = ?', (image_id,)).fetchone()[0]
+
+#Remove the revisions of the reference image and the ones that don't exist anymore from a list of
+#matching revision ids
+def _remove_ref_image(ref_image_id: int, match_revision_ids: list[int],
+                      match_info: dict[int, tuple[int, str, str, bool, bool]]) -> list[int]:
+  return [match_revision_id for match_revision_id in match_revision_ids
+          if match_revision_id in match_info and match_info[match_revision_id][0] != ref_image_id]
+
+#Add a group of matching revisions to the matching images of a reference revision
+def _add_matches(matches: dict[str, dict[str, bool | list[str]]], ref_image_id: int,
+                 match_revision_ids: list[int],
+                 match_info: dict[int, tuple[int, str, str, bool, bool]]) -> None:
+  for match_revision_id in match_revision_ids:
+    if match_revision_id not in match_info:
+      continue
+
+    match_image_id, match_image_title, match_rev_timestamp, match_unused, match_reviewed =\
+      match_info[match_revision_id]
+
+    #Make sure this is different from the reference image, which is identical to itself
+    if match_image_id == ref_image_id:
+      continue
+
+    #Add a dictionary for the matching image if not already present
+    if match_image_title not in matches:
+      matches[match_image_title] = {
+        'unused': match_unused,
+        'reviewed': match_reviewed,
+        'revisions': [],
+      }
+
+    #Lastly, append the matching revision timestamp
+    matches[match_image_title]['revisions'].append(match_rev_timestamp)
+
+#Read the image id, image title, timestamp and the unused and reviewed flags of the image of a group
+#of revisions with a single query, returning them in a dictionary by revision id
+def _read_match_info(revision_ids: set[int]) -> dict[int, tuple[int, str, str, bool, bool]]:
+  if not revision_ids:
+    return {}
+
+  cursor = db.get().execute(
+    'SELECT revisions.id, images.id, images.title, revisions.timestamp, '
+    'EXISTS (SELECT 1 FROM unused_images WHERE unused_images.title = images.title), '
+    'EXISTS (SELECT 1 FROM image_reviews INNER JOIN users ON image_reviews.user_id = users.id '
+      'WHERE image_reviews.image_id = images.id) '
+    'FROM json_each(?) AS matches '
+    'INNER JOIN revisions ON revisions.id = matches.value '
+    'INNER JOIN images ON images.id = revisions.image_id',
+    (json.dumps(list(revision_ids)),))
+
+  return {revision_id: (image_id, image_title, timestamp, bool(unused), bool(reviewed))
+          for revision_id, image_id, image_title, timestamp, unused, reviewed in cursor}
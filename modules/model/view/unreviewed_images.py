@@ -8,6 +8,30 @@ class Category(enum.Enum):
   used_img_all_rev       = 'unreviewed_used_images_by_size_of_all_revs_view'
   used_img_all_rev_count = 'unreviewed_used_images_by_count_of_all_revs_view'
 
+#Filter condition and sort key column of the images of every category in the review queue. Sort keys
+#are negated, so the largest images come first when sorting in ascending order (along with the image
+#id), and unknown sizes are replaced with 1, so they come last like in the views.
+QUEUE_KEYS = {
+  Category.unused_img_all_rev:     ('unused', 'size_key'),
+  Category.used_img_old_rev:       ('NOT unused AND old_size_key IS NOT NULL', 'old_size_key'),
+  Category.used_img_all_rev:       ('NOT unused', 'size_key'),
+  Category.used_img_all_rev_count: ('NOT unused', 'count_key'),
+}
+
+#Query that gets the review queue rows of the images matching a condition, which can be used in
+#triggers
+_SELECT_QUEUE_ROWS = \
+  'SELECT images.id, images.title IN (SELECT title FROM unused_images), ' \
+  'IFNULL(-SUM(revisions.size), 1), ' \
+  'CASE WHEN COUNT(*) >= 2 THEN IFNULL(-SUM(revisions.size) FILTER (WHERE revisions.timestamp < ' \
+    '(SELECT MAX(timestamp) FROM revisions AS last_revisions ' \
+    'WHERE last_revisions.image_id = images.id)), 1) END, ' \
+  '-COUNT(*) ' \
+  'FROM images INNER JOIN revisions ON images.id = revisions.image_id ' \
+  'WHERE {condition} GROUP BY images.id ' \
+  'HAVING SUM(NOT EXISTS ' \
+    '(SELECT 1 FROM revision_reviews WHERE revision_reviews.revision_id = revisions.id)) > 0'
+
 #Schema initialization function
 @db.schema
 def init_schema() -> None:
@@ -66,13 +90,62 @@ def init_schema() -> None:
     'WHERE image_title NOT IN (SELECT title FROM unused_images) '
     'GROUP BY image_id')
 
+  #The review queue materializes the views above, so images are dealt and listed without grouping
+  #every unreviewed revision. Every image pending a review has a row with its sort key in every
+  #category, kept up to date by the triggers below. The old revisions size key is null if the image
+  #has a single revision.
+  created = con.execute(
+    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'review_queue'").fetchone() is None
+
+  con.execute(
+    'CREATE TABLE IF NOT EXISTS review_queue('
+      'image_id INTEGER PRIMARY KEY REFERENCES images(id) ON DELETE CASCADE, '
+      'unused INTEGER NOT NULL, '
+      'size_key INTEGER NOT NULL, '
+      'old_size_key INTEGER, '
+      'count_key INTEGER NOT NULL)')
+
+  #Every category has a partial index in its order, so finding the next image is a single seek. The
+  #queries must use the exact same conditions for the indexes to be used.
+  for category, (condition, key) in QUEUE_KEYS.items():
+    con.execute(
+      f'CREATE INDEX IF NOT EXISTS review_queue_{category.name} '
+      f'ON review_queue({key}, image_id) WHERE {condition}')
+
+  if created:
+    with con:
+      con.execute(f'INSERT INTO review_queue {_SELECT_QUEUE_ROWS.format(condition = 'TRUE')}')
+
+  #Refresh the row of the image affected by every change to the revisions, their sizes, their
+  #reviews, the unused images and the image titles
+  for name, event, image_id in (
+    ('revisions_insert', 'AFTER INSERT ON revisions', 'NEW.image_id'),
+    ('revisions_delete', 'AFTER DELETE ON revisions', 'OLD.image_id'),
+    ('revisions_update', 'AFTER UPDATE OF size ON revisions', 'NEW.image_id'),
+    ('revision_reviews_insert', 'AFTER INSERT ON revision_reviews',
+     '(SELECT image_id FROM revisions WHERE id = NEW.revision_id)'),
+    ('revision_reviews_delete', 'AFTER DELETE ON revision_reviews',
+     '(SELECT image_id FROM revisions WHERE id = OLD.revision_id)'),
+    ('unused_images_insert', 'AFTER INSERT ON unused_images',
+     '(SELECT id FROM images WHERE title = NEW.title)'),
+    ('unused_images_delete', 'AFTER DELETE ON unused_images',
+     '(SELECT id FROM images WHERE title = OLD.title)'),
+    ('images_update', 'AFTER UPDATE OF title ON images', 'NEW.id')):
+    con.execute(
+      f'CREATE TRIGGER IF NOT EXISTS review_queue_{name} {event} BEGIN '
+      f'DELETE FROM review_queue WHERE image_id = {image_id}; '
+      f'INSERT INTO review_queue '
+        f'{_SELECT_QUEUE_ROWS.format(condition = f'images.id = {image_id}')}; '
+      f'END')
+
 #Get image titles in a given range and category
 def get_range(limit: int, offset: int, category: Category):
   #Request the titles matching the provided category for the specified range, but request one
   #additional row to confirm that more rows follow
+  condition, key = QUEUE_KEYS[category]
   cursor = db.get().execute(
-    f'SELECT image_title FROM {category.value} '
-    f'ORDER BY row_num LIMIT ? OFFSET ?', (limit + 1, offset))
+    f'SELECT images.title FROM review_queue INNER JOIN images ON images.id = review_queue.image_id '
+    f'WHERE {condition} ORDER BY {key}, image_id LIMIT ? OFFSET ?', (limit + 1, offset))
 
   cursor.row_factory = lambda cur, row: row[0]
 
@@ -88,9 +161,9 @@ def get_range(limit: int, offset: int, category: Category):
 def get_totals():
   cursor = db.get().execute(
     'SELECT '
-      '(SELECT COUNT(*) FROM unreviewed_unused_images_by_size_of_all_revs_view), '
-      '(SELECT COUNT(*) FROM unreviewed_used_images_by_size_of_old_revs_view), '
-      '(SELECT COUNT(*) FROM unreviewed_used_images_by_size_of_all_revs_view), '
+      f'(SELECT COUNT(*) FROM review_queue WHERE {QUEUE_KEYS[Category.unused_img_all_rev][0]}), '
+      f'(SELECT COUNT(*) FROM review_queue WHERE {QUEUE_KEYS[Category.used_img_old_rev][0]}), '
+      f'(SELECT COUNT(*) FROM review_queue WHERE {QUEUE_KEYS[Category.used_img_all_rev][0]}), '
       '(SELECT COUNT(*) FROM images WHERE title IN (SELECT title FROM unused_images)), '
       '(SELECT COUNT(*) FROM '
         '(SELECT 1 FROM images INNER JOIN revisions ON images.id = revisions.image_id '
@@ -98,9 +171,9 @@ def get_totals():
         'GROUP BY images.id HAVING COUNT(*) >= 2)), '
       '(SELECT COUNT(*) FROM images WHERE title NOT IN (SELECT title FROM unused_images))')
 
-  #Note: The view called unreviewed_used_images_by_size_of_all_revs_view refers to the exact same
-  #set as unreviewed_used_images_by_count_of_all_revs_view, with the only difference being their
-  #ordering scheme. Therefore only the count of one of the sets is calculated.
+  #Note: The used_img_all_rev category refers to the exact same set as used_img_all_rev_count, with
+  #the only difference being their ordering scheme. Therefore only the count of one of the sets is
+  #calculated.
 
   cursor.row_factory = lambda cur, row: {
     'unused_images': {
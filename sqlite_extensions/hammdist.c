@@ -1,19 +1,846 @@
 #include <sqlite3ext.h>
 SQLITE_EXTENSION_INIT1
+#include <stdlib.h>
+#include <string.h>
+#if defined(__x86_64__) && defined(__GNUC__)
+#include <immintrin.h>
+#define HAMMSCAN_X86 1
+#endif
 
 //Calculate the hamming distance between two 64-bit numbers. This implementation is intentionally
 //small with the intention to be fast and is aimed at numbers stored in the native 64-bit format.
 //The calculation works by obtaining the bits that are different using an XOR mask and then counting
 //the bits that are set using one of the GCC's built-in "popcount" (population count) functions.
 //The intrinsic uses the POPCNT instruction of the x86 processors, which is inherently fast.
+//A third argument can provide a packed BLOB of additional 64-bit hashes (in native byte order) to
+//compare with the first number, such as the rotation hashes of a revision, in which case the
+//minimum distance is returned. The result is NULL if the second number is NULL.
 void hammdist(sqlite3_context *context, int argc, sqlite3_value **argv) {
   sqlite3_int64 a = sqlite3_value_int64(argv[0]);
   sqlite3_int64 b = sqlite3_value_int64(argv[1]);
-  sqlite3_result_int64(context, __builtin_popcountll(a ^ b));
+  int dist = __builtin_popcountll(a ^ b);
+
+  if (argc == 3) {
+    if (sqlite3_value_type(argv[1]) == SQLITE_NULL) return;
+
+    //The additional hashes are copied one by one, since the BLOB may not be aligned
+    const unsigned char *packed = sqlite3_value_blob(argv[2]);
+    int packed_size = sqlite3_value_bytes(argv[2]);
+    for (int offset = 0; offset + sizeof(sqlite3_int64) <= packed_size;
+         offset += sizeof(sqlite3_int64)) {
+      sqlite3_int64 c;
+      memcpy(&c, packed + offset, sizeof(c));
+      int packed_dist = __builtin_popcountll(a ^ c);
+      if (packed_dist < dist) dist = packed_dist;
+    }
+  }
+
+  sqlite3_result_int64(context, dist);
+}
+
+//Find the offsets of the hashes within a maximum hamming distance of a query hash in an array of
+//hashes, storing them in the offsets array (which must fit all the hashes). Variants for different
+//instruction sets are provided, the best one is selected when loading the extension.
+//Return value: The amount of offsets found.
+typedef int (*hammscan_impl)(const sqlite3_int64 *hashes, int count, sqlite3_int64 query,
+                             int max_dist, int *offsets);
+
+//Generic variant, which relies on the compiler's popcount implementation
+static int hammscan_generic(const sqlite3_int64 *hashes, int count, sqlite3_int64 query,
+                            int max_dist, int *offsets) {
+  int found = 0;
+  for (int i = 0; i < count; i++) {
+    if (__builtin_popcountll(hashes[i] ^ query) <= max_dist) offsets[found++] = i;
+  }
+  return found;
+}
+
+#ifdef HAMMSCAN_X86
+//Variant that uses the POPCNT instruction, for processors without AVX2
+__attribute__((target("popcnt")))
+static int hammscan_popcnt(const sqlite3_int64 *hashes, int count, sqlite3_int64 query,
+                           int max_dist, int *offsets) {
+  int found = 0;
+  for (int i = 0; i < count; i++) {
+    if (__builtin_popcountll(hashes[i] ^ query) <= max_dist) offsets[found++] = i;
+  }
+  return found;
+}
+
+//Variant that compares 4 hashes at once using AVX2 instructions. Bits are counted per nibble with a
+//shuffle-based lookup table, and the nibble counts of every 64-bit lane are added together with
+//a sum of absolute differences against zero.
+__attribute__((target("avx2,popcnt")))
+static int hammscan_avx2(const sqlite3_int64 *hashes, int count, sqlite3_int64 query,
+                         int max_dist, int *offsets) {
+  const __m256i nibble_counts = _mm256_setr_epi8(0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+                                                 0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+  const __m256i nibble_mask = _mm256_set1_epi8(0x0F);
+  const __m256i query_vector = _mm256_set1_epi64x(query);
+  const __m256i max_dist_vector = _mm256_set1_epi64x(max_dist);
+
+  int found = 0, i = 0;
+  for (; i + 4 <= count; i += 4) {
+    __m256i diff = _mm256_xor_si256(_mm256_loadu_si256((const __m256i *)(hashes + i)),
+                                    query_vector);
+    __m256i low_counts = _mm256_shuffle_epi8(nibble_counts, _mm256_and_si256(diff, nibble_mask));
+    __m256i high_counts = _mm256_shuffle_epi8(nibble_counts,
+                                              _mm256_and_si256(_mm256_srli_epi16(diff, 4),
+                                                               nibble_mask));
+    __m256i distances = _mm256_sad_epu8(_mm256_add_epi8(low_counts, high_counts),
+                                        _mm256_setzero_si256());
+
+    //Get a bit mask of the lanes within the maximum distance
+    __m256i too_far = _mm256_cmpgt_epi64(distances, max_dist_vector);
+    int matches = ~_mm256_movemask_pd(_mm256_castsi256_pd(too_far)) & 0xF;
+    while (matches) {
+      offsets[found++] = i + __builtin_ctz(matches);
+      matches &= matches - 1;
+    }
+  }
+
+  //Compare the remaining hashes one by one
+  for (; i < count; i++) {
+    if (__builtin_popcountll(hashes[i] ^ query) <= max_dist) offsets[found++] = i;
+  }
+  return found;
+}
+#endif
+
+//Variant selected for the processor
+static hammscan_impl hammscan_best = hammscan_generic;
+
+//Scan a packed BLOB of 64-bit hashes (in native byte order) for the hashes within a maximum hamming
+//distance of a query hash:
+//  hammscan(hashes, query, max_dist) - returns the offsets of the matching hashes
+//  hammscan(hashes, query, max_dist, values) - returns the values at the offsets of the matching
+//  hashes instead, taken from a parallel packed BLOB of 32-bit integers (e.g. revision ids)
+//The result is a packed BLOB of 32-bit integers in native byte order, or NULL if nothing matches.
+//The query can also be a packed BLOB of 64-bit hashes, in which case all of them are scanned for
+//while the hashes are in the CPU cache, and the result holds pairs of 32-bit integers instead: the
+//index of the query hash followed by the offset (or value) of a matching hash.
+void hammscan(sqlite3_context *context, int argc, sqlite3_value **argv) {
+  if (sqlite3_value_type(argv[0]) == SQLITE_NULL || sqlite3_value_type(argv[1]) == SQLITE_NULL ||
+      sqlite3_value_type(argv[2]) == SQLITE_NULL) {
+    return;
+  }
+
+  const void *hashes_blob = sqlite3_value_blob(argv[0]);
+  int hashes_size = sqlite3_value_bytes(argv[0]);
+  sqlite3_int64 max_dist = sqlite3_value_int64(argv[2]);
+
+  if (hashes_size % sizeof(sqlite3_int64) != 0) {
+    sqlite3_result_error(context, "hammscan: hash BLOB size is not a multiple of 8", -1);
+    return;
+  }
+  int count = hashes_size / sizeof(sqlite3_int64);
+
+  //Read the query hashes, which are copied since they may not be aligned
+  int multiple_queries = sqlite3_value_type(argv[1]) == SQLITE_BLOB;
+  sqlite3_int64 single_query;
+  sqlite3_int64 *queries = &single_query;
+  int query_count = 1;
+  if (multiple_queries) {
+    int queries_size = sqlite3_value_bytes(argv[1]);
+    if (queries_size % sizeof(sqlite3_int64) != 0) {
+      sqlite3_result_error(context, "hammscan: query BLOB size is not a multiple of 8", -1);
+      return;
+    }
+    query_count = queries_size / sizeof(sqlite3_int64);
+    if (query_count == 0) return;
+
+    queries = sqlite3_malloc(queries_size);
+    if (queries == NULL) {
+      sqlite3_result_error_nomem(context);
+      return;
+    }
+    memcpy(queries, sqlite3_value_blob(argv[1]), queries_size);
+  } else {
+    single_query = sqlite3_value_int64(argv[1]);
+  }
+
+  const int *values = NULL;
+  if (argc > 3) {
+    values = sqlite3_value_blob(argv[3]);
+    if (sqlite3_value_bytes(argv[3]) != count * (int)sizeof(int)) {
+      sqlite3_result_error(context, "hammscan: value BLOB size does not match the hash count", -1);
+      goto done;
+    }
+  }
+
+  if (count == 0 || max_dist < 0) goto done;
+
+  //Copy the hashes if the BLOB is not aligned for 64-bit access
+  sqlite3_int64 *aligned_hashes = NULL;
+  const sqlite3_int64 *hashes = hashes_blob;
+  if ((size_t)hashes_blob % _Alignof(sqlite3_int64) != 0) {
+    aligned_hashes = sqlite3_malloc(hashes_size);
+    if (aligned_hashes == NULL) {
+      sqlite3_result_error_nomem(context);
+      goto done;
+    }
+    memcpy(aligned_hashes, hashes_blob, hashes_size);
+    hashes = aligned_hashes;
+  }
+
+  int *offsets = sqlite3_malloc(count * sizeof(int));
+  if (offsets == NULL) {
+    sqlite3_free(aligned_hashes);
+    sqlite3_result_error_nomem(context);
+    goto done;
+  }
+
+  if (!multiple_queries) {
+    int found = hammscan_best(hashes, count, single_query, max_dist > 64 ? 64 : (int)max_dist,
+                              offsets);
+    sqlite3_free(aligned_hashes);
+
+    if (found == 0) {
+      sqlite3_free(offsets);
+      return;
+    }
+
+    if (values) {
+      for (int i = 0; i < found; i++) offsets[i] = values[offsets[i]];
+    }
+    sqlite3_result_blob(context, offsets, found * sizeof(int), sqlite3_free);
+    return;
+  }
+
+  //Scan for every query hash, appending the pairs of every match to a growing result buffer
+  int *pairs = NULL;
+  sqlite3_int64 pair_count = 0, pair_capacity = 0;
+  for (int q = 0; q < query_count; q++) {
+    int found = hammscan_best(hashes, count, queries[q], max_dist > 64 ? 64 : (int)max_dist,
+                              offsets);
+    if (pair_count + found > pair_capacity) {
+      pair_capacity = (pair_count + found) * 2;
+      int *new_pairs = sqlite3_realloc64(pairs, pair_capacity * 2 * sizeof(int));
+      if (new_pairs == NULL) {
+        sqlite3_free(pairs);
+        sqlite3_free(offsets);
+        sqlite3_free(aligned_hashes);
+        sqlite3_result_error_nomem(context);
+        goto done;
+      }
+      pairs = new_pairs;
+    }
+
+    for (int i = 0; i < found; i++) {
+      pairs[pair_count * 2] = q;
+      pairs[pair_count * 2 + 1] = values ? values[offsets[i]] : offsets[i];
+      pair_count++;
+    }
+  }
+  sqlite3_free(offsets);
+  sqlite3_free(aligned_hashes);
+
+  if (pair_count == 0) {
+    sqlite3_free(pairs);
+  } else {
+    sqlite3_result_blob64(context, pairs, pair_count * 2 * sizeof(int), sqlite3_free);
+  }
+
+done:
+  if (multiple_queries) sqlite3_free(queries);
+}
+
+//The hammindex virtual table module stores 64-bit hashes along with a revision id and finds the
+//hashes within a hamming distance of a reference hash without comparing them all:
+//  CREATE VIRTUAL TABLE hash_index USING hammindex;
+//  SELECT revision_id, distance FROM hash_index WHERE hash MATCH ?1 AND distance <= ?2;
+//Every hash is split into 4 substrings of 16 bits, which are stored in a bucket shadow table indexed
+//by substring value. If two hashes are within a distance r, at least one of their substrings must
+//be within a distance of r / 4, so only the buckets of the substring values within that distance
+//from the reference ones have to be read, and their hashes verified. Queries with larger distances
+//or without a distance limit scan the data shadow table instead, which holds every hash once.
+#define SUBSTRING_COUNT 4
+#define SUBSTRING_BITS 16
+#define SUBSTRING_MASK 0xFFFF
+#define MAX_SUBSTRING_RADIUS 3
+
+//Columns of the virtual table (the distance column is hidden and only set when matching)
+#define COLUMN_REVISION_ID 0
+#define COLUMN_HASH 1
+#define COLUMN_DISTANCE 2
+
+//Query plans, passed as index numbers from xBestIndex to xFilter
+#define PLAN_FULL_SCAN 0      //Scan all rows
+#define PLAN_ROWID 1          //Look up a single row by rowid
+#define PLAN_MATCH 2          //Scan all rows, calculating their distance to a reference hash
+#define PLAN_MATCH_LE 3       //Find the rows within a distance (<=) of a reference hash
+#define PLAN_MATCH_LT 4       //Find the rows within a distance (<) of a reference hash
+
+//Virtual table instance
+typedef struct {
+  sqlite3_vtab base;
+  sqlite3 *db;
+  char *schema_name;
+  char *table_name;
+  sqlite3_stmt *insert_data_stmt;     //Cached statements used for writing
+  sqlite3_stmt *insert_bucket_stmt;
+  sqlite3_stmt *select_data_stmt;
+  sqlite3_stmt *delete_data_stmt;
+  sqlite3_stmt *delete_bucket_stmt;
+} hammindex_vtab;
+
+//Row found by a match query
+typedef struct {
+  sqlite3_int64 rowid;
+  sqlite3_int64 revision_id;
+  sqlite3_int64 hash;
+} hammindex_row;
+
+//Virtual table cursor. Scans read rows from a statement, while match queries collect their rows in
+//an array first.
+typedef struct {
+  sqlite3_vtab_cursor base;
+  int plan;
+  sqlite3_int64 ref_hash;
+  int max_dist;             //Maximum distance of scanned rows, or -1 for no limit
+  sqlite3_stmt *scan_stmt;
+  int scan_eof;
+  hammindex_row *rows;
+  int row_count;
+  int row_index;
+} hammindex_cursor;
+
+//Create (or connect to) a virtual table instance
+static int hammindex_init(sqlite3 *db, void *aux, int argc, const char *const *argv,
+                          sqlite3_vtab **vtab_out, char **error, int create) {
+  if (argc != 3) {
+    *error = sqlite3_mprintf("hammindex takes no arguments");
+    return SQLITE_ERROR;
+  }
+
+  int rc;
+  if (create) {
+    //Create the shadow tables
+    char *sql = sqlite3_mprintf(
+      "CREATE TABLE \"%w\".\"%w_data\"("
+        "id INTEGER PRIMARY KEY, revision_id INTEGER, hash INTEGER NOT NULL);"
+      "CREATE TABLE \"%w\".\"%w_buckets\"("
+        "substring INTEGER, value INTEGER, id INTEGER, revision_id INTEGER, hash INTEGER, "
+        "PRIMARY KEY (substring, value, id)) WITHOUT ROWID;",
+      argv[1], argv[2], argv[1], argv[2]);
+    if (sql == NULL) return SQLITE_NOMEM;
+    rc = sqlite3_exec(db, sql, 0, 0, error);
+    sqlite3_free(sql);
+    if (rc != SQLITE_OK) return rc;
+  }
+
+  rc = sqlite3_declare_vtab(db,
+    "CREATE TABLE x(revision_id INTEGER, hash INTEGER, distance INTEGER HIDDEN)");
+  if (rc != SQLITE_OK) return rc;
+
+  hammindex_vtab *vtab = sqlite3_malloc(sizeof(hammindex_vtab));
+  if (vtab == NULL) return SQLITE_NOMEM;
+  memset(vtab, 0, sizeof(hammindex_vtab));
+  vtab->db = db;
+  vtab->schema_name = sqlite3_mprintf("%s", argv[1]);
+  vtab->table_name = sqlite3_mprintf("%s", argv[2]);
+  if (vtab->schema_name == NULL || vtab->table_name == NULL) {
+    sqlite3_free(vtab->schema_name);
+    sqlite3_free(vtab->table_name);
+    sqlite3_free(vtab);
+    return SQLITE_NOMEM;
+  }
+
+  *vtab_out = &vtab->base;
+  return SQLITE_OK;
+}
+
+static int hammindex_create(sqlite3 *db, void *aux, int argc, const char *const *argv,
+                            sqlite3_vtab **vtab_out, char **error) {
+  return hammindex_init(db, aux, argc, argv, vtab_out, error, 1);
+}
+
+static int hammindex_connect(sqlite3 *db, void *aux, int argc, const char *const *argv,
+                             sqlite3_vtab **vtab_out, char **error) {
+  return hammindex_init(db, aux, argc, argv, vtab_out, error, 0);
+}
+
+//Release a virtual table instance
+static int hammindex_disconnect(sqlite3_vtab *base) {
+  hammindex_vtab *vtab = (hammindex_vtab *)base;
+  sqlite3_finalize(vtab->insert_data_stmt);
+  sqlite3_finalize(vtab->insert_bucket_stmt);
+  sqlite3_finalize(vtab->select_data_stmt);
+  sqlite3_finalize(vtab->delete_data_stmt);
+  sqlite3_finalize(vtab->delete_bucket_stmt);
+  sqlite3_free(vtab->schema_name);
+  sqlite3_free(vtab->table_name);
+  sqlite3_free(vtab);
+  return SQLITE_OK;
+}
+
+//Drop the shadow tables and release a virtual table instance
+static int hammindex_destroy(sqlite3_vtab *base) {
+  hammindex_vtab *vtab = (hammindex_vtab *)base;
+  char *sql = sqlite3_mprintf(
+    "DROP TABLE IF EXISTS \"%w\".\"%w_data\";"
+    "DROP TABLE IF EXISTS \"%w\".\"%w_buckets\";",
+    vtab->schema_name, vtab->table_name, vtab->schema_name, vtab->table_name);
+  if (sql == NULL) return SQLITE_NOMEM;
+  int rc = sqlite3_exec(vtab->db, sql, 0, 0, 0);
+  sqlite3_free(sql);
+  if (rc != SQLITE_OK) return rc;
+
+  return hammindex_disconnect(base);
+}
+
+//Rename the shadow tables along with the virtual table
+static int hammindex_rename(sqlite3_vtab *base, const char *new_name) {
+  hammindex_vtab *vtab = (hammindex_vtab *)base;
+  char *sql = sqlite3_mprintf(
+    "ALTER TABLE \"%w\".\"%w_data\" RENAME TO \"%w_data\";"
+    "ALTER TABLE \"%w\".\"%w_buckets\" RENAME TO \"%w_buckets\";",
+    vtab->schema_name, vtab->table_name, new_name,
+    vtab->schema_name, vtab->table_name, new_name);
+  if (sql == NULL) return SQLITE_NOMEM;
+  int rc = sqlite3_exec(vtab->db, sql, 0, 0, 0);
+  sqlite3_free(sql);
+  if (rc != SQLITE_OK) return rc;
+
+  char *table_name = sqlite3_mprintf("%s", new_name);
+  if (table_name == NULL) return SQLITE_NOMEM;
+  sqlite3_free(vtab->table_name);
+  vtab->table_name = table_name;
+  return SQLITE_OK;
+}
+
+//Identify the shadow tables, so they are protected from modification in defensive mode
+static int hammindex_shadow_name(const char *suffix) {
+  return sqlite3_stricmp(suffix, "data") == 0 || sqlite3_stricmp(suffix, "buckets") == 0;
+}
+
+//Choose the query plan based on the available constraints
+static int hammindex_best_index(sqlite3_vtab *base, sqlite3_index_info *info) {
+  int match_index = -1, match_unusable = 0, distance_index = -1, rowid_index = -1;
+
+  for (int i = 0; i < info->nConstraint; i++) {
+    const struct sqlite3_index_constraint *constraint = &info->aConstraint[i];
+    if (constraint->iColumn == COLUMN_HASH && constraint->op == SQLITE_INDEX_CONSTRAINT_MATCH) {
+      if (constraint->usable) match_index = i;
+      else match_unusable = 1;
+    } else if (!constraint->usable) {
+      continue;
+    } else if (constraint->iColumn == COLUMN_DISTANCE &&
+               (constraint->op == SQLITE_INDEX_CONSTRAINT_LE ||
+                constraint->op == SQLITE_INDEX_CONSTRAINT_LT)) {
+      distance_index = i;
+    } else if (constraint->iColumn == -1 && constraint->op == SQLITE_INDEX_CONSTRAINT_EQ) {
+      rowid_index = i;
+    }
+  }
+
+  if (match_index >= 0) {
+    //The hash must match a reference hash (this module handles MATCH entirely)
+    info->aConstraintUsage[match_index].argvIndex = 1;
+    info->aConstraintUsage[match_index].omit = 1;
+
+    if (distance_index >= 0) {
+      info->aConstraintUsage[distance_index].argvIndex = 2;
+      info->aConstraintUsage[distance_index].omit = 1;
+      info->idxNum = info->aConstraint[distance_index].op == SQLITE_INDEX_CONSTRAINT_LT ?
+                     PLAN_MATCH_LT : PLAN_MATCH_LE;
+      info->estimatedCost = 1000;
+      info->estimatedRows = 100;
+    } else {
+      info->idxNum = PLAN_MATCH;
+      info->estimatedCost = 1000000;
+      info->estimatedRows = 1000000;
+    }
+  } else if (match_unusable) {
+    //MATCH can't be evaluated outside this module, so plans without it are not valid
+    return SQLITE_CONSTRAINT;
+  } else if (rowid_index >= 0) {
+    info->aConstraintUsage[rowid_index].argvIndex = 1;
+    info->aConstraintUsage[rowid_index].omit = 1;
+    info->idxNum = PLAN_ROWID;
+    info->idxFlags = SQLITE_INDEX_SCAN_UNIQUE;
+    info->estimatedCost = 10;
+    info->estimatedRows = 1;
+  } else {
+    info->idxNum = PLAN_FULL_SCAN;
+    info->estimatedCost = 1000000;
+    info->estimatedRows = 1000000;
+  }
+
+  return SQLITE_OK;
+}
+
+//Open a new cursor
+static int hammindex_open(sqlite3_vtab *base, sqlite3_vtab_cursor **cursor_out) {
+  hammindex_cursor *cursor = sqlite3_malloc(sizeof(hammindex_cursor));
+  if (cursor == NULL) return SQLITE_NOMEM;
+  memset(cursor, 0, sizeof(hammindex_cursor));
+  *cursor_out = &cursor->base;
+  return SQLITE_OK;
+}
+
+//Release the results of the previous query of a cursor
+static void hammindex_reset(hammindex_cursor *cursor) {
+  sqlite3_finalize(cursor->scan_stmt);
+  cursor->scan_stmt = NULL;
+  cursor->scan_eof = 1;
+  sqlite3_free(cursor->rows);
+  cursor->rows = NULL;
+  cursor->row_count = 0;
+  cursor->row_index = 0;
+}
+
+//Close a cursor
+static int hammindex_close(sqlite3_vtab_cursor *base) {
+  hammindex_cursor *cursor = (hammindex_cursor *)base;
+  hammindex_reset(cursor);
+  sqlite3_free(cursor);
+  return SQLITE_OK;
+}
+
+//Compare rows by rowid, for sorting
+static int hammindex_compare_rows(const void *a, const void *b) {
+  sqlite3_int64 rowid_a = ((const hammindex_row *)a)->rowid;
+  sqlite3_int64 rowid_b = ((const hammindex_row *)b)->rowid;
+  return (rowid_a > rowid_b) - (rowid_a < rowid_b);
+}
+
+//Append a row to the results of a cursor, growing the array as needed
+static int hammindex_append_row(hammindex_cursor *cursor, int *capacity, sqlite3_int64 rowid,
+                                sqlite3_int64 revision_id, sqlite3_int64 hash) {
+  if (cursor->row_count == *capacity) {
+    int new_capacity = *capacity ? *capacity * 2 : 64;
+    hammindex_row *rows = sqlite3_realloc64(cursor->rows, sizeof(hammindex_row) * new_capacity);
+    if (rows == NULL) return SQLITE_NOMEM;
+    cursor->rows = rows;
+    *capacity = new_capacity;
+  }
+
+  cursor->rows[cursor->row_count].rowid = rowid;
+  cursor->rows[cursor->row_count].revision_id = revision_id;
+  cursor->rows[cursor->row_count].hash = hash;
+  cursor->row_count++;
+  return SQLITE_OK;
+}
+
+//Find the rows within a distance of the reference hash by reading the buckets of the substring
+//values within the substring radius, then sort the results by rowid removing duplicates (a hash may
+//be found through multiple substrings)
+static int hammindex_match(hammindex_vtab *vtab, hammindex_cursor *cursor, int max_dist) {
+  char *sql = sqlite3_mprintf(
+    "SELECT id, revision_id, hash FROM \"%w\".\"%w_buckets\" WHERE substring = ?1 AND value = ?2",
+    vtab->schema_name, vtab->table_name);
+  if (sql == NULL) return SQLITE_NOMEM;
+  sqlite3_stmt *stmt;
+  int rc = sqlite3_prepare_v2(vtab->db, sql, -1, &stmt, 0);
+  sqlite3_free(sql);
+  if (rc != SQLITE_OK) return rc;
+
+  int substring_radius = max_dist / SUBSTRING_COUNT;
+  int capacity = 0;
+  for (int i = 0; i < SUBSTRING_COUNT && rc == SQLITE_OK; i++) {
+    int ref_substring = (int)((sqlite3_uint64)cursor->ref_hash >> (i * SUBSTRING_BITS)) &
+                        SUBSTRING_MASK;
+
+    for (int mask = 0; mask <= SUBSTRING_MASK && rc == SQLITE_OK; mask++) {
+      if (__builtin_popcount(mask) > substring_radius) continue;
+
+      sqlite3_bind_int(stmt, 1, i);
+      sqlite3_bind_int(stmt, 2, ref_substring ^ mask);
+      while ((rc = sqlite3_step(stmt)) == SQLITE_ROW) {
+        sqlite3_int64 hash = sqlite3_column_int64(stmt, 2);
+        if (__builtin_popcountll(hash ^ cursor->ref_hash) <= max_dist) {
+          rc = hammindex_append_row(cursor, &capacity, sqlite3_column_int64(stmt, 0),
+                                    sqlite3_column_int64(stmt, 1), hash);
+          if (rc != SQLITE_OK) break;
+        }
+      }
+      if (rc == SQLITE_DONE) rc = SQLITE_OK;
+      sqlite3_reset(stmt);
+    }
+  }
+  sqlite3_finalize(stmt);
+  if (rc != SQLITE_OK) return rc;
+
+  if (cursor->row_count > 1) {
+    qsort(cursor->rows, cursor->row_count, sizeof(hammindex_row), hammindex_compare_rows);
+
+    int unique_count = 1;
+    for (int i = 1; i < cursor->row_count; i++) {
+      if (cursor->rows[i].rowid != cursor->rows[unique_count - 1].rowid) {
+        cursor->rows[unique_count++] = cursor->rows[i];
+      }
+    }
+    cursor->row_count = unique_count;
+  }
+
+  return SQLITE_OK;
+}
+
+//Advance a scan to its next row that satisfies the query
+static int hammindex_scan_next(hammindex_cursor *cursor) {
+  int rc;
+  while ((rc = sqlite3_step(cursor->scan_stmt)) == SQLITE_ROW) {
+    if (cursor->max_dist < 0 ||
+        __builtin_popcountll(sqlite3_column_int64(cursor->scan_stmt, 2) ^ cursor->ref_hash) <=
+        cursor->max_dist) {
+      return SQLITE_OK;
+    }
+  }
+
+  cursor->scan_eof = 1;
+  return rc == SQLITE_DONE ? SQLITE_OK : rc;
+}
+
+//Start a query
+static int hammindex_filter(sqlite3_vtab_cursor *base, int plan, const char *plan_str, int argc,
+                            sqlite3_value **argv) {
+  hammindex_cursor *cursor = (hammindex_cursor *)base;
+  hammindex_vtab *vtab = (hammindex_vtab *)base->pVtab;
+  hammindex_reset(cursor);
+  cursor->plan = plan;
+  cursor->ref_hash = 0;
+  cursor->max_dist = -1;
+
+  int max_dist = 64;
+  if (plan == PLAN_MATCH || plan == PLAN_MATCH_LE || plan == PLAN_MATCH_LT) {
+    //Nothing matches a null reference hash or distance limit
+    if (sqlite3_value_type(argv[0]) == SQLITE_NULL ||
+        (argc > 1 && sqlite3_value_type(argv[1]) == SQLITE_NULL)) {
+      return SQLITE_OK;
+    }
+
+    cursor->ref_hash = sqlite3_value_int64(argv[0]);
+    if (argc > 1) {
+      sqlite3_int64 limit = sqlite3_value_int64(argv[1]);
+      if (plan == PLAN_MATCH_LT) limit--;
+      if (limit < 0) return SQLITE_OK;
+      max_dist = limit > 64 ? 64 : (int)limit;
+    }
+
+    //Small distances are searched through the buckets, larger ones scan every row
+    if (max_dist / SUBSTRING_COUNT <= MAX_SUBSTRING_RADIUS) {
+      return hammindex_match(vtab, cursor, max_dist);
+    }
+    cursor->max_dist = max_dist;
+  }
+
+  char *sql = sqlite3_mprintf(
+    "SELECT id, revision_id, hash FROM \"%w\".\"%w_data\"%s",
+    vtab->schema_name, vtab->table_name, plan == PLAN_ROWID ? " WHERE id = ?1" : "");
+  if (sql == NULL) return SQLITE_NOMEM;
+  int rc = sqlite3_prepare_v2(vtab->db, sql, -1, &cursor->scan_stmt, 0);
+  sqlite3_free(sql);
+  if (rc != SQLITE_OK) return rc;
+
+  if (plan == PLAN_ROWID) sqlite3_bind_value(cursor->scan_stmt, 1, argv[0]);
+
+  cursor->scan_eof = 0;
+  return hammindex_scan_next(cursor);
 }
 
-//Initialize this plugin and register the functions defined here
+//Check whether a query has no more rows
+static int hammindex_eof(sqlite3_vtab_cursor *base) {
+  hammindex_cursor *cursor = (hammindex_cursor *)base;
+  return cursor->scan_stmt ? cursor->scan_eof : cursor->row_index >= cursor->row_count;
+}
+
+//Advance to the next row of a query
+static int hammindex_next(sqlite3_vtab_cursor *base) {
+  hammindex_cursor *cursor = (hammindex_cursor *)base;
+  if (cursor->scan_stmt == NULL) {
+    cursor->row_index++;
+    return SQLITE_OK;
+  }
+
+  return hammindex_scan_next(cursor);
+}
+
+//Get a column value of the current row
+static int hammindex_column(sqlite3_vtab_cursor *base, sqlite3_context *context, int column) {
+  hammindex_cursor *cursor = (hammindex_cursor *)base;
+  sqlite3_int64 revision_id, hash;
+  if (cursor->scan_stmt) {
+    revision_id = sqlite3_column_int64(cursor->scan_stmt, 1);
+    hash = sqlite3_column_int64(cursor->scan_stmt, 2);
+  } else {
+    revision_id = cursor->rows[cursor->row_index].revision_id;
+    hash = cursor->rows[cursor->row_index].hash;
+  }
+
+  switch (column) {
+    case COLUMN_REVISION_ID:
+      sqlite3_result_int64(context, revision_id);
+      break;
+    case COLUMN_HASH:
+      sqlite3_result_int64(context, hash);
+      break;
+    case COLUMN_DISTANCE:
+      if (cursor->plan == PLAN_FULL_SCAN || cursor->plan == PLAN_ROWID) {
+        sqlite3_result_null(context);
+      } else {
+        sqlite3_result_int(context, __builtin_popcountll(hash ^ cursor->ref_hash));
+      }
+      break;
+  }
+  return SQLITE_OK;
+}
+
+//Get the rowid of the current row
+static int hammindex_rowid(sqlite3_vtab_cursor *base, sqlite3_int64 *rowid) {
+  hammindex_cursor *cursor = (hammindex_cursor *)base;
+  *rowid = cursor->scan_stmt ? sqlite3_column_int64(cursor->scan_stmt, 0) :
+                               cursor->rows[cursor->row_index].rowid;
+  return SQLITE_OK;
+}
+
+//Prepare a statement for writing if not prepared yet, or reset it otherwise
+static int hammindex_prepare(hammindex_vtab *vtab, sqlite3_stmt **stmt, const char *sql_format) {
+  if (*stmt) {
+    sqlite3_reset(*stmt);
+    return SQLITE_OK;
+  }
+
+  char *sql = sqlite3_mprintf(sql_format, vtab->schema_name, vtab->table_name);
+  if (sql == NULL) return SQLITE_NOMEM;
+  int rc = sqlite3_prepare_v3(vtab->db, sql, -1, SQLITE_PREPARE_PERSISTENT, stmt, 0);
+  sqlite3_free(sql);
+  return rc;
+}
+
+//Run a prepared write statement until completion
+static int hammindex_step(sqlite3_stmt *stmt) {
+  int rc = sqlite3_step(stmt);
+  sqlite3_reset(stmt);
+  return rc == SQLITE_DONE ? SQLITE_OK : rc;
+}
+
+//Delete a row from the data and bucket shadow tables
+static int hammindex_delete(hammindex_vtab *vtab, sqlite3_int64 rowid) {
+  int rc = hammindex_prepare(vtab, &vtab->select_data_stmt,
+                             "SELECT hash FROM \"%w\".\"%w_data\" WHERE id = ?1");
+  if (rc != SQLITE_OK) return rc;
+
+  sqlite3_bind_int64(vtab->select_data_stmt, 1, rowid);
+  rc = sqlite3_step(vtab->select_data_stmt);
+  if (rc != SQLITE_ROW) {
+    sqlite3_reset(vtab->select_data_stmt);
+    return rc == SQLITE_DONE ? SQLITE_OK : rc;
+  }
+  sqlite3_uint64 hash = (sqlite3_uint64)sqlite3_column_int64(vtab->select_data_stmt, 0);
+  sqlite3_reset(vtab->select_data_stmt);
+
+  rc = hammindex_prepare(vtab, &vtab->delete_bucket_stmt,
+    "DELETE FROM \"%w\".\"%w_buckets\" WHERE substring = ?1 AND value = ?2 AND id = ?3");
+  for (int i = 0; i < SUBSTRING_COUNT && rc == SQLITE_OK; i++) {
+    sqlite3_bind_int(vtab->delete_bucket_stmt, 1, i);
+    sqlite3_bind_int(vtab->delete_bucket_stmt, 2, (int)(hash >> (i * SUBSTRING_BITS)) &
+                                                  SUBSTRING_MASK);
+    sqlite3_bind_int64(vtab->delete_bucket_stmt, 3, rowid);
+    rc = hammindex_step(vtab->delete_bucket_stmt);
+  }
+  if (rc != SQLITE_OK) return rc;
+
+  rc = hammindex_prepare(vtab, &vtab->delete_data_stmt,
+                         "DELETE FROM \"%w\".\"%w_data\" WHERE id = ?1");
+  if (rc != SQLITE_OK) return rc;
+  sqlite3_bind_int64(vtab->delete_data_stmt, 1, rowid);
+  return hammindex_step(vtab->delete_data_stmt);
+}
+
+//Insert a row into the data and bucket shadow tables
+static int hammindex_insert(hammindex_vtab *vtab, sqlite3_value *rowid_value,
+                            sqlite3_value *revision_id_value, sqlite3_value *hash_value,
+                            sqlite3_int64 *rowid) {
+  if (sqlite3_value_type(hash_value) == SQLITE_NULL) {
+    vtab->base.zErrMsg = sqlite3_mprintf("hammindex: hash must not be NULL");
+    return SQLITE_CONSTRAINT;
+  }
+
+  int rc = hammindex_prepare(vtab, &vtab->insert_data_stmt,
+    "INSERT INTO \"%w\".\"%w_data\" (id, revision_id, hash) VALUES (?1, ?2, ?3)");
+  if (rc != SQLITE_OK) return rc;
+  sqlite3_bind_value(vtab->insert_data_stmt, 1, rowid_value);
+  sqlite3_bind_value(vtab->insert_data_stmt, 2, revision_id_value);
+  sqlite3_bind_int64(vtab->insert_data_stmt, 3, sqlite3_value_int64(hash_value));
+  rc = hammindex_step(vtab->insert_data_stmt);
+  if (rc != SQLITE_OK) return rc;
+  *rowid = sqlite3_last_insert_rowid(vtab->db);
+
+  sqlite3_uint64 hash = (sqlite3_uint64)sqlite3_value_int64(hash_value);
+  rc = hammindex_prepare(vtab, &vtab->insert_bucket_stmt,
+    "INSERT INTO \"%w\".\"%w_buckets\" (substring, value, id, revision_id, hash) "
+    "VALUES (?1, ?2, ?3, ?4, ?5)");
+  for (int i = 0; i < SUBSTRING_COUNT && rc == SQLITE_OK; i++) {
+    sqlite3_bind_int(vtab->insert_bucket_stmt, 1, i);
+    sqlite3_bind_int(vtab->insert_bucket_stmt, 2, (int)(hash >> (i * SUBSTRING_BITS)) &
+                                                  SUBSTRING_MASK);
+    sqlite3_bind_int64(vtab->insert_bucket_stmt, 3, *rowid);
+    sqlite3_bind_value(vtab->insert_bucket_stmt, 4, revision_id_value);
+    sqlite3_bind_int64(vtab->insert_bucket_stmt, 5, (sqlite3_int64)hash);
+    rc = hammindex_step(vtab->insert_bucket_stmt);
+  }
+  return rc;
+}
+
+//Insert, delete or update a row
+static int hammindex_update(sqlite3_vtab *base, int argc, sqlite3_value **argv,
+                            sqlite3_int64 *rowid) {
+  hammindex_vtab *vtab = (hammindex_vtab *)base;
+
+  //Delete the previous row when deleting or updating
+  if (sqlite3_value_type(argv[0]) != SQLITE_NULL) {
+    int rc = hammindex_delete(vtab, sqlite3_value_int64(argv[0]));
+    if (rc != SQLITE_OK || argc == 1) return rc;
+  }
+
+  //Insert the new row when inserting or updating (columns start at argv[2])
+  return hammindex_insert(vtab, argv[1], argv[2 + COLUMN_REVISION_ID], argv[2 + COLUMN_HASH],
+                          rowid);
+}
+
+//Virtual table module definition
+static sqlite3_module hammindex_module = {
+  .iVersion = 3,
+  .xCreate = hammindex_create,
+  .xConnect = hammindex_connect,
+  .xBestIndex = hammindex_best_index,
+  .xDisconnect = hammindex_disconnect,
+  .xDestroy = hammindex_destroy,
+  .xOpen = hammindex_open,
+  .xClose = hammindex_close,
+  .xFilter = hammindex_filter,
+  .xNext = hammindex_next,
+  .xEof = hammindex_eof,
+  .xColumn = hammindex_column,
+  .xRowid = hammindex_rowid,
+  .xUpdate = hammindex_update,
+  .xRename = hammindex_rename,
+  .xShadowName = hammindex_shadow_name,
+};
+
+//Initialize this plugin and register the functions and modules defined here
 int sqlite3_hammdist_init(sqlite3 *db, char **pzErrMsg, const sqlite3_api_routines *pApi) {
   SQLITE_EXTENSION_INIT2(pApi);
-  return sqlite3_create_function(db, "hammdist", 2, SQLITE_UTF8, 0, hammdist, 0, 0);
+  int rc = sqlite3_create_function(db, "hammdist", 2, SQLITE_UTF8, 0, hammdist, 0, 0);
+  if (rc != SQLITE_OK) return rc;
+  rc = sqlite3_create_function(db, "hammdist", 3, SQLITE_UTF8, 0, hammdist, 0, 0);
+  if (rc != SQLITE_OK) return rc;
+
+  //Select the best hammscan variant for the processor
+#ifdef HAMMSCAN_X86
+  __builtin_cpu_init();
+  if (__builtin_cpu_supports("avx2") && __builtin_cpu_supports("popcnt")) {
+    hammscan_best = hammscan_avx2;
+  } else if (__builtin_cpu_supports("popcnt")) {
+    hammscan_best = hammscan_popcnt;
+  }
+#endif
+
+  int flags = SQLITE_UTF8 | SQLITE_DETERMINISTIC;
+  rc = sqlite3_create_function(db, "hammscan", 3, flags, 0, hammscan, 0, 0);
+  if (rc != SQLITE_OK) return rc;
+  rc = sqlite3_create_function(db, "hammscan", 4, flags, 0, hammscan, 0, 0);
+  if (rc != SQLITE_OK) return rc;
+  return sqlite3_create_module(db, "hammindex", &hammindex_module, 0);
 }
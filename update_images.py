@@ -4,14 +4,18 @@ from collections.abc import Iterator
 from argparse import ArgumentParser
 from pathlib import Path
 from urllib.parse import urlparse, unquote
-from time import sleep
+from datetime import datetime, timezone
+from time import sleep, time
+import json, os, queue, random, signal, threading, traceback
 import urllib3
 from modules.common import config
 from modules.model import db
-from modules.model.table import images, revisions, hashes, unused_images
+from modules.model.table import images, revisions, hashes, unused_images, sync_state, image_usage
 from modules.model.view import pending_hashes
 from modules.model.aggregate import images_without_revisions
-from modules.mediawiki import api_client
+from modules.model.hash_index import engine, similar_pairs, duplicate_clusters, hub_hashes,\
+                                     result_cache
+from modules.mediawiki import api_client, transport, event_stream
 from modules.utility import perceptual_hash
 
 #Register module configurations
@@ -21,6 +25,15 @@ config.register({
     'remote_images': '',  #Default: Don't look for for local images
     'local_images': '',   #Default: Same as previous
   },
+  'update_daemon': {
+    'index_interval': 300,    #Default: Update the image index every 5 minutes
+    'unused_interval': 300,   #Default: Update the unused images every 5 minutes
+    'hash_interval': 60,      #Default: Look for images pending hashing every minute
+    'hash_batch_size': 50,    #Default: Hash up to 50 images before letting other loops run
+    'hub_interval': 3600,     #Default: Recount the hub hashes every hour if the hashes changed
+    'max_backoff': 3600,      #Default: Retry failed loops after 1 hour at most
+    'state_file': 'update_daemon_state.json', #Default: State file in the working directory
+  },
 })
 
 #Perform initialization based on configuration
@@ -48,24 +61,55 @@ def _on_load():
   local_images = config.root.image_updates.local_images
   g_local_image_path = Path(local_images) if local_images else None
 
+  #Hashing batches must make progress, otherwise the daemon would never hash any image
+  if config.root.update_daemon.hash_batch_size < 1:
+    raise ValueError(f'Invalid value for configuration update_daemon.hash_batch_size: '
+                     f'{config.root.update_daemon.hash_batch_size}')
+
 config.load('config.toml', warn_unknown = False)
 db.go_without_flask()
 
-#Create (or recreate) the complete image index and store it in the image and revision tables
+#Create a connection pool for downloading. Only one download is performed at a time, but preserving
+#open connections to potentially multiple servers might become useful for faster download times.
+_download_pool = urllib3.PoolManager()
+
+#Create (or recreate) the complete image index and store it in the image and revision tables. The
+#process is checkpointed after every page of results, so it can be resumed if interrupted.
 def refresh_full_image_index(first_time: bool):
-  if first_time: print('Creating initial image index...')
-  else:          print('Refreshing full image index...')
+  #Look for the checkpoint of an interrupted process, if any
+  checkpoint = sync_state.read('full_image_index')
+
+  if checkpoint is not None:
+    first_time = checkpoint['first_time']
+    print('Resuming interrupted image index creation...' if first_time else
+          'Resuming interrupted full image index refresh...')
+  elif first_time:
+    print('Creating initial image index...')
+  else:
+    print('Refreshing full image index...')
 
   query_params = { 'action': 'query', 'generator': 'allimages', 'gailimit': 'max',
                    'prop': 'imageinfo', 'iiprop': 'timestamp|url', 'iilimit': 'max' }
 
-  #Start a full synchronization process for the revisions
-  revisions.synchronize_begin()
+  #Start a full synchronization process for the revisions, resuming the previous one if possible,
+  #then store the initial checkpoint
+  revisions.full_synchronize_begin(resume = checkpoint is not None)
+
+  if checkpoint is None:
+    #Read the current high-water marks of the incremental updates before crawling, so that they
+    #continue exactly after the point where the full index is a snapshot of the server
+    checkpoint = { 'first_time': first_time, 'continue': None, 'crawled': False,
+                   'watermarks': _read_high_water_marks() }
+    sync_state.write('full_image_index', checkpoint)
+  elif checkpoint['continue'] is not None:
+    query_params.update(checkpoint['continue'])
+
   img_count = 0
   rev_count = 0
 
-  #Query the mediawiki server and process each parsed JSON block
-  for result in api_client.query(query_params):
+  #Query the mediawiki server and process each parsed JSON block, unless the crawl was already
+  #completed by the interrupted process
+  for result in (api_client.query(query_params) if not checkpoint['crawled'] else ()):
     for img in result['query']['pages'].values():
       #Create or read an id for the current image
       image_id = images.create_read_id(title = img['title'])
@@ -76,9 +120,9 @@ def refresh_full_image_index(first_time: bool):
           continue
 
         #Add each revision to the synchronization process
-        is_new = revisions.synchronize_add_one(image_id = image_id,
-                                               timestamp = rev['timestamp'],
-                                               url = rev['url'])
+        is_new = revisions.full_synchronize_add_one(image_id = image_id,
+                                                    timestamp = rev['timestamp'],
+                                                    url = rev['url'])
 
         #Track successful imports
         if first_time:
@@ -93,23 +137,38 @@ def refresh_full_image_index(first_time: bool):
 
       img_count += 1
 
+    #The page has been committed. Store the continuation point so the process resumes after it.
+    checkpoint['continue'] = result.get('continue')
+    checkpoint['crawled'] = checkpoint['continue'] is None
+    sync_state.write('full_image_index', checkpoint)
+
     print(f'{img_count} images, {rev_count} revisions')
 
-  #Show deletions caused by the full synchronization process
+  #The crawl is complete at this point, so deletions can be safely calculated. Show the deletions
+  #caused by the full synchronization process.
   for image_id, timestamp in revisions.full_synchronize_get_deletions():
     print(f'Removed: "{images.read_title(image_id)}" - {timestamp}')
 
-  #Finish the full synchronization process and then prune images without revisions
+  #Finish the full synchronization process and then prune images without revisions. Store the
+  #high-water marks and remove the checkpoint only afterwards.
   revisions.full_synchronize_end()
   images_without_revisions.prune()
 
+  for name, watermark in checkpoint['watermarks'].items():
+    if watermark is not None:
+      sync_state.write(name, watermark)
+
+  sync_state.delete('full_image_index')
+
   print('Done')
 
 #Update the existing image index if any, or create it otherwise
-def update_image_index(full_index: bool):
-  last_timestamp = revisions.read_last_timestamp()
-
-  if last_timestamp is None:
+def update_image_index(full_index: bool, log_events: bool):
+  if sync_state.read('full_image_index') is not None:
+    #A previous full index creation or refresh was interrupted. Resume it before anything else.
+    refresh_full_image_index(first_time = False)
+    return
+  elif revisions.is_empty():
     #The revisions table is not populated yet. Create a new index instead.
     refresh_full_image_index(first_time = True)
     return
@@ -117,64 +176,212 @@ def update_image_index(full_index: bool):
     #A full index refresh has been requested
     refresh_full_image_index(first_time = False)
     return
+  elif log_events == True:
+    #An update based on log events has been requested
+    update_image_index_from_log_events()
+    return
 
   print ('Updating image index...')
 
-  query_params = { 'action': 'query', 'generator': 'recentchanges', 'grcnamespace': 6,
-                   'grcstart': last_timestamp, 'grcdir': 'newer', 'grclimit': 'max',
-                   'prop': 'imageinfo', 'iiprop': 'timestamp|url', 'iilocalonly': 1,
-                   'iilimit': 'max' }
+  query_params = { 'action': 'query', 'list': 'recentchanges', 'rcnamespace': 6, 'rcdir': 'newer',
+                   'rclimit': 'max', 'rcprop': 'title|ids|timestamp' }
 
-  #Start a partial synchronization process for the revisions
-  revisions.synchronize_begin()
+  #Continue right after the last processed recent change if any. Otherwise start from the latest
+  #revision timestamp (only needed once, for databases created before the watermark was stored).
+  watermark = sync_state.read('recent_changes')
+  if watermark is not None:
+    query_params['rccontinue'] = f'{watermark['timestamp']}|{watermark['rcid'] + 1}'
+  else:
+    query_params['rcstart'] = revisions.read_last_timestamp()
 
   #Query the mediawiki server and process each parsed JSON block
   for result in api_client.query(query_params):
-    if 'query' not in result or 'pages' not in result['query']: continue
+    changes = result['query']['recentchanges']
+    if not changes: continue
 
-    for img in result['query']['pages'].values():
-      if 'imageinfo' not in img:
-        #The image has no revisions and has been removed
+    #Refresh the changed images, then store the last change as the new continuation point
+    _refresh_images(list(dict.fromkeys(change['title'] for change in changes
+                                        if 'title' in change)))
+    sync_state.write('recent_changes', { 'rcid': changes[-1]['rcid'],
+                                         'timestamp': changes[-1]['timestamp'] })
+
+  print('Done')
+
+#Update the existing image index by replaying the file log events (uploads, overwrites, reverts,
+#deletions, restorations and moves) that happened after the last processed one. Every event is
+#applied as a precise change to the affected images only.
+def update_image_index_from_log_events():
+  print('Updating image index from log events...')
+
+  query_params = { 'action': 'query', 'list': 'logevents', 'lenamespace': 6, 'ledir': 'newer',
+                   'lelimit': 'max', 'leprop': 'ids|title|type|timestamp|details' }
+
+  #Continue right after the last processed log event if any, otherwise start from the latest
+  #revision timestamp
+  watermark = sync_state.read('log_events')
+  if watermark is not None:
+    query_params['lecontinue'] = f'{watermark['timestamp']}|{watermark['logid'] + 1}'
+  else:
+    query_params['lestart'] = revisions.read_last_timestamp()
+
+  event_count = 0
+
+  #Query the mediawiki server and process each parsed JSON block
+  for result in api_client.query(query_params):
+    log_events = result['query']['logevents']
+    if not log_events: continue
+
+    #Apply the log events, then store the last one as the new continuation point
+    event_count += _apply_log_events(log_events)
+    sync_state.write('log_events', { 'logid': log_events[-1]['logid'],
+                                     'timestamp': log_events[-1]['timestamp'] })
+
+    print(f'{event_count} log events')
+
+  print('Done')
+
+#Apply a group of file log events to the image index in order. Moves are applied to the image table
+#right away, as their relative order matters, while all other events just require the affected
+#images to be refreshed.
+#Return value: The amount of log events applied.
+def _apply_log_events(log_events: list[dict]) -> int:
+  #Use a dictionary to collect the titles, as it behaves like an ordered set
+  refresh_titles = {}
+  event_count = 0
+  for event in log_events:
+    #Hidden log events don't provide a title, so they can't be applied
+    if 'title' not in event:
+      continue
+
+    match event['type'], event['action']:
+      case ('upload', 'upload' | 'overwrite' | 'revert') |\
+           ('delete', 'delete' | 'restore'):
+        refresh_titles[event['title']] = None
+      case ('move', 'move' | 'move_redir'):
+        #Renaming preserves the image id, and with it the hashes and reviews of the image
+        target_title = event['params']['target_title']
+        if images.rename(event['title'], target_title):
+          print(f'Moved: "{event['title']}" => "{target_title}"')
+        refresh_titles[event['title']] = None
+        refresh_titles[target_title] = None
+      case _:
+        continue
+
+    event_count += 1
+
+  #Refresh the affected images
+  _refresh_images(list(refresh_titles))
+
+  return event_count
+
+#Read the newest recent change and the newest log event in the file namespace, which serve as the
+#high-water marks for the incremental updates of the image index
+def _read_high_water_marks() -> dict[str, dict[str, int | str] | None]:
+  le_result = next(api_client.query({ 'action': 'query', 'list': 'logevents', 'lenamespace': 6,
+                                      'ledir': 'older', 'lelimit': 1, 'leprop': 'ids|timestamp' }))
+
+  log_events = le_result['query']['logevents']
+
+  return {
+    'recent_changes': _read_newest_recent_change(namespace = 6),
+    'log_events': { 'logid': log_events[0]['logid'], 'timestamp': log_events[0]['timestamp'] }
+                  if log_events else None,
+  }
+
+#Read the id and timestamp of the newest recent change in a given namespace (or all namespaces if
+#None), if any
+def _read_newest_recent_change(namespace: int | None) -> dict[str, int | str] | None:
+  query_params = { 'action': 'query', 'list': 'recentchanges', 'rcdir': 'older', 'rclimit': 1,
+                   'rcprop': 'ids|timestamp' }
+  if namespace is not None:
+    query_params['rcnamespace'] = namespace
+
+  changes = next(api_client.query(query_params))['query']['recentchanges']
+
+  return { 'rcid': changes[0]['rcid'], 'timestamp': changes[0]['timestamp'] } if changes else None
+
+#Synchronize the revisions of a given list of images with the mediawiki server, removing images
+#that no longer exist
+def _refresh_images(titles: list[str]):
+  #Maximum amount of titles per request allowed by the mediawiki API
+  TITLES_PER_REQUEST = 50
+
+  if not titles: return
+
+  #Start a partial synchronization process for the revisions
+  revisions.partial_synchronize_begin()
+
+  #Query the mediawiki server for every block of titles and process each parsed JSON block
+  for i in range(0, len(titles), TITLES_PER_REQUEST):
+    query_params = { 'action': 'query', 'titles': '|'.join(titles[i:i + TITLES_PER_REQUEST]),
+                     'prop': 'imageinfo', 'iiprop': 'timestamp|url', 'iilocalonly': 1,
+                     'iilimit': 'max' }
+
+    for result in api_client.query(query_params):
+      _partial_synchronize_pages(result)
+
+  #Finish the partial synchronization process
+  _partial_synchronize_end()
+
+#Add the image revisions of a parsed JSON block to the ongoing partial synchronization process,
+#removing images without revisions
+def _partial_synchronize_pages(result: dict):
+  if 'query' not in result or 'pages' not in result['query']: return
+
+  for img in result['query']['pages'].values():
+    if 'imageinfo' not in img:
+      #The image has no revisions and has been removed
+      if images.read_id(img['title']) is not None:
         print(f'Removed: "{img['title']}"')
         images.delete(title = img['title'])
-      else:
-        #The image has revisions. Create or read an id for it.
-        image_id = images.create_read_id(title = img['title'])
+    else:
+      #The image has revisions. Create or read an id for it.
+      image_id = images.create_read_id(title = img['title'])
 
-        for rev in img['imageinfo']:
-          #Add each revision to the synchronization process
-          is_new = revisions.synchronize_add_one(image_id = image_id,
-                                                 timestamp = rev['timestamp'],
-                                                 url = rev['url'])
+      for rev in img['imageinfo']:
+        #Add each revision to the synchronization process
+        is_new = revisions.partial_synchronize_add_one(image_id = image_id,
+                                                       timestamp = rev['timestamp'],
+                                                       url = rev['url'])
 
-          if is_new:
-            print(f'Added: "{img['title']}" - {rev['timestamp']}')
+        if is_new:
+          print(f'Added: "{img['title']}" - {rev['timestamp']}')
 
-  #Show deletions caused by the partial synchronization process
+#Finish the ongoing partial synchronization process, showing the deletions it causes
+def _partial_synchronize_end():
   for image_id, timestamp in revisions.partial_synchronize_get_deletions():
     print(f'Removed: "{images.read_title(image_id)}" - {timestamp}')
 
-  #Finish the partial synchronization process
   revisions.partial_synchronize_end()
 
-  print('Done')
-
 #Refresh the list of unused images
 def update_unused_images():
   print('Updating unused images...')
 
-  #Create a scratch table for downloading the images
-  unused_images.synchronize_begin()
-
   query_params = {
     'action': 'query', 'list': 'querypage', 'qppage': 'Unusedimages', 'qplimit': 'max',
   }
 
   img_count = 0
+  cached_timestamp = None
 
   #Query the mediawiki server and process each parsed JSON block
-  for result in api_client.query(query_params):
-    querypage_results = result['query']['querypage']['results']
+  for block_count, result in enumerate(api_client.query(query_params)):
+    querypage = result['query']['querypage']
+
+    if block_count == 0:
+      #This is the first block. If the server reports a cached query page that was already
+      #processed in a previous run, it's not necessary to go any further.
+      cached_timestamp = querypage.get('cachedtimestamp')
+      if cached_timestamp is not None and \
+         cached_timestamp == sync_state.read('unused_images_cached_timestamp'):
+        print(f'Unused images are up to date (cached at {cached_timestamp})')
+        return
+
+      #Create a scratch table for downloading the images
+      unused_images.synchronize_begin()
+
+    querypage_results = querypage['results']
 
     #Insert the images into the scratch table
     unused_images.synchronize_add_many(img['title'] for img in querypage_results)
@@ -182,24 +389,159 @@ def update_unused_images():
     img_count += len(querypage_results)
     print(f'{img_count} unused images')
 
-  #The scratch table is completed. Update the unused images table with it.
-  unused_images.synchronize_end()
+  #The scratch table is completed. Update the unused images table with the differences.
+  added_count, removed_count = unused_images.synchronize_end()
+  print(f'{added_count} added, {removed_count} removed')
+
+  #Store the timestamp of the cached query page, so it's not processed again
+  if cached_timestamp is not None:
+    sync_state.write('unused_images_cached_timestamp', cached_timestamp)
+  else:
+    sync_state.delete('unused_images_cached_timestamp')
 
   print('Done')
 
+#Refresh the list of unused images using image usage information tracked locally, as an alternative
+#to the Special:UnusedImages query page. After an initial crawl, only the images and pages touched by
+#recent changes are queried.
+#Note: Changes of image usage caused by template edits are propagated by the mediawiki server
+#without recent changes for the affected pages, so a full refresh should still be performed
+#periodically to catch them.
+def update_unused_images_locally(full_refresh: bool):
+  print('Updating image usage...')
+
+  watermark = None if full_refresh else sync_state.read('image_usage')
+  if watermark is None:
+    #There's no continuation point, so retrieve the usage of all images. Read the high-water mark
+    #of the recent changes first, so the following updates continue from there (or from the
+    #beginning if there are no recent changes at all).
+    watermark = _read_newest_recent_change(namespace = None) or\
+                { 'rcid': 0, 'timestamp': '1970-01-01T00:00:00Z' }
+
+    query_params = { 'action': 'query', 'generator': 'allimages', 'gailimit': 'max',
+                     'prop': 'fileusage', 'fulimit': 'max' }
+
+    #Discard the continuation point before clearing the usage, so an interrupted crawl is started
+    #over instead of being updated incrementally with most of the usage missing
+    sync_state.delete('image_usage')
+    image_usage.clear()
+    img_count = 0
+
+    for result in api_client.query(query_params):
+      if 'query' not in result or 'pages' not in result['query']: continue
+
+      #The usage of an image may be split across multiple blocks, so just add it
+      for img in result['query']['pages'].values():
+        image_usage.add_many((img['title'], page['title']) for page in img.get('fileusage', ()))
+
+      img_count += len(result['query']['pages'])
+      print(f'{img_count} images')
+
+    sync_state.write('image_usage', watermark)
+  else:
+    #Query the recent changes in all namespaces right after the last processed one
+    query_params = { 'action': 'query', 'list': 'recentchanges', 'rcdir': 'newer',
+                     'rclimit': 'max', 'rcprop': 'title|ids|timestamp|loginfo',
+                     'rctype': 'edit|new|log',
+                     'rccontinue': f'{watermark['timestamp']}|{watermark['rcid'] + 1}' }
+
+    page_count = 0
+
+    for result in api_client.query(query_params):
+      changes = result['query']['recentchanges']
+      if not changes: continue
+
+      #Collect the changed pages, including the targets of page moves. Changed files might also have
+      #new uses (pages can link to files before they're uploaded), so collect them separately.
+      page_titles = {}
+      image_titles = {}
+      for change in changes:
+        if 'title' not in change: continue
+
+        page_titles[change['title']] = None
+        if change['ns'] == 6:
+          image_titles[change['title']] = None
+
+        if change.get('logtype') == 'move' and 'target_title' in change.get('logparams', {}):
+          page_titles[change['logparams']['target_title']] = None
+
+      #Refresh the usage information, then store the last change as the new continuation point
+      _refresh_page_images(list(page_titles))
+      _refresh_image_pages(list(image_titles))
+      sync_state.write('image_usage', { 'rcid': changes[-1]['rcid'],
+                                        'timestamp': changes[-1]['timestamp'] })
+
+      page_count += len(page_titles)
+      print(f'{page_count} changed pages')
+
+  #Update the unused images table with the images that are not used by any page. Only the
+  #differences are applied.
+  unused_images.synchronize_begin()
+  unused_images.synchronize_add_many(image_usage.get_unused_titles())
+  added_count, removed_count = unused_images.synchronize_end()
+  print(f'Unused images: {added_count} added, {removed_count} removed')
+
+  print('Done')
+
+#Refresh the locally tracked images used by a given list of pages
+def _refresh_page_images(titles: list[str]):
+  #Maximum amount of titles per request allowed by the mediawiki API
+  TITLES_PER_REQUEST = 50
+
+  for i in range(0, len(titles), TITLES_PER_REQUEST):
+    query_params = { 'action': 'query', 'titles': '|'.join(titles[i:i + TITLES_PER_REQUEST]),
+                     'prop': 'images', 'imlimit': 'max' }
+
+    #Gather the complete results first, as they may be split across multiple blocks. Missing pages
+    #are included as well, so their usage is removed.
+    page_images = { title: [] for title in titles[i:i + TITLES_PER_REQUEST] }
+    for result in api_client.query(query_params):
+      if 'query' not in result or 'pages' not in result['query']: continue
+
+      for page in result['query']['pages'].values():
+        page_images.setdefault(page['title'], []).extend(
+          img['title'] for img in page.get('images', ()))
+
+    image_usage.replace_page_images(page_images)
+
+#Refresh the locally tracked pages that use a given list of images
+def _refresh_image_pages(titles: list[str]):
+  #Maximum amount of titles per request allowed by the mediawiki API
+  TITLES_PER_REQUEST = 50
+
+  for i in range(0, len(titles), TITLES_PER_REQUEST):
+    query_params = { 'action': 'query', 'titles': '|'.join(titles[i:i + TITLES_PER_REQUEST]),
+                     'prop': 'fileusage', 'fulimit': 'max' }
+
+    #Gather the complete results first, as they may be split across multiple blocks
+    image_pages = { title: [] for title in titles[i:i + TITLES_PER_REQUEST] }
+    for result in api_client.query(query_params):
+      if 'query' not in result or 'pages' not in result['query']: continue
+
+      for img in result['query']['pages'].values():
+        image_pages.setdefault(img['title'], []).extend(
+          page['title'] for page in img.get('fileusage', ()))
+
+    image_usage.replace_image_pages(image_pages)
+
 #Download and calculate hashes for all images that haven't been hashed yet
-def update_hashes():
+#Parameters:
+# - limit: The maximum amount of image revisions to process, or None to process all of them.
+# - after_id: The revision id after which to start processing.
+#Return value: The id of the last processed image revision, or None if there were no more pending
+#revisions to process.
+def update_hashes(limit: int | None = None, after_id: int = -1) -> int | None:
   print('Downloading images and calculating hashes...')
 
-  #Create a connection pool for downloading. Only one download is performed at a time, but
-  #preserving open connections to potentially multiple servers might become useful for faster
-  #download times.
-  pool_mgr = urllib3.PoolManager()
-
   revision_count = 0
-  revision_total = pending_hashes.total()
-  for revision_id, revision_url_str in pending_hashes.get():
+  last_revision_id = None
+  revision_total = pending_hashes.total() if limit is None else min(pending_hashes.total(), limit)
+  for revision_id, revision_url_str in pending_hashes.get(after_id):
+    if revision_count == limit:
+      break
+
     revision_count += 1
+    last_revision_id = revision_id
     stream = None
 
     #Check whether files should be searched locally first by confirming that all associated globals
@@ -227,7 +569,12 @@ def update_hashes():
 
       #Perform a request to download the image and get the response
       sleep(config.root.image_updates.download_delay)
-      rsp = pool_mgr.request('GET', revision_url_str, preload_content = False)
+      try:
+        rsp = _download_pool.request('GET', revision_url_str, preload_content = False)
+      except urllib3.exceptions.HTTPError as e:
+        #Skip the image on connection errors, so a single unreachable image can't stall hashing
+        print(f'Download failed - {type(e).__name__}')
+        continue
 
       #Make sure the response is 200 - OK
       if rsp.status != 200:
@@ -247,8 +594,7 @@ def update_hashes():
       case perceptual_hash.Status.OK:
         #Store the hashes now. Do this as the last step, as this effectively removes the image from
         #the pending hashes view.
-        for h in new_hashes:
-          hashes.create(revision_id, h)
+        hashes.create(revision_id, new_hashes)
         print('OK')
       case perceptual_hash.Status.OUT_OF_MEM:
         #There was not enough memory for processing the image. Don't store a hash, so this can be
@@ -256,12 +602,272 @@ def update_hashes():
         print('Not enough memory')
       case perceptual_hash.Status.UNSUPPORTED:
         #The image could not be processed, possibly because its type is unsupported or there was
-        #another error. Store a null hash for it, so it won't be retried.
+        #another error. Store it as unsupported, so it won't be retried.
         hashes.create(revision_id, None)
         print('Not a recognized image file')
 
+  #Bring the data structures of the similarity search engine up to date, followed by the precomputed
+  #similar pairs, which are searched with it. Cached search results are outdated by now.
+  engine.refresh()
+  similar_pairs.update()
+  result_cache.purge()
+
+  print('Done')
+
+  return last_revision_id if revision_count == limit else None
+
+#Run the image updates as a long-running process. The image index, unused images, hash and hub hash
+#updates run as independent loops, each with its own interval and an exponential backoff on failure.
+#A single thread takes turns running one step of whichever loop is due next, so all loops share the
+#database connection and the open server connections. Hashing is performed in batches, so it does
+#not delay the other loops for long. Hub hashes are only counted from the precomputed similar pairs,
+#unless requested otherwise, as searching every hash would stall the other loops.
+#If an event stream is configured, it's consumed by a separate thread and the file changes it
+#reports are applied by another loop as soon as they arrive, followed by hashing the new revisions.
+#The first SIGTERM or SIGINT stops the process after the current step, a second one interrupts it
+#immediately. The status of every loop is written to the configured state file after each step.
+def run_daemon(full_index: bool, log_events: bool, local_usage: bool, just_index: bool,
+               count_hubs: bool) -> None:
+  print('Starting update daemon...')
+
+  #Stop gracefully when requested to terminate. The wake event interrupts waiting for the next loop.
+  stop_event = threading.Event()
+  wake_event = threading.Event()
+  def handle_signal(signum, frame):
+    if stop_event.is_set():
+      raise KeyboardInterrupt()
+
+    print(f'Received {signal.Signals(signum).name}, stopping after the current step...')
+    stop_event.set()
+    wake_event.set()
+
+  signal.signal(signal.SIGTERM, handle_signal)
+  signal.signal(signal.SIGINT, handle_signal)
+
+  #Loop step functions, which return whether they should be run again immediately
+  def index_step() -> bool:
+    nonlocal full_index
+    update_image_index(full_index = full_index, log_events = log_events)
+    engine.refresh()
+
+    #A forced full index update only applies to the first run
+    full_index = False
+    return False
+
+  full_usage = full_index
+  def unused_step() -> bool:
+    nonlocal full_usage
+    if local_usage:
+      update_unused_images_locally(full_refresh = full_usage)
+      full_usage = False
+    else:
+      update_unused_images()
+    return False
+
+  hash_cursor = -1
+  def hash_step() -> bool:
+    nonlocal hash_cursor
+    last_revision_id = update_hashes(limit = config.root.update_daemon.hash_batch_size,
+                                     after_id = hash_cursor)
+
+    #Keep hashing right away while there are pending images, otherwise start from the beginning in
+    #the next run (so images that failed are retried)
+    hash_cursor = -1 if last_revision_id is None else last_revision_id
+    return last_revision_id is not None
+
+  def hub_step() -> bool:
+    if count_hubs or similar_pairs.available(config.root.similarity_search.hub_max_dist):
+      hub_hashes.update()
+    return False
+
+  stream_queue = queue.SimpleQueue()
+  stream_events = []
+  def stream_step() -> bool:
+    #Apply all the changes received so far at once. They're kept until applied successfully, so
+    #they're applied again in the next run if this one fails.
+    while not stream_queue.empty():
+      stream_events.append(stream_queue.get())
+
+    if not stream_events:
+      return False
+
+    event_count = apply_stream_events(stream_events)
+    stream_events.clear()
+
+    if event_count > 0:
+      engine.refresh()
+
+      #Hash the new revisions right away, unless hashing is backing off
+      if 'hashes' in loops and loops['hashes']['failures'] == 0:
+        loops['hashes']['next_run'] = time()
+    return False
+
+  loops = {
+    'index': _daemon_loop(index_step, config.root.update_daemon.index_interval),
+    'unused': _daemon_loop(unused_step, config.root.update_daemon.unused_interval),
+  }
+  if not just_index:
+    loops['hashes'] = _daemon_loop(hash_step, config.root.update_daemon.hash_interval)
+    loops['hubs'] = _daemon_loop(hub_step, config.root.update_daemon.hub_interval)
+
+  #Start consuming the event stream, resuming after the last applied event
+  stream_state = None
+  if event_stream.enabled():
+    loops['stream'] = _daemon_loop(stream_step, config.root.update_daemon.index_interval)
+    stream_state = { 'last_event': None, 'last_error': None, 'failures': 0 }
+    threading.Thread(target = _read_event_stream,
+                     args = (sync_state.read('event_stream'), stream_queue, wake_event,
+                             stream_state),
+                     daemon = True).start()
+
+  try:
+    while not stop_event.is_set():
+      wake_event.clear()
+
+      #Apply stream events as soon as they arrive, unless their loop is backing off
+      if 'stream' in loops and not stream_queue.empty() and loops['stream']['failures'] == 0:
+        loops['stream']['next_run'] = time()
+
+      #Wait for the loop that is due next, unless the process is requested to stop or stream events
+      #arrive
+      name, loop = min(loops.items(), key = lambda item: item[1]['next_run'])
+      delay = loop['next_run'] - time()
+      if delay > 0:
+        wake_event.wait(delay)
+        continue
+
+      #Run one step of the loop, rescheduling it according to the result
+      loop['last_run'] = time()
+      try:
+        run_again = loop['step']()
+      except Exception as e:
+        traceback.print_exc()
+
+        loop['failures'] += 1
+        loop['last_error'] = f'{type(e).__name__}: {e}'
+
+        #Back off exponentially with some jitter, so failing loops don't hammer the server
+        backoff = min(config.root.update_daemon.max_backoff,
+                      loop['interval'] * 2 ** loop['failures'])
+        loop['next_run'] = time() + random.uniform(backoff / 2, backoff)
+        print(f'Loop {name} failed, retrying in {loop['next_run'] - time():.0f}s')
+      else:
+        loop['failures'] = 0
+        loop['last_success'] = time()
+        loop['next_run'] = time() if run_again else time() + loop['interval']
+
+      _write_daemon_state(loops, stream_state, len(stream_events) + stream_queue.qsize())
+  except KeyboardInterrupt:
+    print()
+
+  print('Update daemon stopped')
+
+#Read the event stream, queueing the file log events reported for the mediawiki server and waking
+#up the update daemon for each one. This is run by a separate thread, which can't access the
+#database. Unexpected errors are reported and the stream is reconnected after a backoff, resuming
+#after the last received event. The status of the stream is kept in the given state dictionary.
+def _read_event_stream(last_event_id: str | None, stream_queue: queue.SimpleQueue,
+                       wake_event: threading.Event, stream_state: dict) -> None:
+  while True:
+    try:
+      for event_id, data in event_stream.events(last_event_id):
+        last_event_id = event_id
+        stream_state['last_event'] = time()
+        stream_state['failures'] = 0
+
+        if _is_file_log_change(data):
+          stream_queue.put((event_id, data))
+          wake_event.set()
+    except Exception as e:
+      traceback.print_exc()
+
+      stream_state['failures'] += 1
+      stream_state['last_error'] = f'{type(e).__name__}: {e}'
+
+      #Back off exponentially, so a persistent error doesn't hammer the server
+      delay = min(event_stream.RECONNECT_DELAY_MAX,
+                  config.root.event_stream.reconnect_delay * 2 ** stream_state['failures'])
+      print(f'Event stream failed, reconnecting in {delay:.0f}s')
+      sleep(delay)
+
+#Check whether a recentchange event stream change is an upload, deletion or move of a file in the
+#mediawiki server. Streams may provide changes from multiple servers, so check the server name too.
+def _is_file_log_change(data: any) -> bool:
+  return isinstance(data, dict) and data.get('type') == 'log' and data.get('namespace') == 6 and\
+         data.get('log_type') in ('upload', 'delete', 'move') and 'title' in data and\
+         data.get('server_name', config.root.mediawiki_server.url.hostname) ==\
+           config.root.mediawiki_server.url.hostname
+
+#Apply a group of file changes received from the recentchange event stream to the image index, then
+#store the id of the last change, so the stream can be resumed right after it
+#Parameters:
+# - stream_events: Tuples with the event id and the event data of each change, in order.
+#Return value: The amount of changes applied.
+def apply_stream_events(stream_events: list[tuple[str | None, dict]]) -> int:
+  print('Applying event stream changes...')
+
+  #Convert the changes to log events, as returned by the mediawiki API
+  log_events = []
+  for _, data in stream_events:
+    log_event = { 'type': data['log_type'], 'action': data.get('log_action'),
+                  'title': data['title'] }
+
+    if data['log_type'] == 'move':
+      #Moves without a target (hidden or suppressed) can't be applied
+      log_params = data.get('log_params')
+      if not isinstance(log_params, dict) or 'target' not in log_params:
+        continue
+      log_event['params'] = { 'target_title': log_params['target'] }
+
+    log_events.append(log_event)
+
+  event_count = _apply_log_events(log_events)
+
+  last_event_id = stream_events[-1][0]
+  if last_event_id is not None:
+    sync_state.write('event_stream', last_event_id)
+
+  print(f'{event_count} changes')
   print('Done')
 
+  return event_count
+
+#Create the state of an update daemon loop, due to run immediately
+def _daemon_loop(step, interval: int) -> dict:
+  return { 'step': step, 'interval': interval, 'next_run': time(), 'last_run': None,
+           'last_success': None, 'last_error': None, 'failures': 0 }
+
+#Write the status of the update daemon loops and the event stream (if any) to the state file. The
+#file is replaced atomically, so readers never see it partially written.
+def _write_daemon_state(loops: dict[str, dict], stream_state: dict | None,
+                        pending_stream_events: int) -> None:
+  def format_time(t: float | None) -> str | None:
+    return None if t is None else\
+           datetime.fromtimestamp(t, timezone.utc).isoformat(timespec = 'seconds')
+
+  state = {
+    'pid': os.getpid(),
+    'updated': format_time(time()),
+    'loops': { name: { 'last_run': format_time(loop['last_run']),
+                       'last_success': format_time(loop['last_success']),
+                       'last_error': loop['last_error'],
+                       'failures': loop['failures'],
+                       'next_run': format_time(loop['next_run']) }
+               for name, loop in loops.items() },
+    'server_requests': transport.stats(),
+  }
+
+  if stream_state is not None:
+    state['event_stream'] = { 'last_event': format_time(stream_state['last_event']),
+                              'last_error': stream_state['last_error'],
+                              'failures': stream_state['failures'],
+                              'pending_events': pending_stream_events }
+
+  state_path = Path(config.root.update_daemon.state_file)
+  temp_path = state_path.with_name(state_path.name + '.tmp')
+  temp_path.write_text(json.dumps(state, indent = 2))
+  os.replace(temp_path, state_path)
+
 #Open a local file for reading and return a stream compatible with urllib3's response streams
 def _local_file_stream(pathname: Path) -> Iterator[bytes] | None:
   #Function used for generating chunks
@@ -284,13 +890,65 @@ parser.add_argument('-fi', '--full-index',
 parser.add_argument('-ji', '--just-index',
                     action = 'store_true',
                     help = 'Update the image index only (prevent downloading images for hashing)')
+parser.add_argument('-le', '--log-events',
+                    action = 'store_true',
+                    help = 'Update the image index from file log events (tracks deletions, moves and '
+                           'overwrites)')
+parser.add_argument('-lu', '--local-usage',
+                    action = 'store_true',
+                    help = 'Track image usage locally instead of using the unused images special page '
+                           '(a full index update also refreshes the full image usage)')
+parser.add_argument('-sp', '--similar-pairs',
+                    action = 'store_true',
+                    help = 'Compute the similar image pairs used by the review pages from scratch '
+                           '(they are kept up to date afterwards)')
+parser.add_argument('-dc', '--duplicate-clusters',
+                    action = 'store_true',
+                    help = 'Compute the near-duplicate image clusters of the duplicate report '
+                           '(skipped if the hashes have not changed)')
+parser.add_argument('-hh', '--hub-hashes',
+                    action = 'store_true',
+                    help = 'Count the similar revisions of every hash to find the ones similar to '
+                           'too many images, which are collapsed in the review pages (skipped if '
+                           'the hashes have not changed). The daemon always counts them '
+                           'periodically if the similar pairs are available, or only with this '
+                           'option otherwise.')
+parser.add_argument('-d', '--daemon',
+                    action = 'store_true',
+                    help = 'Keep running and perform every update periodically (stops on SIGTERM)')
 args = parser.parse_args()
 
-try:
-  update_image_index(full_index = args.full_index)
-  update_unused_images()
-
-  if not args.just_index:
-    update_hashes()
-except KeyboardInterrupt:
-  print()
+if args.daemon:
+  run_daemon(full_index = args.full_index, log_events = args.log_events,
+             local_usage = args.local_usage, just_index = args.just_index,
+             count_hubs = args.hub_hashes)
+else:
+  try:
+    update_image_index(full_index = args.full_index, log_events = args.log_events)
+    engine.refresh()
+
+    if args.local_usage:
+      update_unused_images_locally(full_refresh = args.full_index)
+    else:
+      update_unused_images()
+
+    if not args.just_index:
+      update_hashes()
+
+    if args.similar_pairs:
+      similar_pairs.rebuild()
+
+    if args.duplicate_clusters:
+      duplicate_clusters.update()
+
+    if args.hub_hashes:
+      hub_hashes.update()
+  except KeyboardInterrupt:
+    print()
+
+#Show the mediawiki server request counters
+stats = transport.stats()
+print(f'{stats['requests']} server requests ({stats['retries']} retries), '
+      f'{stats['bytes_received']} bytes received ({stats['bytes_decoded']} decoded), '
+      f'{stats['latency_total'] / max(stats['requests'], 1):.3f}s average latency, '
+      f'{stats['latency_max']:.3f}s maximum latency')